@@ -0,0 +1,45 @@
+"""
+Ring of the most recent broadcast frames, replayed to users as they log in.
+
+The ring has a fixed number of slots allocated up front and keeps frames
+already encoded, so a login costs one join and one write however many
+frames it is sent, and recording a broadcast never allocates a slot.
+"""
+import threading
+
+class FrameRing:
+    """The last capacity encoded frames, oldest overwritten first"""
+
+    def __init__(self, capacity, metrics):
+        self.slots = [b""] * capacity
+        self.next = 0  # Slot the next frame is written to
+        self.count = 0
+        self.lock = threading.Lock()
+        self.replayed = metrics.counter("broadcast_backlog_replayed_total", "Backlog frames replayed to users logging in")
+        metrics.gauge("broadcast_backlog_frames", "Broadcast frames held for replay", lambda: self.count)
+
+    def append(self, frame, recipients=list):
+        """
+        Record a frame and return recipients(), called under the ring's lock so
+        that every user logging in either gets the frame replayed or is listed.
+        """
+        with self.lock:
+            if self.slots:
+                self.slots[self.next] = frame
+                self.next = (self.next + 1) % len(self.slots)
+                self.count = min(self.count + 1, len(self.slots))
+            return recipients()
+
+    def snapshot(self, register=None):
+        """
+        Return the frames in the ring, oldest first, as one buffer, calling
+        register() under the ring's lock so the new user is listed for every
+        frame appended after it and for none of those in the buffer.
+        """
+        with self.lock:
+            start = self.next - self.count
+            frames = self.slots[start:self.next] if start >= 0 else self.slots[start:] + self.slots[:self.next]
+            if register is not None:
+                register()
+        self.replayed.inc(amount=len(frames))
+        return b"".join(frames)
@@ -0,0 +1,133 @@
+"""
+Binary capture of the frames clients send to the server, for replay.
+
+A capture starts with CAPTURE_MAGIC, followed by records of a fixed header
+and a payload:
+
+    kind        1 byte    FRAME, USER or CLOSE
+    connection  4 bytes   ID of the connection, unique within the capture
+    time        8 bytes   nanoseconds since the capture started
+    length      4 bytes   payload length
+    payload               the frame without its newline, or the username of a USER record
+
+Relay threads only queue records, a writer thread encodes and writes them
+in batches. Password hashes in LOGIN and REGISTER frames are never written.
+Paths ending in .gz are gzip-compressed.
+"""
+import gzip
+import queue
+import struct
+import threading
+import time
+from collections import namedtuple
+from common import log
+
+log_capture = log.get_logger("capture")
+
+CAPTURE_MAGIC = b"CHATCAP1"
+RECORD_HEADER = struct.Struct(">BIQI")
+CAPTURE_QUEUE_LIMIT = 100000  # Records waiting for the writer before new ones are dropped
+CAPTURE_BATCH = 1000  # Records written per write call
+
+# Record kinds
+FRAME = 0  # A frame read from the connection
+USER = 1  # The connection authenticated as a user
+CLOSE = 2  # The connection ended
+
+Record = namedtuple("Record", ["kind", "connection", "time_ns", "data"])
+
+def open_capture(path, mode):
+    return gzip.open(path, mode, compresslevel=1) if path.endswith(".gz") else open(path, mode)
+
+def redact(frame):
+    """Drop the password hash from LOGIN and REGISTER frames"""
+    if frame.startswith(("LOGIN|", "REGISTER|")):
+        command, username, _ = (frame.split('|', 2) + ["", ""])[:3]
+        return f"{command}|{username}|"
+    return frame
+
+class Recorder:
+    """Writes records queued by connection threads to a capture file"""
+
+    def __init__(self, path, metrics):
+        self.path = path
+        self.incoming = queue.SimpleQueue()
+        self.started_ns = time.monotonic_ns()
+        self.thread = None
+        self.recorded = metrics.counter("capture_records_total", "Records written to the capture file")
+        self.dropped = metrics.counter("capture_dropped_total", "Records dropped because the writer fell behind")
+        metrics.gauge("capture_backlog", "Records waiting for the capture writer", self.incoming.qsize)
+
+    def start(self):
+        capture_file = open_capture(self.path, "wb")
+        capture_file.write(CAPTURE_MAGIC)
+        self.thread = threading.Thread(target=self.write_forever, args=(capture_file,), daemon=True, name="capture-writer")
+        self.thread.start()
+        log_capture.info("Capturing inbound frames to %s", self.path)
+        return self
+
+    def stop(self):
+        """Write what is queued and close the file"""
+        self.incoming.put(None)
+        self.thread.join()
+
+    def record(self, kind, connection, data):
+        if self.incoming.qsize() >= CAPTURE_QUEUE_LIMIT:
+            self.dropped.inc()
+            return
+        self.incoming.put((kind, connection, time.monotonic_ns(), data))
+
+    def frame(self, connection, frame):
+        self.record(FRAME, connection, frame)
+
+    def user(self, connection, username):
+        self.record(USER, connection, username)
+
+    def close(self, connection):
+        self.record(CLOSE, connection, "")
+
+    def write_forever(self, capture_file):
+        with capture_file:
+            while True:
+                batch = [self.incoming.get()]
+                while batch[-1] is not None and len(batch) < CAPTURE_BATCH:
+                    try:
+                        batch.append(self.incoming.get_nowait())
+                    except queue.Empty:
+                        break
+                stopping = batch[-1] is None
+                if stopping:
+                    batch.pop()
+                chunks = []
+                for kind, connection, time_ns, data in batch:
+                    payload = (redact(data) if kind == FRAME else data).encode()
+                    chunks.append(RECORD_HEADER.pack(kind, connection, time_ns - self.started_ns, len(payload)))
+                    chunks.append(payload)
+                try:
+                    capture_file.write(b"".join(chunks))
+                    capture_file.flush()
+                except OSError as e:
+                    log_capture.error("Error writing capture %s: %s", self.path, e)
+                    return
+                self.recorded.inc(amount=len(batch))
+                if stopping:
+                    return
+
+def read_capture(path):
+    """Yield the Records of a capture, stopping quietly at a truncated tail"""
+    with open_capture(path, "rb") as capture_file:
+        if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a chat capture")
+        while True:
+            try:
+                header = capture_file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                kind, connection, time_ns, length = RECORD_HEADER.unpack(header)
+                payload = capture_file.read(length)
+            except EOFError:
+                # A gzip capture of a server that did not stop cleanly
+                return
+            if len(payload) < length:
+                return
+            yield Record(kind, connection, time_ns, payload.decode())
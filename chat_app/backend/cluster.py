@@ -0,0 +1,283 @@
+"""
+Federation of several chat server nodes.
+
+Nodes form a full mesh of TCP links. Every node owns the users connected to
+it and replicates that ownership to all other nodes, so any node can locate
+a user and reach it in a single hop. Frames forwarded between nodes are only
+ever delivered locally, never forwarded again.
+
+Links are authenticated with a secret shared by every node: each side
+sends a random challenge in its hello and answers the other's with an HMAC
+of both challenges, and a peer that cannot is dropped before any other
+frame is read from it.
+
+Node protocol, one frame per line like the client protocol:
+    NODE_HELLO|node_id|challenge
+    NODE_AUTH|hmac                        HMAC-SHA256 of "peer challenge|own challenge|own node_id"
+    DIR_SET|username|ip|port|p2p_port     owner announces or updates a user
+    DIR_DEL|username                      owner lost a user
+    FWD|username|sent_ns|frame            deliver a client frame to a user
+    FWD_ALL|exclude|sent_ns|frame         deliver to every local user but one, or to
+                                          the local members of a room for room frames
+    CREDENTIALS|username|password_hash    replicate a registration
+"""
+import hashlib
+import hmac
+import secrets
+import socket
+import threading
+import time
+from common.protocol import encode_frame, FrameReader, FRAME_DELIMITER
+from common import log
+
+log_cluster = log.get_logger("cluster")
+
+CLUSTER_RETRY_INTERVAL = 2.0  # Seconds between attempts to reach a peer node
+CLUSTER_CONNECT_TIMEOUT = 5.0
+
+def parse_address(address):
+    """Parse "host:port" into (host, port)"""
+    host, _, port = address.rpartition(':')
+    return host or "127.0.0.1", int(port)
+
+def link_proof(secret, peer_challenge, own_challenge, node_id):
+    """Return the NODE_AUTH answer of node_id to peer_challenge"""
+    message = f"{peer_challenge}|{own_challenge}|{node_id}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+class NodeLink:
+    """TCP link to one peer node"""
+
+    def __init__(self, node_id, sock, reader):
+        self.node_id = node_id
+        self.sock = sock
+        self.reader = reader
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+class Cluster:
+    """Links to the other nodes and the replicated user directory"""
+
+    def __init__(self, node_id, listen_address, peer_addresses, secret, metrics,
+                 deliver, deliver_broadcast, on_directory_change, on_credentials, local_directory):
+        if not secret:
+            raise ValueError("A cluster node needs a shared secret")
+        self.node_id = node_id
+        self.secret = secret
+        self.listen_address = listen_address
+        self.peer_addresses = peer_addresses
+        # Callbacks into the server
+        self.deliver = deliver  # deliver(username, frame) sends a frame to a local user
+        self.deliver_broadcast = deliver_broadcast  # deliver_broadcast(frame, exclude)
+        self.on_directory_change = on_directory_change  # on_directory_change(added, removed) with lists of usernames
+        self.on_credentials = on_credentials  # on_credentials(username, password_hash)
+        self.local_directory = local_directory  # Returns [(username, ip, port, p2p_port)] of local users
+        self.links = {}  # Dictionary to store the link to each node: {node_id: NodeLink}
+        self.directory = {}  # Dictionary to store remote users: {username: (node_id, ip, port, p2p_port)}
+        self.lock = threading.Lock()
+        self.listener = None
+        self.stopping = False
+        self.hop_latency = metrics.histogram("cluster_hop_seconds", "Delay of frames forwarded from another node",
+                                             label_name="kind")
+        self.forwarded = metrics.counter("cluster_forwarded_total", "Frames forwarded to other nodes", label_name="kind")
+        self.rejected = metrics.counter("cluster_rejected_links_total", "Links dropped for failing the handshake",
+                                        label_name="reason")
+        metrics.gauge("cluster_nodes", "Peer nodes with an open link", lambda: len(self.links))
+        metrics.gauge("remote_users", "Users connected to other nodes", lambda: len(self.directory))
+
+    def start(self):
+        """Bind the cluster port, raising OSError if it is taken, then accept and dial peer nodes"""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server.bind(self.listen_address)
+            server.listen(16)
+        except OSError:
+            server.close()
+            raise
+        self.listener = server
+        log_cluster.info("Node %s accepting peer nodes on %s:%s", self.node_id, *self.listen_address)
+        threading.Thread(target=self.listen, args=(server,), daemon=True).start()
+        for address in self.peer_addresses:
+            threading.Thread(target=self.dial_forever, args=(address,), daemon=True).start()
+        return self
+
+    def stop_listening(self):
+        """Release the cluster port, links already open stay up"""
+        self.stopping = True
+        if self.listener is not None:
+            try:
+                # Shutting down wakes the accept call, closing alone would leave the port bound
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener.close()
+
+    def listen(self, server):
+        """Accept links from peer nodes"""
+        while True:
+            try:
+                sock, _ = server.accept()
+            except OSError as e:
+                if self.stopping:
+                    return
+                log_cluster.error("Error accepting peer node: %s", e)
+                continue
+            threading.Thread(target=self.run_link, args=(sock,), daemon=True).start()
+
+    def dial_forever(self, address):
+        """Keep a link to a configured peer node open, redialing when it drops"""
+        while True:
+            try:
+                sock = socket.create_connection(parse_address(address), timeout=CLUSTER_CONNECT_TIMEOUT)
+            except OSError:
+                time.sleep(CLUSTER_RETRY_INTERVAL)
+                continue
+            self.run_link(sock)
+            time.sleep(CLUSTER_RETRY_INTERVAL)
+
+    def handshake(self, sock, reader):
+        """Exchange hellos and prove the shared secret both ways, return the peer's node_id or None"""
+        challenge = secrets.token_hex(16)
+        sock.sendall(encode_frame("NODE_HELLO", self.node_id, challenge))
+        hello = (reader.read_frame() or "").split('|')
+        if len(hello) != 3 or hello[0] != "NODE_HELLO" or not hello[1] or hello[1] == self.node_id:
+            self.rejected.inc("hello")
+            return None
+        _, node_id, peer_challenge = hello
+        sock.sendall(encode_frame("NODE_AUTH", link_proof(self.secret, peer_challenge, challenge, self.node_id)))
+        answer = (reader.read_frame() or "").split('|')
+        expected = link_proof(self.secret, challenge, peer_challenge, node_id)
+        if len(answer) != 2 or answer[0] != "NODE_AUTH" or not hmac.compare_digest(answer[1], expected):
+            self.rejected.inc("auth")
+            log_cluster.warning("Dropped a link claiming to be node %s that failed authentication", node_id)
+            return None
+        return node_id
+
+    def run_link(self, sock):
+        """Authenticate the peer, exchange directories, then handle frames until the link closes"""
+        reader = FrameReader(sock)
+        try:
+            sock.settimeout(CLUSTER_CONNECT_TIMEOUT)
+            node_id = self.handshake(sock, reader)
+            sock.settimeout(None)
+        except (OSError, UnicodeDecodeError) as e:
+            log_cluster.warning("Handshake with peer node failed: %s", e)
+            node_id = None
+        if node_id is None:
+            sock.close()
+            return
+
+        link = NodeLink(node_id, sock, reader)
+        with self.lock:
+            self.links[node_id] = link
+        log_cluster.info("Linked to node %s", node_id)
+
+        try:
+            # Tell the new peer about every user we own
+            for entry in self.local_directory():
+                link.send(encode_frame("DIR_SET", *entry))
+            while True:
+                frames = reader.read_frames()
+                if frames is None:
+                    break
+                for frame in frames:
+                    self.handle_frame(link, frame)
+        except Exception as e:
+            log_cluster.warning("Link to node %s failed: %s", node_id, e)
+        finally:
+            sock.close()
+            self.drop_link(link)
+
+    def drop_link(self, link):
+        """Forget a closed link and the users owned by its node"""
+        with self.lock:
+            if self.links.get(link.node_id) is not link:
+                return  # A newer link to the same node took over
+            del self.links[link.node_id]
+            lost = [name for name, entry in self.directory.items() if entry[0] == link.node_id]
+            for name in lost:
+                del self.directory[name]
+        log_cluster.info("Lost node %s and its %d users", link.node_id, len(lost))
+        if lost:
+            self.on_directory_change([], lost)
+
+    def handle_frame(self, link, frame):
+        kind, _, rest = frame.partition('|')
+
+        if kind == "FWD":
+            username, sent_ns, payload = rest.split('|', 2)
+            self.hop_latency.observe((time.time_ns() - int(sent_ns)) / 1e9, "FWD")
+            self.deliver(username, payload.encode() + FRAME_DELIMITER)
+
+        elif kind == "FWD_ALL":
+            exclude, sent_ns, payload = rest.split('|', 2)
+            self.hop_latency.observe((time.time_ns() - int(sent_ns)) / 1e9, "FWD_ALL")
+            self.deliver_broadcast(payload, exclude or None)
+
+        elif kind == "DIR_SET":
+            username, ip, port, p2p_port = rest.split('|')
+            with self.lock:
+                known = username in self.directory
+                self.directory[username] = (link.node_id, ip, port, p2p_port)
+            if not known:
+                self.on_directory_change([username], [])
+
+        elif kind == "DIR_DEL":
+            with self.lock:
+                entry = self.directory.get(rest)
+                removed = entry is not None and entry[0] == link.node_id
+                if removed:
+                    del self.directory[rest]
+            if removed:
+                self.on_directory_change([], [rest])
+
+        elif kind == "CREDENTIALS":
+            username, password_hash = rest.split('|', 1)
+            self.on_credentials(username, password_hash)
+
+    def send_all(self, data):
+        """Send a frame to every peer node"""
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            try:
+                link.send(data)
+            except OSError as e:
+                log_cluster.warning("Error sending to node %s: %s", link.node_id, e)
+
+    def locate(self, username):
+        """Return (node_id, ip, port, p2p_port) of a user on another node, or None"""
+        return self.directory.get(username)
+
+    def remote_users(self):
+        with self.lock:
+            return list(self.directory)
+
+    def forward(self, username, *fields):
+        """Forward a client frame to the node that owns username, returning False if none does"""
+        entry = self.directory.get(username)
+        link = self.links.get(entry[0]) if entry else None
+        if link is None:
+            return False
+        link.send(encode_frame("FWD", username, time.time_ns(), *fields))
+        self.forwarded.inc("FWD")
+        return True
+
+    def broadcast(self, exclude, *fields):
+        """Deliver a client frame to the local users of every other node"""
+        self.send_all(encode_frame("FWD_ALL", exclude or "", time.time_ns(), *fields))
+        self.forwarded.inc("FWD_ALL")
+
+    def publish_user(self, username, ip, port, p2p_port):
+        """Announce that a user is connected here, or update its P2P port"""
+        self.send_all(encode_frame("DIR_SET", username, ip, port, p2p_port))
+
+    def unpublish_user(self, username):
+        self.send_all(encode_frame("DIR_DEL", username))
+
+    def publish_credentials(self, username, password_hash):
+        self.send_all(encode_frame("CREDENTIALS", username, password_hash))
@@ -0,0 +1,59 @@
+"""
+Sorted index of the online usernames for WHO queries.
+
+Names are kept in one sorted list, so a prefix query is a binary search
+followed by a slice. Pages are addressed by a cursor, the last name of the
+previous page, rather than an offset, so users coming and going between
+two requests never make a client skip or repeat a name.
+
+A name can be online on this node and, briefly while moving, on another
+one; it stays listed until every source removed it.
+"""
+import threading
+from bisect import bisect_left, bisect_right
+
+WHO_PAGE = 50  # Names per WHO page unless the client asks for fewer
+WHO_MAX_PAGE = 200
+
+class UserDirectory:
+    """Online usernames of this node and its peers, sorted for prefix queries"""
+
+    def __init__(self, metrics):
+        self.names = []
+        self.sources = {}  # Dictionary to store how many places list each name: {username: count}
+        self.lock = threading.Lock()
+        self.queries = metrics.counter("who_queries_total", "WHO queries answered")
+        metrics.gauge("directory_users", "Usernames in the online user directory", lambda: len(self.names))
+
+    def add(self, username):
+        with self.lock:
+            count = self.sources.get(username, 0)
+            self.sources[username] = count + 1
+            if not count:
+                self.names.insert(bisect_left(self.names, username), username)
+
+    def remove(self, username):
+        with self.lock:
+            count = self.sources.get(username, 0)
+            if count > 1:
+                self.sources[username] = count - 1
+            elif count:
+                del self.sources[username]
+                del self.names[bisect_left(self.names, username)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def query(self, prefix="", cursor="", limit=WHO_PAGE):
+        """Return (names, next cursor) of the page of names starting with prefix after cursor, the cursor is "" on the last page"""
+        limit = max(1, min(limit, WHO_MAX_PAGE))
+        self.queries.inc()
+        with self.lock:
+            start = bisect_left(self.names, prefix)
+            if cursor:
+                start = max(start, bisect_right(self.names, cursor))
+            page = self.names[start:start + limit + 1]
+        matching = [name for name in page if name.startswith(prefix)]
+        if len(matching) > limit:
+            return matching[:limit], matching[limit - 1]
+        return matching, ""
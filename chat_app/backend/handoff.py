@@ -0,0 +1,52 @@
+"""
+Socket handoff between an old and a new chat server process.
+
+The old process passes its open sockets to the new one over a Unix socket
+with SCM_RIGHTS, together with JSON metadata describing them. Every message
+is a 4 byte length carrying the file descriptors, followed by the JSON body:
+
+    {"kind": "listener", ...}   the listening socket and server-wide state
+    {"kind": "sessions", "sessions": [...]}   one descriptor per session
+    {"kind": "done"}
+"""
+import json
+import socket
+import struct
+
+HANDOFF_FDS_PER_MESSAGE = 200  # Stays below the kernel limit of descriptors per message
+HANDOFF_HEADER = struct.Struct(">I")
+
+def send_message(conn, payload, fds=()):
+    """Send a JSON payload with the given file descriptors attached"""
+    body = json.dumps(payload).encode()
+    socket.send_fds(conn, [HANDOFF_HEADER.pack(len(body))], list(fds))
+    conn.sendall(body)
+
+def recv_exactly(conn, size, data=b""):
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Handoff connection closed")
+        data += chunk
+    return data
+
+def receive_message(conn):
+    """Receive one message, return (payload, fds)"""
+    header, fds, _, _ = socket.recv_fds(conn, HANDOFF_HEADER.size, HANDOFF_FDS_PER_MESSAGE)
+    if not header:
+        raise ConnectionError("Handoff connection closed")
+    size, = HANDOFF_HEADER.unpack(recv_exactly(conn, HANDOFF_HEADER.size, header))
+    return json.loads(recv_exactly(conn, size)), fds
+
+def send_sessions(conn, sessions):
+    """Send [(socket, metadata)] in batches small enough for one message each"""
+    for start in range(0, len(sessions), HANDOFF_FDS_PER_MESSAGE):
+        batch = sessions[start:start + HANDOFF_FDS_PER_MESSAGE]
+        send_message(conn, {"kind": "sessions", "sessions": [meta for _, meta in batch]},
+                     [sock.fileno() for sock, _ in batch])
+
+def set_receive_timeout(sock, seconds):
+    """Set SO_RCVTIMEO, 0 blocks forever; it applies to every process holding the socket"""
+    whole = int(seconds)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO,
+                    struct.pack("ll", whole, int((seconds - whole) * 1e6)))
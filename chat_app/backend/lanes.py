@@ -0,0 +1,114 @@
+"""
+Priority lanes for the frames written to one client socket.
+
+Every thread sending to a client writes the socket itself, one frame at a
+time under the connection's lock. A plain lock hands the socket to its
+waiters in no particular order, so a P2P_INFO can wait behind a pile of
+broadcasts to a slow reader. A LaneLock hands it to waiting control frames
+first, bulk chat after them in arrival order, and after CONTROL_BURST
+control turns in a row gives a waiting bulk frame the next one, so a
+stream of control frames never starves chat. Only the frame already being
+written is never overtaken.
+
+Lanes only order the threads queued for a socket, they do not isolate a
+slow peer: while a write to a client that stopped reading blocks, every
+frame for that client waits behind it, control frames included. The
+server bounds that stall with a send timeout on client sockets, after
+which the connection is reaped and the frames still queued fail at once.
+
+Waking a waiter does not hand it the lock: keeping the socket for a thread
+that has yet to be scheduled leaves it idle and every other writer queued
+behind, so a free lock goes to whichever thread gets to it first, as with a
+plain lock. Bulk frames only give way to control frames waiting or woken,
+and the turn owed to a bulk frame is the one turn kept for its thread.
+"""
+import threading
+import time
+from collections import deque
+
+CONTROL, BULK = 0, 1
+LANE_NAMES = ("control", "bulk")
+CONTROL_BURST = 8  # Control turns in a row while bulk frames wait
+
+class OutboundLanes:
+    """Makes the lane locks of client sockets, sharing their metrics"""
+
+    def __init__(self, metrics):
+        self.wait = metrics.histogram("send_wait_seconds", "Time frames waited for their turn on a client socket",
+                                      label_name="lane")
+        self.bulk_turns = metrics.counter("send_bulk_turns_total", "Turns given to bulk frames ahead of waiting control frames")
+
+    def lock(self):
+        return LaneLock(self)
+
+class LaneLock:
+    """Lock on one client socket, granting its turns by lane"""
+
+    __slots__ = ("lanes", "mutex", "busy", "waiting", "woken", "reserved", "streak")
+
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self.mutex = threading.Lock()
+        self.busy = False
+        self.waiting = (deque(), deque())  # Gates of the waiting threads per lane
+        self.woken = 0  # Control threads woken that have not taken the lock yet
+        self.reserved = None  # Gate of the bulk thread owed the next turn
+        self.streak = 0  # Control turns given in a row while bulk frames waited
+
+    def acquire(self, lane=BULK, blocking=True):
+        gate = None
+        started = time.perf_counter()
+        while True:
+            with self.mutex:
+                if gate is not None and lane == CONTROL:
+                    self.woken -= 1
+                if self.reserved is not None:
+                    free = not self.busy and self.reserved is gate
+                else:
+                    # Bulk frames only take a free lock while no control frame waits
+                    free = not self.busy and (lane == CONTROL or not (self.waiting[CONTROL] or self.woken))
+                if free:
+                    self.busy = True
+                    self.reserved = None
+                    self.lanes.wait.observe(time.perf_counter() - started if gate else 0.0, LANE_NAMES[lane])
+                    return True
+                if not blocking:
+                    return False
+                if gate is None:
+                    gate = threading.Lock()
+                    gate.acquire()
+                    self.waiting[lane].append(gate)
+                else:
+                    # Woken but beaten to the lock, wait at the head of the lane again
+                    self.waiting[lane].appendleft(gate)
+            # Opened by release() when it is our lane's turn
+            gate.acquire()
+
+    def release(self):
+        with self.mutex:
+            self.busy = False
+            control, bulk = self.waiting
+            if bulk and (not control or self.streak >= CONTROL_BURST):
+                if control:
+                    self.lanes.bulk_turns.inc()
+                    self.reserved = bulk[0]
+                self.streak = 0
+                gate = bulk.popleft()
+            elif control:
+                self.streak = self.streak + 1 if bulk else 0
+                self.woken += 1
+                gate = control.popleft()
+            else:
+                return
+        gate.release()
+
+    def turn(self, lane):
+        """Acquire the lock for a frame of lane, for use as with lock.turn(lane), which releases it"""
+        self.acquire(lane)
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,171 @@
+"""
+On-demand profiling of the running server.
+
+Nothing here runs until an admin asks for it, so the server pays nothing
+while profiling is off. Each kind runs at most once at a time, on its own
+thread, for at most MAX_PROFILE_SECONDS, and writes one file:
+
+    cpu     sampled stacks of every thread in collapsed format (flamegraph.pl, speedscope)
+    memory  allocations made during short tracemalloc slices and still alive, by traceback
+    stacks  current stack of every thread, threads with identical stacks grouped
+
+The CPU sampler reads sys._current_frames() instead of installing a profile
+hook, and stretches its interval so sampling stays within CPU_SAMPLE_BUDGET
+of one core however many threads there are. tracemalloc slows every
+allocation while it runs, so the memory profile traces for TRACE_SLICE at a
+time and only for TRACE_DUTY of the duration.
+"""
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from common import log
+
+log_admin = log.get_logger("admin")
+
+PROFILE_KINDS = ("cpu", "memory", "stacks")
+MAX_PROFILE_SECONDS = 60
+CPU_SAMPLE_INTERVAL = 0.01  # Seconds between stack samples when threads are few
+CPU_SAMPLE_BUDGET = 0.05  # Share of one core the sampler may use
+TRACE_FRAMES = 4  # Frames tracemalloc keeps per allocation
+TRACE_SLICE = 0.2  # Seconds tracemalloc runs at a stretch, every allocation is slower meanwhile
+TRACE_DUTY = 0.2  # Share of the profile's duration spent tracing
+TOP_ALLOCATIONS = 50  # Tracebacks listed in a memory profile
+
+class Profiler:
+    """Starts profiles on request, one of each kind at a time"""
+
+    def __init__(self, directory, metrics):
+        self.directory = directory
+        self.active = set()  # Kinds currently running
+        self.lock = threading.Lock()
+        self.runs = metrics.counter("profiles_total", "Profiles taken on admin request", label_name="kind")
+        metrics.gauge("profiles_active", "Profiles running right now", lambda: len(self.active))
+
+    def start(self, kind, seconds):
+        """Start a profile and return the file it will be written to, raise ValueError if it cannot run"""
+        if kind not in PROFILE_KINDS:
+            raise ValueError(f"Unknown profile {kind}, expected one of {', '.join(PROFILE_KINDS)}")
+        seconds = min(max(float(seconds), 0.1), MAX_PROFILE_SECONDS)
+        with self.lock:
+            if kind in self.active:
+                raise ValueError(f"A {kind} profile is already running")
+            self.active.add(kind)
+        os.makedirs(self.directory, exist_ok=True)
+        extension = "collapsed" if kind == "cpu" else "txt"
+        path = os.path.join(self.directory, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.{extension}")
+        threading.Thread(target=self.run, args=(kind, seconds, path), daemon=True, name=f"profile-{kind}").start()
+        return path
+
+    def run(self, kind, seconds, path):
+        started = time.monotonic()
+        try:
+            if kind == "cpu":
+                sample_cpu(seconds, path)
+            elif kind == "memory":
+                trace_memory(seconds, path)
+            else:
+                dump_stacks(path)
+            self.runs.inc(kind)
+            log_admin.info("Wrote %s profile to %s in %.1fs", kind, path, time.monotonic() - started)
+        except Exception as e:
+            log_admin.error("Error taking %s profile: %s", kind, e)
+        finally:
+            with self.lock:
+                self.active.discard(kind)
+
+def thread_names():
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+def thread_group(name):
+    """Name shared by threads of one kind: the target of "Thread-12 (handle_client)", else the name without its number"""
+    if name.endswith(")") and " (" in name:
+        return name[name.rindex(" (") + 2:-1]
+    return name.rstrip("-0123456789") or "thread"
+
+def sample_cpu(seconds, path):
+    """Sample every thread's stack for seconds and write the counts in collapsed stack format"""
+    counts = collections.Counter()  # {(thread name, code objects from the root): samples}
+    names = thread_names()
+    me = threading.get_ident()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if ident not in names:
+                names = thread_names()
+                names.setdefault(ident, "thread")
+            # Group threads by kind so the stacks of thousands of connection threads add up
+            counts[(thread_group(names[ident]), tuple(reversed(stack)))] += 1
+        samples += 1
+        spent = time.perf_counter() - started
+        time.sleep(max(CPU_SAMPLE_INTERVAL, spent / CPU_SAMPLE_BUDGET - spent))
+
+    labels = {}  # Dictionary to store the label of each code object, they repeat across stacks
+
+    def label(code):
+        text = labels.get(code)
+        if text is None:
+            text = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return text
+
+    with open(path, "w") as f:
+        for (name, stack), count in counts.most_common():
+            f.write(";".join([name, *map(label, stack)]) + f" {count}\n")
+    log_admin.info("CPU profile took %d samples of %d stacks", samples, len(counts))
+
+def trace_memory(seconds, path):
+    """Trace allocations in slices spread over seconds and write the largest ones alive at the end of their slice"""
+    totals = collections.defaultdict(lambda: [0, 0])  # {traceback: [bytes, blocks]}
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    already_tracing = tracemalloc.is_tracing()
+    traced = 0.0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        slice_seconds = min(TRACE_SLICE, deadline - time.monotonic())
+        if not already_tracing:
+            tracemalloc.start(TRACE_FRAMES)
+        try:
+            time.sleep(slice_seconds)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if not already_tracing:
+                tracemalloc.stop()
+        traced += slice_seconds
+        for stat in snapshot.filter_traces(ignore).statistics("traceback"):
+            total = totals[stat.traceback]
+            total[0] += stat.size
+            total[1] += stat.count
+        if already_tracing:
+            # Whoever started tracing pays for it already, one snapshot covers the whole run
+            break
+        time.sleep(min(slice_seconds / TRACE_DUTY - slice_seconds, max(0, deadline - time.monotonic())))
+    largest = sorted(totals.items(), key=lambda item: -item[1][0])[:TOP_ALLOCATIONS]
+    with open(path, "w") as f:
+        f.write(f"Traced {traced:.1f}s of {seconds:.1f}s: {sum(size for size, _ in totals.values()) / 1024:.1f} KiB "
+                f"allocated in the traced slices and still alive at their end\n\n")
+        for traceback_, (size, count) in largest:
+            f.write(f"{size / 1024:.1f} KiB in {count} blocks\n")
+            f.write("\n".join(traceback_.format()) + "\n\n")
+
+def dump_stacks(path):
+    """Write the current stack of every thread, grouping threads whose stacks are identical"""
+    names = thread_names()
+    groups = collections.defaultdict(list)  # {formatted stack: [thread names]}
+    for ident, frame in sys._current_frames().items():
+        if ident != threading.get_ident():
+            groups["".join(traceback.format_stack(frame))].append(names.get(ident, str(ident)))
+    with open(path, "w") as f:
+        for stack, threads in sorted(groups.items(), key=lambda item: -len(item[1])):
+            shown = ", ".join(threads[:5]) + (", ..." if len(threads) > 5 else "")
+            f.write(f"{len(threads)} threads: {shown}\n{stack}\n")
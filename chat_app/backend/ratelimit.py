@@ -0,0 +1,46 @@
+"""
+Token bucket rate limiting for the chat server.
+
+Every user gets a pair of buckets (frames and bytes) per command class. A
+frame that overdraws a bucket is still handled, but the connection thread
+first sleeps until the bucket is back to zero, so an abusive client is slowed
+down by TCP backpressure instead of being buffered by the server.
+"""
+import time
+
+class TokenBucket:
+    """Allowance refilled at rate units per second, holding at most burst units"""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, amount, now):
+        """Take amount units and return the seconds until the balance is positive again"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class RateLimiter:
+    """Frames per second and bytes per second buckets per command class of one user"""
+
+    def __init__(self, limits, burst_seconds):
+        # limits: {command_class: (frames_per_second, bytes_per_second)}
+        self.buckets = {
+            command_class: (TokenBucket(frame_rate, frame_rate * burst_seconds),
+                            TokenBucket(byte_rate, byte_rate * burst_seconds))
+            for command_class, (frame_rate, byte_rate) in limits.items()
+        }
+
+    def charge(self, command_class, size, now=None):
+        """Charge one frame of size bytes, return the seconds the caller should wait"""
+        buckets = self.buckets.get(command_class)
+        if buckets is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        frame_bucket, byte_bucket = buckets
+        return max(frame_bucket.take(1, now), byte_bucket.take(size, now))
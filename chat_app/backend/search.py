@@ -0,0 +1,319 @@
+"""
+Incremental full-text index of relayed messages.
+
+Relay threads only queue a message, a background indexer thread tokenizes it
+into an in-memory segment. Every SEGMENT_DOCS messages that segment is
+sealed into an immutable, compressed one:
+
+    postings       {token: delta-encoded document IDs, zlib-compressed when long}
+    conversations  conversation ID of each document, for permission filtering
+    blocks         the documents themselves, zlib-compressed DOC_BLOCK at a time
+
+A merger thread combines MERGE_FACTOR adjacent segments of the same level
+into one of the next level, so a query visits a logarithmic number of
+segments. Document IDs grow with time and segments cover contiguous ID
+ranges, so queries walk the segments newest first and stop at the limit.
+"""
+import itertools
+import json
+import queue
+import re
+import threading
+import time
+import zlib
+from array import array
+from common import log
+
+log_search = log.get_logger("search")
+
+SEGMENT_DOCS = 4096  # Documents per sealed segment, a multiple of DOC_BLOCK
+DOC_BLOCK = 64  # Documents compressed together
+MERGE_FACTOR = 4  # Segments of one level merged into one of the next
+COMPRESS_MIN = 16  # Shorter postings lists are stored uncompressed
+INDEX_BATCH = 512  # Messages taken from the queue at once
+YIELD_EVERY = 32  # Messages, tokens or blocks handled between two GIL releases of a background thread
+MAX_TOKEN_LENGTH = 64
+BROADCAST_KEY = "broadcast"
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text):
+    """Return the distinct lowercase words of a text"""
+    return {token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) <= MAX_TOKEN_LENGTH}
+
+def yielding(items, every=YIELD_EVERY):
+    """Iterate items, letting relay threads take the GIL every few of them"""
+    for count, item in enumerate(items, 1):
+        yield item
+        if count % every == 0:
+            time.sleep(0)
+
+def dm_key(user_a, user_b):
+    """Conversation key of a DM, the same from both sides"""
+    return "|".join(sorted((user_a, user_b)))
+
+def encode_postings(doc_ids):
+    """Delta-encode sorted document IDs, compressing long lists"""
+    deltas = array("I", doc_ids[:1])
+    deltas.extend(map(int.__sub__, doc_ids[1:], doc_ids[:-1]))
+    if len(doc_ids) < COMPRESS_MIN:
+        return b"r" + deltas.tobytes()
+    return b"z" + zlib.compress(deltas.tobytes(), 1)
+
+def decode_postings(data):
+    deltas = array("I")
+    deltas.frombytes(zlib.decompress(data[1:]) if data[:1] == b"z" else data[1:])
+    return list(itertools.accumulate(deltas))
+
+class Segment:
+    """Immutable, compressed index of a contiguous range of documents"""
+    __slots__ = ("first", "count", "level", "postings", "conversations", "blocks")
+
+    def __init__(self, first, count, level, postings, conversations, blocks):
+        self.first = first
+        self.count = count
+        self.level = level
+        self.postings = postings
+        self.conversations = conversations
+        self.blocks = blocks
+
+    @classmethod
+    def seal(cls, first, postings, docs):
+        """Build a level 0 segment from the in-memory postings and documents"""
+        blocks = [zlib.compress(json.dumps(docs[i:i + DOC_BLOCK]).encode(), 1)
+                  for i in yielding(range(0, len(docs), DOC_BLOCK), 4)]
+        return cls(first, len(docs), 0,
+                   {token: encode_postings(ids) for token, ids in yielding(postings.items())},
+                   array("I", (doc[0] for doc in docs)), blocks)
+
+    @classmethod
+    def merge(cls, segments):
+        """Combine adjacent segments, oldest first, into one segment of the next level"""
+        postings = {}
+        for token in yielding(set().union(*(segment.postings for segment in segments))):
+            ids = []
+            for segment in segments:
+                data = segment.postings.get(token)
+                if data is not None:
+                    ids.extend(decode_postings(data))
+            postings[token] = encode_postings(ids)
+        conversations = array("I")
+        blocks = []
+        for segment in segments:
+            conversations.extend(segment.conversations)
+            blocks.extend(segment.blocks)
+        return cls(segments[0].first, sum(segment.count for segment in segments),
+                   segments[0].level + 1, postings, conversations, blocks)
+
+    def document(self, doc_id):
+        # Blocks are never cached, a query decompresses at most one per result
+        offset = doc_id - self.first
+        return json.loads(zlib.decompress(self.blocks[offset // DOC_BLOCK]))[offset % DOC_BLOCK]
+
+    def size(self):
+        """Return the bytes held by postings, conversation IDs and documents"""
+        return (sum(len(data) for data in self.postings.values()) + len(self.conversations) * 4
+                + sum(len(block) for block in self.blocks))
+
+class SearchIndex:
+    """Inverted index of DMs, broadcasts and room messages, filtered per user at query time"""
+
+    def __init__(self, metrics):
+        self.incoming = queue.SimpleQueue()  # Messages relayed but not indexed yet
+        self.queued = 0  # Messages ever queued, the ID the next one will be indexed under
+        self.queue_lock = threading.Lock()  # Keeps queue order and self.queued in step
+        self.lock = threading.Lock()
+        self.conversation_ids = {}  # Dictionary to store the ID of each conversation key: {key: id}
+        self.conversation_keys = []  # Conversation key of each ID
+        self.user_dms = {}  # Dictionary to store the DM conversation IDs of each user: {username: set(ids)}
+        self.segments = []  # Sealed segments, oldest first
+        self.postings = {}  # Dictionary to store the postings of the open segment: {token: [doc ids]}
+        self.docs = []  # Documents of the open segment: [conversation id, sender, text, time]
+        self.first = 0  # ID of the first document of the open segment
+        self.merge_needed = threading.Event()
+        self.running = False
+        self.indexed = metrics.counter("search_indexed_total", "Messages added to the search index")
+        self.index_batch_time = metrics.histogram("search_index_batch_seconds", "Time spent indexing one batch")
+        self.merge_time = metrics.histogram("search_merge_seconds", "Time spent merging index segments")
+        self.query_time = metrics.histogram("search_query_seconds", "Time spent answering one SEARCH")
+        metrics.gauge("search_backlog", "Messages waiting to be indexed", self.incoming.qsize)
+        metrics.gauge("search_documents", "Messages in the search index", lambda: self.first + len(self.docs))
+        metrics.gauge("search_segments", "Sealed segments of the search index", lambda: len(self.segments))
+        metrics.gauge("search_bytes", "Compressed size of the sealed segments",
+                      lambda: sum(segment.size() for segment in list(self.segments)))
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            threading.Thread(target=self.index_forever, daemon=True, name="search-indexer").start()
+            threading.Thread(target=self.merge_forever, daemon=True, name="search-merger").start()
+
+    def add(self, conversation, sender, text, participants=()):
+        """Queue a message for indexing, cheap enough to call on the relay path"""
+        with self.queue_lock:
+            self.incoming.put((conversation, sender, text, participants, int(time.time())))
+            self.queued += 1
+
+    def watermark(self):
+        """ID of the next message to be queued, recorded when a user joins a room"""
+        with self.queue_lock:
+            return self.queued
+
+    def index_forever(self):
+        while True:
+            batch = [self.incoming.get()]
+            while len(batch) < INDEX_BATCH:
+                try:
+                    batch.append(self.incoming.get_nowait())
+                except queue.Empty:
+                    break
+            started = time.perf_counter()
+            try:
+                self.index_batch(batch)
+            except Exception as e:
+                log_search.error("Error indexing %d messages: %s", len(batch), e)
+                continue
+            self.indexed.inc(amount=len(batch))
+            self.index_batch_time.observe(time.perf_counter() - started)
+
+    def index_batch(self, batch):
+        """Add queued messages to the open segment, sealing it whenever it is full"""
+        for start in range(0, len(batch), YIELD_EVERY):
+            if start:
+                time.sleep(0)
+            self.index_chunk(batch[start:start + YIELD_EVERY])
+
+    def index_chunk(self, chunk):
+        tokenized = [(message, tokenize(message[2])) for message in chunk]
+        with self.lock:
+            for (conversation, sender, text, participants, sent), tokens in tokenized:
+                conversation_id = self.conversation_id(conversation, participants)
+                doc_id = self.first + len(self.docs)
+                self.docs.append([conversation_id, sender, text, sent])
+                for token in tokens:
+                    self.postings.setdefault(token, []).append(doc_id)
+                if len(self.docs) == SEGMENT_DOCS:
+                    # Queries wait for the seal rather than see a gap, it yields the GIL to the relay
+                    self.segments.append(Segment.seal(self.first, self.postings, self.docs))
+                    self.first += len(self.docs)
+                    self.postings = {}
+                    self.docs = []
+                    self.merge_needed.set()
+
+    def conversation_id(self, conversation, participants):
+        conversation_id = self.conversation_ids.get(conversation)
+        if conversation_id is None:
+            conversation_id = self.conversation_ids[conversation] = len(self.conversation_keys)
+            self.conversation_keys.append(conversation)
+            for username in participants:
+                self.user_dms.setdefault(username, set()).add(conversation_id)
+        return conversation_id
+
+    def merge_forever(self):
+        while True:
+            self.merge_needed.wait()
+            self.merge_needed.clear()
+            while self.merge_once():
+                pass
+
+    def merge_once(self):
+        """Merge the first run of MERGE_FACTOR segments of one level, return False if there is none"""
+        with self.lock:
+            run = merge_candidates(self.segments)
+        if not run:
+            return False
+
+        # Segments are immutable, the merge runs without the lock and only the swap takes it
+        started = time.perf_counter()
+        merged = Segment.merge(run)
+        with self.lock:
+            # The indexer only ever appends, so the run is still in place
+            position = self.segments.index(run[0])
+            self.segments[position:position + MERGE_FACTOR] = [merged]
+        elapsed = time.perf_counter() - started
+        self.merge_time.observe(elapsed)
+        log_search.debug("Merged %d segments into one of %d documents in %.3fs", MERGE_FACTOR, merged.count, elapsed)
+        return True
+
+    def allowed_conversations(self, username, rooms):
+        """
+        Conversations a user may search, mapped to the first document ID they may see:
+        broadcasts and their DMs in full, their rooms from the watermark taken when they joined
+        """
+        with self.lock:
+            allowed = dict.fromkeys(self.user_dms.get(username, ()), 0)
+            for key, first in [(BROADCAST_KEY, 0), *(("#" + room, first) for room, first in rooms.items())]:
+                conversation_id = self.conversation_ids.get(key)
+                if conversation_id is not None:
+                    allowed[conversation_id] = first
+        return allowed
+
+    def search(self, query, username, rooms=None, limit=20):
+        """
+        Return up to limit messages containing every word of query, newest first,
+        as dicts with conversation (from the user's point of view), sender, text and time.
+        rooms maps each room of the user to the watermark() taken when they joined it,
+        messages posted there before they joined are left out
+        """
+        started = time.perf_counter()
+        tokens = tokenize(query)
+        allowed = self.allowed_conversations(username, rooms or {})
+        if not tokens or not allowed:
+            return []
+
+        with self.lock:
+            segments = list(self.segments)
+            # Copy only what the query needs from the open segment, the indexer keeps appending
+            open_postings = [list(self.postings.get(token, ())) for token in tokens]
+            open_first = self.first
+            open_docs = self.docs[:]
+
+        results = []
+        for doc_id in reversed(intersect(open_postings)):
+            conversation_id, sender, text, sent = open_docs[doc_id - open_first]
+            if doc_id >= allowed.get(conversation_id, float("inf")):
+                results.append(self.result(conversation_id, sender, text, sent, username))
+                if len(results) == limit:
+                    break
+
+        for segment in reversed(segments):
+            if len(results) == limit:
+                break
+            encoded = [segment.postings.get(token) for token in tokens]
+            if None in encoded:
+                continue
+            for doc_id in reversed(intersect([decode_postings(data) for data in sorted(encoded, key=len)])):
+                if doc_id >= allowed.get(segment.conversations[doc_id - segment.first], float("inf")):
+                    conversation_id, sender, text, sent = segment.document(doc_id)
+                    results.append(self.result(conversation_id, sender, text, sent, username))
+                    if len(results) == limit:
+                        break
+
+        self.query_time.observe(time.perf_counter() - started)
+        return results
+
+    def result(self, conversation_id, sender, text, sent, username):
+        key = self.conversation_keys[conversation_id]
+        if key != BROADCAST_KEY and not key.startswith("#"):
+            # A DM is shown under the name of the other user
+            user_a, user_b = key.split("|")
+            key = user_b if user_a == username else user_a
+        return {"conversation": key, "sender": sender, "text": text, "time": sent}
+
+def merge_candidates(segments):
+    """Return the first MERGE_FACTOR adjacent segments of one level, an empty list if there are none"""
+    for start in range(len(segments) - MERGE_FACTOR + 1):
+        run = segments[start:start + MERGE_FACTOR]
+        if all(segment.level == run[0].level for segment in run):
+            return run
+    return []
+
+def intersect(postings):
+    """Sorted document IDs present in every list, starting from the shortest"""
+    if not postings:
+        return []
+    postings = sorted(postings, key=len)
+    if len(postings) == 1:
+        return postings[0]
+    others = [set(ids) for ids in postings[1:]]
+    return [doc_id for doc_id in postings[0] if all(doc_id in ids for ids in others)]
@@ -0,0 +1,59 @@
+"""
+Hashed timer wheel for per-connection timeouts.
+
+Each key sits in the slot of the tick its deadline falls in. Advancing the
+wheel only visits the slots of elapsed ticks, so expiring timers costs
+O(expired) no matter how many connections are being tracked. Rescheduling a
+key within the same tick is free, so callers can reschedule on every read.
+"""
+import math
+import threading
+import time
+
+class TimerWheel:
+    """Keys scheduled by deadline, with a resolution of one tick"""
+
+    def __init__(self, tick, span):
+        # Deadlines further than span ahead are clamped and fire early, callers re-check on expiry
+        self.tick = tick
+        self.slots = [set() for _ in range(math.ceil(span / tick) + 2)]
+        self.ticks = {}  # Dictionary to store the tick each key fires on: {key: tick}
+        self.current = int(time.monotonic() / tick)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def schedule(self, key, deadline):
+        """Fire key at deadline (a time.monotonic() value), replacing its previous deadline"""
+        with self.lock:
+            tick = min(max(math.ceil(deadline / self.tick), self.current + 1), self.current + len(self.slots) - 1)
+            previous = self.ticks.get(key)
+            if previous == tick:
+                return
+            if previous is not None:
+                self.slots[previous % len(self.slots)].discard(key)
+            self.ticks[key] = tick
+            self.slots[tick % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        with self.lock:
+            tick = self.ticks.pop(key, None)
+            if tick is not None:
+                self.slots[tick % len(self.slots)].discard(key)
+
+    def advance(self, now):
+        """Move the wheel up to now and return the keys whose deadline passed"""
+        target = int(now / self.tick)
+        expired = []
+        with self.lock:
+            # Never spin more than one turn, every slot is visited once per turn anyway
+            self.current = max(self.current, target - len(self.slots))
+            while self.current < target:
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                for key in slot:
+                    del self.ticks[key]
+                expired.extend(slot)
+                slot.clear()
+        return expired
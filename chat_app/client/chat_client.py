@@ -0,0 +1,725 @@
+"""
+Chat client library, usable without Streamlit.
+
+ChatClient runs on plain threads and AsyncChatClient on asyncio. Both own
+the server connection, the P2P links, the inbox and the message history,
+and report what happens as ChatEvent objects, either to callbacks or, for
+the asyncio client, through an async iterator. The Streamlit GUI is one
+consumer of ChatClient, bots and load tools are others.
+"""
+import asyncio
+import hashlib
+import logging
+import queue
+import random
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+from common.protocol import encode_frame, FrameReader, FRAME_DELIMITER
+from common.metrics import MetricsRegistry
+from common import log
+from .core import ChatEvent, ChatSession, BROADCAST_CONVERSATION, ROOM_PREFIX, LOCAL, coalesce_inbox, route_usernames
+from .p2p_manager import P2PManager
+from .signals import SignalCoalescer
+
+log_net = log.get_logger("net")
+log_inbox = log.get_logger("inbox")
+log_relay = log.get_logger("relay")
+log_p2p = log.get_logger("p2p")
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 5000
+STREAM_LIMIT = 16 * 1024 * 1024  # Longest frame the asyncio client accepts
+STREAM_READ_SIZE = 64 * 1024
+INBOX_LIMIT = 10000  # Frames waiting in the inbox before it is coalesced in place, then the oldest are dropped
+INBOX_BATCH = 500  # Frames applied per store commit
+CONNECT_ATTEMPTS = 5  # Tries before giving up on a busy server
+BACKOFF_BASE = 0.2  # Seconds before the first retry when the server gave no hint
+BACKOFF_MAX = 10.0
+
+# Client metrics, shared by every client of the process
+metrics = MetricsRegistry("chat_client_")
+inbox_batch_seconds = metrics.histogram("inbox_batch_seconds", "Time spent applying one inbox batch")
+inbox_frames = metrics.counter("inbox_frames_total", "Inbox items applied")
+inbox_coalesced = metrics.counter("inbox_coalesced_total", "Inbox items dropped as superseded")
+inbox_dropped = metrics.counter("inbox_dropped_total", "Inbox items dropped because nobody applied the inbox")
+signals_sent = metrics.counter("signals_total", "Typing and read signals by path: p2p, server or coalesced")
+
+def hash_password(password):
+    return hashlib.sha256(password.encode()).hexdigest()
+
+def backoff_delay(attempt, base=BACKOFF_BASE):
+    """Exponential backoff with jitter, so turned away clients do not come back together"""
+    return min(BACKOFF_MAX, base * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+def busy_retry_after(response):
+    """Seconds a BUSY|retry_ms reply asks us to wait"""
+    try:
+        return int(response.split('|')[1]) / 1000
+    except (IndexError, ValueError):
+        return BACKOFF_BASE
+
+# Errors of a server that closed on us before replying, as it does to TLS clients under overload
+RETRYABLE_ERRORS = (ConnectionResetError, ssl.SSLEOFError)
+
+class BaseChatClient:
+    """Protocol handling shared by the threaded and the asyncio client"""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, on_event=None, tls=None, p2p_tls=None):
+        self.host = host
+        self.port = port
+        self.tls = tls  # common.tls.ClientTLS for the server connection, None for plain TCP
+        self.p2p_tls = p2p_tls  # (server context, ClientTLS) for P2P links, from common.tls.p2p_tls_from_env()
+        self.session = None
+        self.p2p = None
+        self.handlers = [on_event] if on_event else []
+        self.signals = SignalCoalescer(self.send_signal, lambda: signals_sent.inc("coalesced"))
+
+    @property
+    def username(self):
+        return self.session.username if self.session else ""
+
+    @property
+    def store(self):
+        return self.session.store if self.session else None
+
+    @property
+    def history(self):
+        """Copy of every conversation, use store.snapshot() to read a single one"""
+        return self.session.store.history() if self.session else {}
+
+    @property
+    def online_users(self):
+        return self.session.online_users if self.session else ()
+
+    def add_handler(self, handler):
+        """Call handler(event) for every event from now on"""
+        self.handlers.append(handler)
+
+    def emit(self, event):
+        for handler in self.handlers:
+            try:
+                handler(event)
+            except Exception as e:
+                log_inbox.error("Event handler failed on %s event: %s", event.kind, e)
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def send_server(self, *fields):
+        """Send one frame to the server, raising if we are not connected"""
+        self.write(encode_frame(*fields))
+
+    def answer_heartbeats(self, frames):
+        """Answer server PINGs as soon as they are read, return the other frames"""
+        if not any(frame.startswith("PING|") for frame in frames):
+            return frames
+        rest = []
+        for frame in frames:
+            if frame.startswith("PING|"):
+                # Answered on the receiving side so a slow GUI never makes us look dead
+                self.send_control("PONG", frame[5:])
+            else:
+                rest.append(frame)
+        return rest
+
+    def relay_gossip(self, frames, peer=None):
+        """
+        Forward overlay broadcasts to our subtrees as soon as they are read and
+        acknowledge them to the server, return the frames to apply
+        """
+        if not any(frame.startswith("GOSSIP|") for frame in frames):
+            return frames
+        rest = []
+        acked = []
+        for frame in frames:
+            if frame.startswith("GOSSIP|"):
+                # Forwarded on the receiving side so our subtrees never wait for the inbox to drain
+                try:
+                    admitted = self.session.admit_gossip(frame[7:], peer)
+                except (ValueError, TypeError) as e:
+                    log_p2p.warning("Dropping broadcast from %s: %s", peer or "server", e)
+                    continue
+                if admitted is None:
+                    continue
+                msg_id, sender, children, message = admitted
+                if children:
+                    self.forward_gossip(msg_id, sender, children, message)
+                acked.append(msg_id)
+            rest.append(frame)
+        if acked:
+            # The server patches whoever has not acknowledged a broadcast in time
+            self.send_control("GOSSIP_ACK", ",".join(acked))
+        return rest
+
+    def apply_batch(self, items):
+        """
+        Apply a batch of inbox items, (peer, frame) with peer None for the server or
+        (LOCAL, event), in one store commit and return the events it produced
+        """
+        started = time.perf_counter()
+        items, coalesced = coalesce_inbox(items)
+
+        events = []
+        with self.session.store.batch():
+            for source, payload in items:
+                if source is LOCAL:
+                    events.append(payload)
+                    continue
+                try:
+                    events.extend(self.session.handle_frame(payload, source))
+                except Exception as e:
+                    log_inbox.error("Error processing %s frame: %s", payload.split('|', 1)[0], e)
+
+        # Side effects and callbacks run after the commit so they never hold the store lock
+        published = self.publish(events)
+
+        inbox_batch_seconds.observe(time.perf_counter() - started)
+        inbox_frames.inc(amount=len(items))
+        if coalesced:
+            inbox_coalesced.inc(amount=coalesced)
+            log_inbox.debug("Coalesced %d superseded inbox items", coalesced)
+        return published
+
+    def publish(self, events):
+        """Run the side effects of events and hand them to the handlers"""
+        published = []
+        for event in events:
+            if event.kind == "p2p_info":
+                self.handle_p2p_info(event)
+            elif event.kind == "error":
+                log_inbox.warning("Error from server: %s", event.text)
+            elif event.kind == "message" and log_inbox.isEnabledFor(logging.DEBUG):
+                log_inbox.debug("Message in %s from %s: %s", event.conversation, event.sender, log.body(event.text))
+            self.emit(event)
+            published.append(event)
+        return published
+
+    def forward_gossip(self, msg_id, sender, children, message):
+        if self.p2p is not None:
+            self.p2p.forward_gossip(msg_id, sender, children, message)
+            return
+        # Without P2P links the server has to deliver to our whole subtree
+        missed = [name for child in children for name in route_usernames(child)]
+        try:
+            self.send_server("GOSSIP_PATCH", msg_id, ",".join(missed))
+        except Exception as e:
+            log_p2p.warning("Error requesting broadcast patch: %s", e)
+
+    def handle_p2p_info(self, event):
+        """Dial a peer the server told us about"""
+        target_ip, target_port, auto = event.data
+        log_p2p.info("Received P2P connection info for %s: %s:%s", event.sender, target_ip, target_port)
+
+        # Server-initiated upgrade of a busy conversation, only one side dials so both
+        # ends agree on a single link; relay stays in use until then
+        if auto and self.username > event.sender:
+            log_p2p.info("Waiting for %s to dial the automatic P2P link", event.sender)
+            return
+        self.connect_peer(event.sender, target_ip, target_port)
+
+    def connect_peer(self, target_username, target_ip, target_port):
+        raise NotImplementedError
+
+    def start_p2p(self):
+        """Start accepting P2P links, safe to call more than once"""
+        if self.p2p is None:
+            self.p2p = P2PManager(self.username, self.send_server, self.deliver_peer_frame, self.on_peer_link,
+                                  tls=self.p2p_tls)
+        return self.p2p.start()
+
+    def deliver_peer_frame(self, peer, frame):
+        raise NotImplementedError
+
+    def on_peer_link(self, peer, up):
+        raise NotImplementedError
+
+    def has_p2p(self, username):
+        return self.p2p is not None and self.p2p.is_connected(username)
+
+    def p2p_peers(self):
+        return self.p2p.peers() if self.p2p is not None else []
+
+    def send_direct(self, recipient, message):
+        """Send a DM over P2P when linked, through the server otherwise"""
+        if recipient == BROADCAST_CONVERSATION:
+            return self.send_broadcast(message)
+        if recipient.startswith(ROOM_PREFIX):
+            return self.send_room(recipient[len(ROOM_PREFIX):], message)
+        try:
+            if self.has_p2p(recipient) and self.p2p.send_message(recipient, message):
+                if log_p2p.isEnabledFor(logging.DEBUG):
+                    log_p2p.debug("P2P message sent to %s: %s", recipient, log.body(message))
+                self.session.add_message(recipient, self.username, message)
+                return True, "Message sent via P2P"
+
+            self.send_server("DIRECT", recipient, message)
+            if log_relay.isEnabledFor(logging.DEBUG):
+                log_relay.debug("Relay message sent to %s: %s", recipient, log.body(message))
+            self.session.add_message(recipient, self.username, message)
+            return True, "Message sent"
+        except Exception as e:
+            log_relay.error("Error sending message: %s", e)
+            return False, f"Failed to send message: {e}"
+
+    def send_broadcast(self, message):
+        """Send a message to every online user"""
+        try:
+            self.send_server("BROADCAST", message)
+            self.session.add_message(BROADCAST_CONVERSATION, self.username, message)
+            return True, "Message sent"
+        except Exception as e:
+            log_relay.error("Error sending broadcast: %s", e)
+            return False, f"Failed to send message: {e}"
+
+    def send_room(self, room, message):
+        """Send a message to the members of a room we joined"""
+        try:
+            self.send_server("ROOM_MSG", room, message)
+            self.session.add_message(ROOM_PREFIX + room, self.username, message)
+            return True, "Message sent"
+        except Exception as e:
+            log_relay.error("Error sending to room %s: %s", room, e)
+            return False, f"Failed to send message: {e}"
+
+    def send_typing(self, conversation, typing=True):
+        """Tell the other side of a DM or room that we are typing, coalesced per conversation"""
+        self.signals.offer(conversation, "TYPING", 1 if typing else 0)
+
+    def mark_read(self, conversation):
+        """Send a read receipt for a DM or room, coalesced per conversation"""
+        self.signals.offer(conversation, "READ", int(time.time() * 1000))
+
+    def send_signal(self, conversation, kind, value):
+        """Send one signal, directly over P2P when linked; broadcasts carry no signals"""
+        if conversation == BROADCAST_CONVERSATION:
+            return False
+        if not conversation.startswith(ROOM_PREFIX) and self.has_p2p(conversation) \
+                and self.p2p.send(conversation, "SIGNAL", kind, value):
+            signals_sent.inc("p2p")
+            return True
+        signals_sent.inc("server")
+        return self.send_control("SIGNAL", conversation, kind, value)
+
+    def join_room(self, room):
+        """Join or create a room, its member list arrives as a room event"""
+        return self.send_control("JOIN", room)
+
+    def leave_room(self, room):
+        return self.send_control("LEAVE", room)
+
+    def send_control(self, *fields):
+        """Send a control frame, returning False instead of raising on failure"""
+        try:
+            self.send_server(*fields)
+            return True
+        except Exception as e:
+            log_net.warning("Error sending %s: %s", fields[0], e)
+            return False
+
+    def request_p2p(self, username):
+        """Ask another user for a P2P link"""
+        return self.send_control("P2P_REQUEST", username)
+
+    def accept_p2p(self, requester):
+        """Accept a P2P request, the server then tells the requester how to reach us"""
+        self.start_p2p()
+        if not self.send_control("P2P_ACCEPT", requester):
+            return False
+        self.session.remove_pending_request(requester)
+        return True
+
+    def reject_p2p(self, requester):
+        """Reject a P2P request"""
+        if not self.send_control("P2P_REJECT", requester):
+            return False
+        self.session.remove_pending_request(requester)
+        return True
+
+    def who(self, prefix="", cursor="", limit=None):
+        """Ask for a page of online users whose names start with prefix, it arrives as a who event"""
+        return self.send_control("WHO", prefix.replace("|", "").strip(), cursor, *([limit] if limit else []))
+
+    def search(self, query, limit=None):
+        """Search the history the server relayed for us, results arrive as a search event"""
+        query = query.replace("|", " ").strip()
+        if not query:
+            return False
+        return self.send_control("SEARCH", query, *([limit] if limit else []))
+
+    def request_stats(self):
+        """Ask the server for a STATS snapshot, only answered for admin users"""
+        return self.send_control("STATS")
+
+    def request_profile(self, kind, seconds):
+        """Ask the server to profile itself (cpu, memory or stacks), only answered for admin users"""
+        return self.send_control("PROFILE", kind, seconds)
+
+    def stop_p2p(self):
+        if self.p2p is not None:
+            self.p2p.stop()
+            self.p2p = None
+
+class ChatClient(BaseChatClient):
+    """
+    Threaded chat client. A receiver thread fills the inbox, which is applied either
+    by the caller through process_inbox() or by a dispatcher thread when
+    background_dispatch is set.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, on_event=None, background_dispatch=False,
+                 tls=None, p2p_tls=None):
+        super().__init__(host, port, on_event, tls, p2p_tls)
+        self.background_dispatch = background_dispatch
+        self.sock = None
+        self.send_lock = threading.Lock()
+        # Bounded, so a slow consumer pushes back on the server instead of growing memory
+        self.inbox = queue.Queue()  # Kept near INBOX_LIMIT by enqueue(), the receiver never blocks on it
+        self.shedding = False  # Dropping frames from a full inbox nobody has applied since
+        # Link changes come from threads the consumer may be waiting on, they never block
+        self.local_events = deque()
+        self.connected = False
+
+    def write(self, data):
+        sock = self.sock
+        if sock is None:
+            raise ConnectionError("Not connected to server")
+        with self.send_lock:
+            sock.sendall(data)
+
+    def authenticate(self, command, username, password):
+        """Send LOGIN or REGISTER, backing off while the server is busy, returning (socket, reader, response)"""
+        for attempt in range(CONNECT_ATTEMPTS):
+            try:
+                sock, reader, response = self.connect_once(command, username, password)
+            except RETRYABLE_ERRORS as e:
+                log_net.info("Server closed the connection, retrying: %s", e)
+                time.sleep(backoff_delay(attempt))
+                continue
+            if not response.startswith("BUSY"):
+                return sock, reader, response
+            sock.close()
+            log_net.info("Server busy, retrying")
+            time.sleep(backoff_delay(attempt, busy_retry_after(response)))
+        raise ConnectionError("Server is busy, try again later")
+
+    def connect_once(self, command, username, password):
+        """Open one connection and send LOGIN or REGISTER, returning (socket, reader, response)"""
+        sock = socket.create_connection((self.host, self.port))
+        if self.tls:
+            sock = self.tls.wrap(sock, (self.host, self.port))
+        sock.sendall(encode_frame(command, username, hash_password(password)))
+        # Keep any frames that follow the response buffered for the receiver
+        reader = FrameReader(sock)
+        response = reader.read_frame() or ""
+        if self.tls:
+            # Tickets arrive after the handshake, once we have read something they are in
+            self.tls.remember((self.host, self.port), sock)
+        return sock, reader, response
+
+    def login(self, username, password):
+        """Log in and start receiving, returning (success, message)"""
+        if not username or not password:
+            return False, "Username and password are required"
+
+        try:
+            sock, reader, response = self.authenticate("LOGIN", username, password)
+        except Exception as e:
+            return False, f"Could not connect: {e}"
+
+        if not response.startswith("AUTH_SUCCESS"):
+            sock.close()
+            return False, "Authentication failed. Please check your username and password."
+
+        self.sock = sock
+        self.connected = True
+        self.session = ChatSession(username)
+        # The server reports the address it sees us connecting from: AUTH_SUCCESS|ip|port
+        self.session.handle_auth_success(response)
+
+        threading.Thread(target=self.receive, args=(reader,), daemon=True).start()
+        if self.background_dispatch:
+            threading.Thread(target=self.dispatch_forever, daemon=True).start()
+        return True, f"Connected as {username}"
+
+    def register(self, username, password):
+        """Register a new account, returning (success, message)"""
+        if not username or not password:
+            return False, "Username and password are required"
+
+        try:
+            sock, _, response = self.authenticate("REGISTER", username, password)
+            sock.close()
+        except Exception as e:
+            return False, f"Could not connect: {e}"
+
+        if response.startswith("SUCCESS"):
+            return True, f"User {username} registered successfully. You can now log in."
+        return False, response.split('|', 1)[-1]
+
+    def receive(self, reader):
+        """Receive frames from the server and add them to the inbox"""
+        log_net.info("Message receiver thread started")
+        try:
+            while True:
+                frames = reader.read_frames()
+                if frames is None:
+                    log_net.info("Connection closed by server")
+                    break
+                for frame in self.relay_gossip(self.answer_heartbeats(frames)):
+                    self.enqueue((None, frame))
+        except Exception as e:
+            if self.connected:
+                log_net.warning("Error receiving message: %s", e)
+        self.connected = False
+        self.local_events.append(ChatEvent("disconnected"))
+        self.inbox.put(None)  # Wake up a waiting dispatcher
+        log_net.info("Message receiver thread ended")
+
+    def deliver_peer_frame(self, peer, frame):
+        for frame in self.relay_gossip([frame], peer):
+            self.enqueue((peer, frame))
+
+    def enqueue(self, item):
+        """
+        Add a frame to the inbox without blocking the thread that read it. A full
+        inbox is coalesced in place, and if nobody applies it, as when the GUI that
+        owns the client went away, its oldest frames are dropped. Blocking would stop
+        us reading the socket and leave the server's writes to us stuck instead.
+        """
+        inbox = self.inbox
+        with inbox.mutex:
+            if len(inbox.queue) >= INBOX_LIMIT:
+                kept, coalesced = coalesce_inbox([waiting for waiting in inbox.queue if waiting is not None])
+                # Leave room for a batch so the next frames do not coalesce the whole inbox again
+                dropped = max(0, len(kept) - (INBOX_LIMIT - INBOX_BATCH))
+                inbox.queue.clear()
+                inbox.queue.extend(kept[dropped:])
+                if coalesced:
+                    inbox_coalesced.inc(amount=coalesced)
+                if dropped:
+                    inbox_dropped.inc(amount=dropped)
+                    if not self.shedding:
+                        log_inbox.warning("Inbox full and not being applied, dropping its oldest frames")
+                    self.shedding = True
+        inbox.put(item)
+
+    def on_peer_link(self, peer, up):
+        self.local_events.append(ChatEvent("p2p_connected" if up else "p2p_closed", sender=peer))
+
+    def connect_peer(self, target_username, target_ip, target_port):
+        if self.p2p is None:
+            self.start_p2p()
+        return self.p2p.connect(target_username, target_ip, target_port)
+
+    def next_batch(self, first=None):
+        """Take up to INBOX_BATCH waiting items off the inbox, local events first"""
+        self.shedding = False
+        batch = []
+        while self.local_events:
+            batch.append((LOCAL, self.local_events.popleft()))
+        if first is not None:
+            batch.append(first)
+        while len(batch) < INBOX_BATCH:
+            try:
+                item = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+        return batch
+
+    def process_inbox(self):
+        """Apply every frame received so far, one batch at a time, and return the resulting events"""
+        events = []
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                return events
+            events.extend(self.apply_batch(batch))
+
+    def dispatch_forever(self):
+        """Apply inbox batches as they arrive until the connection closes"""
+        while True:
+            batch = self.next_batch(self.inbox.get())
+            events = self.apply_batch(batch)
+            if any(event.kind == "disconnected" for event in events):
+                return
+
+    def close(self):
+        """Close the P2P links and the server connection"""
+        self.connected = False
+        self.stop_p2p()
+        if self.sock:
+            try:
+                # shutdown() wakes the receiver thread, close() alone would leave it blocked
+                self.sock.shutdown(socket.SHUT_RDWR)
+                self.sock.close()
+            except Exception:
+                pass
+        self.sock = None
+
+class AsyncChatClient(BaseChatClient):
+    """
+    asyncio chat client. Server frames are applied on the event loop as they
+    arrive, events go to callbacks and to events(). P2P links still use the
+    threaded P2PManager, whose frames are handed back to the event loop.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, on_event=None, tls=None, p2p_tls=None):
+        # asyncio cannot offer a cached session, the server connection always does a full handshake
+        super().__init__(host, port, on_event, tls, p2p_tls)
+        self.reader = None
+        self.writer = None
+        self.loop = None
+        self.receiver = None
+        self.event_queue = None
+
+    def write(self, data):
+        if self.writer is None or self.writer.is_closing():
+            raise ConnectionError("Not connected to server")
+        self.writer.write(data)
+
+    async def drain(self):
+        """Wait until buffered outgoing frames have been handed to the socket"""
+        await self.writer.drain()
+
+    def emit(self, event):
+        super().emit(event)
+        if self.event_queue is not None:
+            self.event_queue.put_nowait(event)
+
+    async def authenticate(self, command, username, password):
+        """Send LOGIN or REGISTER, backing off while the server is busy, returning (reader, writer, response)"""
+        for attempt in range(CONNECT_ATTEMPTS):
+            try:
+                reader, writer, response = await self.connect_once(command, username, password)
+            except RETRYABLE_ERRORS as e:
+                log_net.info("Server closed the connection, retrying: %s", e)
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            if not response.startswith("BUSY"):
+                return reader, writer, response
+            writer.close()
+            log_net.info("Server busy, retrying")
+            await asyncio.sleep(backoff_delay(attempt, busy_retry_after(response)))
+        raise ConnectionError("Server is busy, try again later")
+
+    async def connect_once(self, command, username, password):
+        """Open one connection and send LOGIN or REGISTER, returning (reader, writer, response)"""
+        reader, writer = await asyncio.open_connection(self.host, self.port, limit=STREAM_LIMIT,
+                                                       ssl=self.tls.context if self.tls else None)
+        writer.write(encode_frame(command, username, hash_password(password)))
+        response = (await reader.readline()).decode().rstrip("\n")
+        return reader, writer, response
+
+    async def login(self, username, password):
+        """Log in and start receiving, returning (success, message)"""
+        if not username or not password:
+            return False, "Username and password are required"
+
+        try:
+            reader, writer, response = await self.authenticate("LOGIN", username, password)
+        except Exception as e:
+            return False, f"Could not connect: {e}"
+
+        if not response.startswith("AUTH_SUCCESS"):
+            writer.close()
+            return False, "Authentication failed. Please check your username and password."
+
+        self.reader, self.writer = reader, writer
+        self.loop = asyncio.get_running_loop()
+        self.session = ChatSession(username)
+        self.session.handle_auth_success(response)
+        self.receiver = asyncio.create_task(self.receive())
+        return True, f"Connected as {username}"
+
+    async def register(self, username, password):
+        """Register a new account, returning (success, message)"""
+        if not username or not password:
+            return False, "Username and password are required"
+
+        try:
+            _, writer, response = await self.authenticate("REGISTER", username, password)
+            writer.close()
+        except Exception as e:
+            return False, f"Could not connect: {e}"
+
+        if response.startswith("SUCCESS"):
+            return True, f"User {username} registered successfully. You can now log in."
+        return False, response.split('|', 1)[-1]
+
+    async def receive(self):
+        """Apply the frames of every read from the server as one batch"""
+        buffer = b""
+        try:
+            while True:
+                data = await self.reader.read(STREAM_READ_SIZE)
+                if not data:
+                    log_net.info("Connection closed by server")
+                    break
+                buffer += data
+                if FRAME_DELIMITER not in data:
+                    if len(buffer) > STREAM_LIMIT:
+                        log_net.warning("Frame longer than %d bytes, closing", STREAM_LIMIT)
+                        break
+                    continue
+                *frames, buffer = buffer.split(FRAME_DELIMITER)
+                frames = self.relay_gossip(self.answer_heartbeats([frame.decode() for frame in frames]))
+                self.apply_batch([(None, frame) for frame in frames])
+        except ConnectionError as e:
+            log_net.warning("Error receiving message: %s", e)
+        finally:
+            self.apply_batch([(LOCAL, ChatEvent("disconnected"))])
+
+    async def events(self):
+        """Iterate over events until the connection closes"""
+        if self.event_queue is None:
+            self.event_queue = asyncio.Queue()
+        while True:
+            event = await self.event_queue.get()
+            yield event
+            if event.kind == "disconnected":
+                return
+
+    def deliver_peer_frame(self, peer, frame):
+        # Runs on the P2P thread that read the frame, broadcasts are forwarded from there
+        for frame in self.relay_gossip([frame], peer):
+            self.loop.call_soon_threadsafe(self.apply_batch, [(peer, frame)])
+
+    def on_peer_link(self, peer, up):
+        event = ChatEvent("p2p_connected" if up else "p2p_closed", sender=peer)
+        self.loop.call_soon_threadsafe(self.apply_batch, [(LOCAL, event)])
+
+    def send_server(self, *fields):
+        # P2PManager threads report to the server too, writes must happen on the loop
+        if self.loop is not None and not self.loop_is_current():
+            self.loop.call_soon_threadsafe(self.send_control, *fields)
+            return
+        super().send_server(*fields)
+
+    def loop_is_current(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def connect_peer(self, target_username, target_ip, target_port):
+        # Dialing blocks for up to the connect timeout, keep it off the event loop
+        if self.p2p is None:
+            self.start_p2p()
+        return self.loop.run_in_executor(None, self.p2p.connect, target_username, target_ip, target_port)
+
+    async def close(self):
+        """Close the P2P links and the server connection"""
+        self.stop_p2p()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+        if self.receiver is not None:
+            await asyncio.gather(self.receiver, return_exceptions=True)
@@ -0,0 +1,282 @@
+"""
+Protocol state of a chat client, independent of sockets, threads and the GUI.
+
+ChatSession turns frames received from the server or from P2P peers into
+state updates and ChatEvent objects. The client classes in chat_client.py
+own the I/O and feed every frame through a single ChatSession.
+"""
+import hashlib
+import hmac
+import json
+import threading
+import time
+from collections import deque, namedtuple
+from common.protocol import gossip_tag
+from .store import ClientStore
+
+BROADCAST_CONVERSATION = "broadcast"
+ROOM_PREFIX = "#"  # Room conversations are named "#room"
+MAX_SEEN_IDS = 10000  # Overlay broadcast IDs remembered for deduplication
+SIGNAL_KINDS = ("TYPING", "READ")  # TYPING carries 1 or 0, READ the epoch milliseconds of the read
+TYPING_TTL = 6  # Seconds a typing indicator is shown without a refresh
+
+# kind is one of: message, users, room, p2p_request, p2p_rejected, p2p_info, p2p_connected,
+# p2p_closed, signal, search, stats, error, disconnected
+ChatEvent = namedtuple("ChatEvent", ["kind", "conversation", "sender", "text", "data"], defaults=(None, None, None, None))
+
+# Source of inbox items that are local events rather than frames
+LOCAL = object()
+
+# Server frames that replace the state set by earlier frames of the same kind
+SUPERSEDED_FRAMES = {"USERS", "ONLINE", "STATS"}
+
+def coalesce_inbox(items):
+    """
+    Drop inbox items superseded by a later item of the same batch: all but the
+    last presence list, online count and stats snapshot, repeated rejections from one user,
+    and all but the latest signal of one kind per sender and conversation.
+    Return the remaining items in order and the number dropped.
+    """
+    kept = []
+    seen = set()
+    for source, payload in reversed(items):
+        if source is not LOCAL:
+            msg_type, _, rest = payload.partition('|')
+            if msg_type == "SIGNAL":
+                key = (source, rest.rpartition('|')[0])
+            elif source is not None:
+                key = None
+            else:
+                key = msg_type if msg_type in SUPERSEDED_FRAMES else (msg_type, rest) if msg_type == "P2P_REJECTED" else None
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+        kept.append((source, payload))
+    kept.reverse()
+    return kept, len(items) - len(kept)
+
+def compact_id(msg_id):
+    """Overlay broadcast IDs are hex UUIDs, keep them as 16 bytes rather than a 32 character string"""
+    try:
+        return bytes.fromhex(msg_id)
+    except ValueError:
+        return msg_id
+
+def route_usernames(route):
+    """List every username contained in an overlay broadcast route"""
+    usernames = [route[0]]
+    for child in route[1]:
+        usernames.extend(route_usernames(child))
+    return usernames
+
+class ChatSession:
+    """State of one logged-in user: history, presence and pending P2P requests"""
+
+    def __init__(self, username, store=None):
+        self.username = username
+        self.store = store or ClientStore()  # History, presence and P2P notifications
+        self.server_stats = None
+        self.public_address = None  # Our (ip, port) as observed by the server
+        self.gossip_key = None  # Key the server tags overlay broadcasts to us with
+        self.seen_ids = set()
+        self.seen_order = deque()
+        self.seen_lock = threading.Lock()  # Overlay broadcasts are admitted by every receiving thread
+
+    @property
+    def online_users(self):
+        return self.store.online_users
+
+    @property
+    def pending_p2p_requests(self):
+        return self.store.pending_p2p_requests
+
+    @property
+    def p2p_rejections(self):
+        return self.store.p2p_rejections
+
+    def add_message(self, conversation, sender, message):
+        """Append a message to a conversation and return its event"""
+        self.store.append(conversation, sender, message)
+        if sender == self.username:
+            self.store.note_sent(conversation, time.monotonic())
+        return ChatEvent("message", conversation, sender, message)
+
+    def mark_seen(self, msg_id):
+        """Remember an overlay broadcast ID, returning False if it was seen before"""
+        key = compact_id(msg_id)
+        with self.seen_lock:
+            if key in self.seen_ids:
+                return False
+            self.seen_ids.add(key)
+            self.seen_order.append(key)
+            if len(self.seen_order) > MAX_SEEN_IDS:
+                self.seen_ids.discard(self.seen_order.popleft())
+        return True
+
+    def handle_auth_success(self, frame):
+        """Record the public address and overlay broadcast key reported in AUTH_SUCCESS|ip|port|key"""
+        parts = frame.split('|')
+        self.public_address = (parts[1], int(parts[2])) if len(parts) > 2 else None
+        self.gossip_key = bytes.fromhex(parts[3]) if len(parts) > 3 else None
+
+    def handle_frame(self, frame, peer=None):
+        """Apply a frame from the server (peer is None) or a P2P peer, return its events"""
+        if peer is not None:
+            return self.handle_peer_frame(frame, peer)
+
+        msg_type, _, rest = frame.partition('|')
+
+        if msg_type == "USERS":
+            self.store.set_online_users(rest.split(',') if rest else [])
+            return [ChatEvent("users", data=self.store.online_users)]
+
+        if msg_type == "ONLINE":
+            # Sent instead of USERS once too many users are online to list: ONLINE|count
+            self.store.set_online_count(int(rest))
+            return [ChatEvent("users", data=())]
+
+        if msg_type == "WHO_RESULTS":
+            # Answer to WHO: WHO_RESULTS|{"prefix": ..., "cursor": ..., "users": [...], "next": ..., "online": n}
+            page = json.loads(rest)
+            self.store.set_directory_page(page)
+            return [ChatEvent("who", text=page["prefix"], data=page)]
+
+        if msg_type == "DIRECT":
+            # Direct message: DIRECT|sender|message
+            sender, message = rest.split('|', 1)
+            if sender == self.username:
+                return []
+            return [self.add_message(sender, sender, message)]
+
+        if msg_type == "BROADCAST":
+            # Broadcast message: BROADCAST|sender|message
+            sender, message = rest.split('|', 1)
+            if sender == self.username:
+                return []
+            return [self.add_message(BROADCAST_CONVERSATION, sender, message)]
+
+        if msg_type == "BACKLOG":
+            # Broadcast replayed at login: BACKLOG|sender|message, our own were sent from an earlier session
+            sender, message = rest.split('|', 1)
+            self.store.append(BROADCAST_CONVERSATION, sender, message)
+            return [ChatEvent("message", BROADCAST_CONVERSATION, sender, message)]
+
+        if msg_type == "ROOM_MSG":
+            # Room message: ROOM_MSG|room|sender|message
+            room, sender, message = rest.split('|', 2)
+            return [self.add_message(ROOM_PREFIX + room, sender, message)]
+
+        if msg_type == "ROOM_MEMBERS":
+            # Full member list, sent once when we join: ROOM_MEMBERS|room|user1,user2
+            room, members = rest.split('|', 1)
+            self.store.set_room_members(room, members.split(',') if members else [])
+            return [ChatEvent("room", ROOM_PREFIX + room, data=self.store.room_members(room))]
+
+        if msg_type in ("ROOM_JOINED", "ROOM_LEFT"):
+            # Incremental room presence: ROOM_JOINED|room|user or ROOM_LEFT|room|user
+            room, member = rest.split('|', 1)
+            if msg_type == "ROOM_JOINED":
+                self.store.add_room_member(room, member)
+            else:
+                self.store.remove_room_member(room, member, self.username)
+            return [ChatEvent("room", ROOM_PREFIX + room, member, data=self.store.room_members(room))]
+
+        if msg_type == "GOSSIP":
+            # Overlay broadcast seeded by the server: GOSSIP|msg_id|sender|route|message
+            return self.handle_gossip(*rest.split('|', 3))
+
+        if msg_type == "SIGNAL":
+            # Typing or read state: SIGNAL|sender|conversation|kind|value
+            sender, conversation, kind, value = rest.split('|', 3)
+            return self.handle_signal(conversation, sender, kind, value)
+
+        if msg_type == "SEARCH_RESULTS":
+            # Answer to SEARCH: SEARCH_RESULTS|{"query": ..., "results": [...]}
+            answer = json.loads(rest)
+            self.store.set_search_results(answer["query"], answer["results"])
+            return [ChatEvent("search", text=answer["query"], data=answer["results"])]
+
+        if msg_type == "STATS":
+            self.server_stats = json.loads(rest)
+            return [ChatEvent("stats", data=self.server_stats)]
+
+        if msg_type == "PROFILE":
+            # Answer to PROFILE: PROFILE|kind|path of the file on the server
+            kind, _, path = rest.partition('|')
+            return [ChatEvent("profile", text=path, data=kind)]
+
+        if msg_type == "ERROR":
+            return [ChatEvent("error", text=rest)]
+
+        if msg_type == "P2P_REQUEST_NOTIFICATION":
+            self.store.add_pending_request(rest)
+            return [ChatEvent("p2p_request", sender=rest)]
+
+        if msg_type == "P2P_REJECTED":
+            self.store.add_rejection(rest)
+            return [ChatEvent("p2p_rejected", sender=rest)]
+
+        if msg_type == "P2P_INFO":
+            # P2P connection information: P2P_INFO|username|ip|port[|AUTO]
+            parts = rest.split('|')
+            auto = len(parts) > 3 and parts[3] == "AUTO"
+            return [ChatEvent("p2p_info", sender=parts[0], data=(parts[1], parts[2], auto))]
+
+        return []
+
+    def handle_peer_frame(self, frame, peer):
+        """Apply a frame received over the P2P link with peer"""
+        frame_type, _, data = frame.partition('|')
+
+        if frame_type == "MSG":
+            return [self.add_message(peer, peer, data)]
+
+        if frame_type == "GOSSIP":
+            # Overlay broadcast forwarded by a peer: GOSSIP|msg_id|sender|route|message
+            return self.handle_gossip(*data.split('|', 3))
+
+        if frame_type == "SIGNAL":
+            # Typing or read state sent directly by the peer: SIGNAL|kind|value
+            kind, value = data.split('|', 1)
+            return self.handle_signal(peer, peer, kind, value)
+
+        return []
+
+    def handle_signal(self, conversation, sender, kind, value):
+        """Record the latest signal of a sender, nothing is added to the history"""
+        if kind not in SIGNAL_KINDS or sender == self.username:
+            return []
+        self.store.set_signal(conversation, sender, kind, value, time.monotonic())
+        return [ChatEvent("signal", conversation, sender, kind, value)]
+
+    def admit_gossip(self, data, peer=None):
+        """
+        Admit an overlay broadcast GOSSIP|msg_id|sender|route|message from the server
+        (peer is None) or a peer on the thread that read it, returning
+        (msg_id, sender, children, message) to forward, or None if it was seen before.
+        Raises ValueError unless the route is ours and tagged by the server for this
+        broadcast coming from peer. Only admitted frames reach handle_frame.
+        """
+        msg_id, sender, route, message = data.split('|', 3)
+        username, children, tag = json.loads(route)
+        if username != self.username:
+            raise ValueError(f"route for {username}")
+        expected = gossip_tag(self.gossip_key or b"", msg_id, sender, peer or "", hashlib.sha256(message.encode()).digest())
+        if self.gossip_key is None or not hmac.compare_digest(str(tag), expected):
+            raise ValueError("route not tagged by the server for this sender and parent")
+        if not self.mark_seen(msg_id):
+            return None
+        return msg_id, sender, children, message
+
+    def handle_gossip(self, msg_id, sender, route, message):
+        """Deliver an overlay broadcast, the client forwarded it and dropped duplicates with admit_gossip"""
+        if sender == self.username:
+            return []
+        return [self.add_message(BROADCAST_CONVERSATION, sender, message)]
+
+    def remove_pending_request(self, requester):
+        self.store.remove_pending_request(requester)
+
+    def dismiss_rejection(self, rejecter):
+        self.store.dismiss_rejection(rejecter)
@@ -1,14 +1,41 @@
 """
 Streamlit GUI for the chat application.
+
+The chat tab is split into fragments that rerun on their own: the user
+list, the chat pane, the message form and the P2P settings. An incoming
+message redraws only the chat pane on its next refresh; the whole page
+reruns only when the open conversation changes.
 """
 import streamlit as st
 import time
-import queue
-import threading
+from streamlit.errors import StreamlitAPIException
 from .auth import login, register, logout
-from .messaging import process_message, send_message
-from .p2p import enable_p2p_mode, update_connection_mode, register_public_ip, accept_p2p_request, reject_p2p_request
-from .utils import get_public_ip, get_local_ip
+from .messaging import (process_pending_messages, send_message, join_room, leave_room, mark_read, typing_status,
+                        search_messages, lookup_users)
+from .p2p import enable_p2p_mode, request_p2p, accept_p2p_request, reject_p2p_request
+from .utils import get_local_ip
+from common import log
+
+log_ui = log.get_logger("ui")
+
+# Seconds between the refreshes of each fragment while auto-refresh is on
+CHAT_REFRESH = 0.5
+USER_LIST_REFRESH = 2.0
+SETTINGS_REFRESH = 5.0
+
+CONTACTS_SHOWN = 10  # Contacts drawn at a time, the rest are a scroll away
+RECENT_CONTACTS = 50  # Recent conversations considered for the contact list
+
+def refresh_every(seconds):
+    """Refresh interval of a fragment, None when auto-refresh is off"""
+    return seconds if st.session_state.auto_refresh else None
+
+def rerun_fragment():
+    """Rerun the fragment being drawn, or the whole page when it is drawn as part of a full rerun"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
 
 def apply_custom_css():
     """Apply custom CSS styling to the application"""
@@ -151,10 +178,7 @@ def show_mode_selection_screen():
             st.session_state.connection_type = "client-server"
             st.session_state.mode_selected = True
             st.session_state.p2p_mode_enabled = False
-            print("\n" + "="*50)
-            print("CLIENT-SERVER MODE SELECTED")
-            print("All messages will be relayed through the central server")
-            print("="*50 + "\n")
+            log_ui.info("Client-server mode selected, all messages will be relayed through the central server")
             st.rerun()
     
     with col2:
@@ -180,26 +204,20 @@ def show_mode_selection_screen():
             
             # Set up P2P server
             if enable_p2p_mode():
-                print("\n" + "="*50)
-                print("P2P MODE SELECTED")
-                print(f"P2P server started on port {st.session_state.p2p_port}")
-                print("Direct connections will be established when possible")
-                print("="*50 + "\n")
+                log_ui.info("P2P mode selected, direct connections will be established when possible")
             else:
-                print("\n" + "="*50)
-                print("P2P MODE SELECTED BUT SERVER SETUP FAILED")
-                print("Falling back to client-server mode for now")
-                print("You can try enabling P2P mode again from the options panel")
-                print("="*50 + "\n")
+                log_ui.warning("P2P mode selected but server setup failed, falling back to client-server mode for now")
             
             st.rerun()
 
 def display_p2p_status():
     """Display P2P connection status in the UI"""
     st.markdown("<div class='chat-header'><h4>🔌 P2P Connection Status</h4></div>", unsafe_allow_html=True)
+    client = st.session_state.chat_client
+    session = client.session
     
     # Display pending P2P requests
-    if hasattr(st.session_state, 'pending_p2p_requests') and st.session_state.pending_p2p_requests:
+    if session.pending_p2p_requests:
         st.markdown("""
         <div style="background-color: #cce5ff; color: #004085; padding: 10px; 
                     border-radius: 5px; margin-bottom: 10px;">
@@ -207,7 +225,7 @@ def display_p2p_status():
         </div>
         """, unsafe_allow_html=True)
         
-        for requester in st.session_state.pending_p2p_requests:
+        for requester in list(session.pending_p2p_requests):
             st.markdown(f"Request from: **{requester}**")
             col1, col2 = st.columns(2)
             with col1:
@@ -222,17 +240,17 @@ def display_p2p_status():
                     if reject_p2p_request(requester):
                         st.success(f"Rejected P2P request from {requester}")
                         time.sleep(1)
-                        st.rerun()
+                        rerun_fragment()
     
     # Display P2P rejection notifications
-    if hasattr(st.session_state, 'p2p_rejections') and st.session_state.p2p_rejections:
-        for rejecter in st.session_state.p2p_rejections:
+    if session.p2p_rejections:
+        for rejecter in list(session.p2p_rejections):
             st.warning(f"{rejecter} rejected your P2P connection request")
             
             # Add a button to dismiss the notification
             if st.button(f"Dismiss", key=f"btn_dismiss_rejection_{rejecter}"):
-                st.session_state.p2p_rejections.remove(rejecter)
-                st.rerun()
+                session.dismiss_rejection(rejecter)
+                rerun_fragment()
     
     if not st.session_state.p2p_mode_enabled:
         st.markdown("""
@@ -243,7 +261,7 @@ def display_p2p_status():
         """, unsafe_allow_html=True)
         return
     
-    if not st.session_state.p2p_server_running:
+    if client.p2p is None or not client.p2p.running:
         st.markdown("""
         <div style="background-color: #f8d7da; color: #721c24; padding: 10px; 
                     border-radius: 5px; margin-bottom: 10px;">
@@ -253,134 +271,322 @@ def display_p2p_status():
         
         if st.button("Start P2P Server", key="btn_start_p2p_server"):
             if enable_p2p_mode():
-                st.success(f"P2P server started on port {st.session_state.p2p_port}")
-                st.rerun()
+                st.success("P2P server started")
+                rerun_fragment()
             else:
                 st.error("Failed to start P2P server")
         return
     
     # Display active P2P connections
+    peers = client.p2p_peers()
     st.markdown(f"""
-    <div style="background-color: {'#d4edda' if st.session_state.p2p_connections else '#fff3cd'}; 
-                color: {'#155724' if st.session_state.p2p_connections else '#856404'}; 
+    <div style="background-color: {'#d4edda' if peers else '#fff3cd'}; 
+                color: {'#155724' if peers else '#856404'}; 
                 padding: 10px; border-radius: 5px; margin-bottom: 10px;">
-        <strong>P2P Server:</strong> Running on port {st.session_state.p2p_port}<br>
-        <strong>Active P2P Connections:</strong> {len(st.session_state.p2p_connections)}
+        <strong>P2P Server:</strong> Running on port {client.p2p.port}<br>
+        <strong>Active P2P Connections:</strong> {len(peers)}
     </div>
     """, unsafe_allow_html=True)
     
     # List active P2P connections
-    if st.session_state.p2p_connections:
+    if peers:
         st.markdown("<strong>Connected Peers:</strong>", unsafe_allow_html=True)
-        for username in st.session_state.p2p_connections:
+        for username in peers:
             st.markdown(f"- {username}", unsafe_allow_html=True)
     
     # Add a button to request P2P connections with all users
     if st.button("Request P2P with All Users", key="btn_request_all_p2p"):
-        for username in st.session_state.online_users:
-            if username != st.session_state.username and username not in st.session_state.p2p_connections:
+        for username in client.online_users:
+            if username != st.session_state.username and not client.has_p2p(username):
                 # Send P2P request to server
-                try:
-                    st.session_state.client_socket.sendall(f"P2P_REQUEST|{username}".encode())
-                    print(f"Sent P2P request to {username}")
-                except Exception as e:
-                    print(f"Error sending P2P request to {username}: {e}")
+                if request_p2p(username):
+                    log_ui.info("Sent P2P request to %s", username)
         
         st.success("Sent P2P connection requests to all online users")
         time.sleep(1)
-        st.rerun()
+        rerun_fragment()
 
 def display_p2p_troubleshooter():
     """Display P2P connection troubleshooting tools"""
     st.markdown("<div class='chat-header'><h4>🔧 P2P Troubleshooter</h4></div>", unsafe_allow_html=True)
     
-    # Show local and public IP
+    # Show local and public IP, the public address is the one the server observed at login
+    client = st.session_state.chat_client
     local_ip = get_local_ip()
-    public_ip = get_public_ip()
+    public_address = client.session.public_address
+    public_ip = f"{public_address[0]} (port {public_address[1]})" if public_address else "Unknown"
     
     st.markdown(f"""
     <div style='background-color: white; padding: 10px; border-radius: 10px; margin-bottom: 10px; font-size: 0.9em;'>
         <p><strong>Local IP:</strong> {local_ip}</p>
         <p><strong>Public IP:</strong> {public_ip}</p>
-        <p><strong>P2P Port:</strong> {st.session_state.get('p2p_port', 'Not set')}</p>
+        <p><strong>P2P Port:</strong> {client.p2p.port if client.p2p and client.p2p.port else 'Not set'}</p>
     </div>
     """, unsafe_allow_html=True)
     
     # Force P2P connection
     st.markdown("<h5>Force P2P Connection</h5>", unsafe_allow_html=True)
-    online_users = [user for user in st.session_state.online_users if user != st.session_state.username]
+    online_users = [user for user in client.online_users if user != st.session_state.username]
     
     if online_users:
         selected_user = st.selectbox("Select user:", online_users, key="select_p2p_user")
         
         if st.button(f"Request P2P with {selected_user}", key=f"btn_force_p2p_{selected_user}"):
-            try:
-                st.session_state.client_socket.sendall(f"P2P_REQUEST|{selected_user}".encode())
+            if request_p2p(selected_user):
                 st.info(f"Sent P2P request to {selected_user}")
-            except Exception as e:
-                st.error(f"Failed to send P2P request: {e}")
+            else:
+                st.error("Failed to send P2P request")
     else:
         st.info("No users available for P2P connection")
 
-def render_chat_interface():
-    """Render the main chat interface"""
-    # Process any pending messages
-    while not st.session_state.message_queue.empty():
-        msg = st.session_state.message_queue.get()
-        process_message(msg)
+def render_message_html(sender, message, sent_time):
+    """Return the HTML bubble of a single message"""
+    if sender == st.session_state.username:
+        # Our message
+        return f"""
+        <div class='sender-msg'>
+            <small style='opacity: 0.7;'>You</small><br>
+            {message}
+            <div class='message-time'>{sent_time}</div>
+        </div>
+        """
+    # Their message
+    return f"""
+    <div class='receiver-msg'>
+        <small style='opacity: 0.7;'>{sender}</small><br>
+        {message}
+        <div class='message-time'>{sent_time}</div>
+    </div>
+    """
+
+def render_conversation_html(client, recipient):
+    """Return the HTML of a conversation from a store snapshot, cached per version"""
+    version, messages = client.store.snapshot(recipient)
+    cached = st.session_state.rendered_conversations.get(recipient)
+    if cached and cached[0] == version:
+        return cached[1]
     
-    # Layout with sidebar for users and main area for chat
-    col1, col2 = st.columns([1, 3])
+    conversation_html = "".join(render_message_html(message.sender, message.text,
+                                                    time.strftime("%H:%M", time.localtime(message.time / 1000)))
+                                for message in messages)
+    st.session_state.rendered_conversations[recipient] = (version, conversation_html)
+    return conversation_html
+
+def render_user_list():
+    """Conversations, rooms, search and people, a fragment refreshed every USER_LIST_REFRESH"""
+    process_pending_messages()
+    client = st.session_state.chat_client
+    st.markdown("<div class='chat-header'><h4>💬 Conversations</h4></div>", unsafe_allow_html=True)
     
-    # User list in the sidebar
-    with col1:
-        st.markdown("<div class='chat-header'><h4>👥 Online Users</h4></div>", unsafe_allow_html=True)
-        
-        # Display broadcast option
+    # Display broadcast option
+    st.markdown(
+        f"""
+        <div class="user-card" style="background-color: {'#e6f7ff' if st.session_state.chat_with == 'broadcast' else 'white'}; cursor: pointer;" 
+             onclick="parent.document.querySelector('[data-testid=stFormSubmitButton]').click()">
+            <strong>📢 Broadcast</strong><br>
+            <small>Send to everyone</small>
+        </div>
+        """, 
+        unsafe_allow_html=True
+    )
+    
+    # Opening a conversation changes the chat pane and the form, so it reruns the whole page
+    if st.button("Chat with Broadcast", key="btn_chat_broadcast"):
+        st.session_state.chat_with = "broadcast"
+        st.rerun()
+    
+    # Display joined rooms
+    st.markdown("<div class='chat-header'><h4>#️⃣ Rooms</h4></div>", unsafe_allow_html=True)
+    for room in client.store.room_list():
         st.markdown(
             f"""
-            <div class="user-card" style="background-color: {'#e6f7ff' if st.session_state.chat_with == 'broadcast' else 'white'}; cursor: pointer;" 
-                 onclick="parent.document.querySelector('[data-testid=stFormSubmitButton]').click()">
-                <strong>📢 Broadcast</strong><br>
-                <small>Send to everyone</small>
+            <div class="user-card" style="background-color: {'#e6f7ff' if st.session_state.chat_with == '#' + room else 'white'};">
+                <strong>#{room}</strong>
+                <span style="float: right; color: gray;">{len(client.store.room_members(room))} members</span>
             </div>
             """, 
             unsafe_allow_html=True
         )
-        
-        if st.button("Chat with Broadcast", key="btn_chat_broadcast"):
-            st.session_state.chat_with = "broadcast"
+        if st.button(f"Open #{room}", key=f"btn_room_{room}"):
+            st.session_state.chat_with = "#" + room
             st.rerun()
+    
+    with st.form(key="join_room_form", clear_on_submit=True):
+        room_name = st.text_input("Join or create a room", key="input_join_room")
+        if st.form_submit_button("Join") and room_name:
+            if join_room(room_name):
+                st.rerun()
+            else:
+                st.error("Could not join the room")
+    
+    # Search over the history the server relayed, results show up on a later refresh
+    with st.form(key="search_form"):
+        query = st.text_input("Search messages", key="input_search")
+        if st.form_submit_button("Search") and query:
+            search_messages(query)
+    searched, results = client.store.search_results
+    if searched:
+        st.caption(f"{len(results)} results for \"{searched}\"")
+        for index, result in enumerate(results):
+            st.markdown(f"<small><b>{result['sender']}</b> in {result['conversation']}: {result['text']}</small>",
+                        unsafe_allow_html=True)
+            if st.button(f"Open {result['conversation']}", key=f"btn_search_{index}"):
+                st.session_state.chat_with = result['conversation']
+                st.rerun()
 
+    # People: a lookup in the server's directory and a window over our contacts, never everyone online
+    st.markdown("<div class='chat-header'><h4>👥 People</h4></div>", unsafe_allow_html=True)
+    st.caption(f"{client.store.online_count} online")
+    render_directory_lookup(client)
+    render_contacts(client)
+
+def render_directory_lookup(client):
+    """Prefix search of the online users, one WHO page at a time"""
+    presence = client.store.presence_version
+    asked_version, asked_at = st.session_state.who_presence
+    if client.store.directory_page is None and not st.session_state.who_cursors:
+        # First draw: ask for the first page of everyone online
+        st.session_state.who_cursors = [""]
+        st.session_state.who_presence = (presence, time.monotonic())
+        lookup_users("")
+    elif presence != asked_version and time.monotonic() - asked_at >= USER_LIST_REFRESH and client.store.directory_page:
+        # Users logged in or out since the page was asked for, ask again for the same page at most once per refresh
+        st.session_state.who_presence = (presence, time.monotonic())
+        lookup_users(client.store.directory_page["prefix"], (st.session_state.who_cursors or [""])[-1])
+    st.text_input("Find online users", key="input_who", on_change=lookup_typed_prefix)
+    page = client.store.directory_page
+    if not page:
+        return
+    for user in page["users"]:
+        if user != st.session_state.username and st.button(f"{user}{' 🔗' if client.has_p2p(user) else ''}",
+                                                           key=f"btn_who_{user}"):
+            st.session_state.chat_with = user
+            st.rerun()
+    if not page["users"]:
+        st.caption("Nobody online matches")
+    col1, col2 = st.columns(2)
+    with col1:
+        # Cursors of the pages seen so far, WHO only pages forward
+        if len(st.session_state.who_cursors) > 1 and st.button("◀ Previous", key="btn_who_previous"):
+            st.session_state.who_cursors.pop()
+            lookup_users(page["prefix"], st.session_state.who_cursors[-1])
+    with col2:
+        if page["next"] and st.button("Next ▶", key="btn_who_next"):
+            st.session_state.who_cursors.append(page["next"])
+            lookup_users(page["prefix"], page["next"])
+
+def lookup_typed_prefix():
+    st.session_state.who_cursors = [""]
+    lookup_users(st.session_state.input_who)
+
+def render_contacts(client):
+    """Favorites, then the people we talked to most recently, drawn CONTACTS_SHOWN at a time"""
+    contacts = sorted(st.session_state.favorites)
+    for name in client.store.recent_conversations(RECENT_CONTACTS):
+        if name not in st.session_state.favorites and name != "broadcast" and not name.startswith("#"):
+            contacts.append(name)
+    if not contacts:
+        return
+    st.markdown("<strong>Contacts</strong>", unsafe_allow_html=True)
+    offset = min(st.session_state.contacts_offset, max(0, len(contacts) - CONTACTS_SHOWN))
+    for user in contacts[offset:offset + CONTACTS_SHOWN]:
+        label = f"{'⭐ ' if user in st.session_state.favorites else ''}{user}{' 🔗' if client.has_p2p(user) else ''}"
+        if st.button(label, key=f"btn_contact_{user}"):
+            st.session_state.chat_with = user
+            st.rerun()
+    if len(contacts) > CONTACTS_SHOWN:
+        col1, col2 = st.columns(2)
+        with col1:
+            if offset and st.button("▲", key="btn_contacts_up"):
+                st.session_state.contacts_offset = max(0, offset - CONTACTS_SHOWN)
+                rerun_fragment()
+        with col2:
+            if offset + CONTACTS_SHOWN < len(contacts) and st.button("▼", key="btn_contacts_down"):
+                st.session_state.contacts_offset = offset + CONTACTS_SHOWN
+                rerun_fragment()
+
+def render_chat_pane():
+    """Header, messages and typing line of the open conversation, a fragment refreshed every CHAT_REFRESH"""
+    recipient = st.session_state.chat_with
+    process_pending_messages()
+    if st.session_state.chat_with != recipient:
+        # An accepted P2P link opened its conversation
+        st.rerun()
+    client = st.session_state.chat_client
     
-        #Display online users
-        if st.session_state.online_users:
-            for user in st.session_state.online_users:
-                if user != st.session_state.username:  # Don't show ourselves
-                    # Determine if this user has a P2P connection
-                    has_p2p = user in st.session_state.p2p_connections
-                    
-                    st.markdown(
-                        f"""
-                        <div class="user-card" style="background-color: {'#e6f7ff' if st.session_state.chat_with == user else 'white'}; cursor: pointer;"
-                             onclick="parent.document.querySelector('[data-testid=stFormSubmitButton]').click()">
-                            <strong>{user}</strong>
-                            <span style="float: right; color: {'green' if has_p2p else 'gray'};">
-                                {'🔗 P2P' if has_p2p else '🌐 Server'}
-                            </span>
-                        </div>
-                        """, 
-                        unsafe_allow_html=True
-                    )
-                    
-                    if st.button(f"Chat with {user}", key=f"btn_chat_{user}"):
-                        st.session_state.chat_with = user
-                        st.rerun()
-        else:
-            st.info("No other users online")
+    # Chat header
+    st.markdown(
+        f"""
+        <div class='chat-header'>
+            <h4>{'📢 Broadcast' if recipient == 'broadcast' else f'#️⃣ Room {recipient}' if recipient.startswith('#') else f'💬 Chat with {recipient}'}</h4>
+            <small>{'Message everyone' if recipient == 'broadcast' else ', '.join(client.store.room_members(recipient[1:])) if recipient.startswith('#') else f"{'🔗 P2P Connection' if client.has_p2p(recipient) else '🌐 Server Connection'}"}</small>
+        </div>
+        """, 
+        unsafe_allow_html=True
+    )
+    
+    if recipient.startswith('#') and st.button(f"Leave {recipient}", key=f"btn_leave_{recipient}"):
+        leave_room(recipient[1:])
+        st.rerun()
+    
+    if recipient != "broadcast" and not recipient.startswith('#'):
+        favorite = recipient in st.session_state.favorites
+        if st.button("★ Remove from favorites" if favorite else "☆ Add to favorites", key="btn_favorite"):
+            st.session_state.favorites.symmetric_difference_update({recipient})
+            st.rerun()
     
+    # Chat messages container
+    chat_container = st.container()
+    with chat_container:
+        # Display messages, rebuilt only when the conversation changed
+        conversation_html = render_conversation_html(client, recipient)
+        if conversation_html:
+            st.markdown(conversation_html, unsafe_allow_html=True)
+            st.markdown("</div>", unsafe_allow_html=True)
+        mark_read(recipient)
+        status = typing_status(recipient)
+        if status:
+            st.caption(status)
 
-    # Auto-refresh toggle
+def render_message_form():
+    """Message input of the open conversation, a fragment so typing and sending leave the rest of the page alone"""
+    recipient = st.session_state.chat_with
+    with st.form(key=f"chat_form_{recipient}_{st.session_state.input_keys.get(recipient, 0)}", clear_on_submit=True):
+        col1, col2 = st.columns([5, 1])
+        
+        with col1:
+            message = st.text_input("Type a message", key=f"input_{recipient}_{st.session_state.input_keys.get(recipient, 0)}")
+        
+        with col2:
+            submit = st.form_submit_button("Send")
+        
+        if submit and message:
+            success, error = send_message(recipient, message)
+            if not success:
+                st.error(error)
+            else:
+                # Update input key to clear the field
+                if recipient not in st.session_state.input_keys:
+                    st.session_state.input_keys[recipient] = 0
+                st.session_state.input_keys[recipient] += 1
+                # The chat pane shows the message on its next refresh, without one only a full rerun does
+                if st.session_state.auto_refresh:
+                    rerun_fragment()
+                st.rerun()
+
+def render_chat_interface():
+    """Render the main chat interface"""
+    # Process any pending messages
+    process_pending_messages()
+    
+    # Layout with sidebar for users and main area for chat
+    col1, col2 = st.columns([1, 3])
+    
+    # User list in the sidebar
+    with col1:
+        st.fragment(render_user_list, run_every=refresh_every(USER_LIST_REFRESH))()
+
+    # Auto-refresh toggle, it changes the refresh of every fragment so it reruns the whole page
     st.checkbox("Auto-refresh UI", value=st.session_state.auto_refresh, key="auto_refresh")    
     # Force refresh button
     if st.button("Force Refresh"):
@@ -388,86 +594,8 @@ def render_chat_interface():
     # Chat area in the main column
     with col2:
         if st.session_state.chat_with:
-            # Chat header
-            recipient = st.session_state.chat_with
-            st.markdown(
-                f"""
-                <div class='chat-header'>
-                    <h4>{'📢 Broadcast' if recipient == 'broadcast' else f'💬 Chat with {recipient}'}</h4>
-                    <small>{'Message everyone' if recipient == 'broadcast' else f"{'🔗 P2P Connection' if recipient in st.session_state.p2p_connections else '🌐 Server Connection'}"}</small>
-                </div>
-                """, 
-                unsafe_allow_html=True
-            )
-            
-            # Chat messages container
-            chat_container = st.container()
-            with chat_container:
-                # Display messages
-                if recipient in st.session_state.messages and st.session_state.messages[recipient]:
-                    
-                    for sender, message in st.session_state.messages[recipient]:
-                        current_time = time.strftime("%H:%M")
-                        
-                        if sender == st.session_state.username:
-                            # Our message
-                            st.markdown(
-                                f"""
-                                <div class='sender-msg'>
-                                    <small style='opacity: 0.7;'>You</small><br>
-                                    {message}
-                                    <div class='message-time'>{current_time}</div>
-                                </div>
-                                """, 
-                                unsafe_allow_html=True
-                            )
-                        else:
-                            # Their message
-                            st.markdown(
-                                f"""
-                                <div class='receiver-msg'>
-                                    <small style='opacity: 0.7;'>{sender}</small><br>
-                                    {message}
-                                    <div class='message-time'>{current_time}</div>
-                                </div>
-                                """, 
-                                unsafe_allow_html=True
-                            )
-                    
-                    st.markdown("</div>", unsafe_allow_html=True)
-                # else:
-                #     # Empty chat
-                #     st.markdown(
-                #         """
-                #         <div class='empty-chat'>
-                #             <div style='font-size: 40px; margin-bottom: 10px;'>💬</div>
-                #             <div>No messages yet</div>
-                #             <div>Start the conversation!</div>
-                #         </div>
-                #         """,
-                #         unsafe_allow_html=True
-                #     )
-            
-            # Message input
-            with st.form(key=f"chat_form_{recipient}_{st.session_state.input_keys.get(recipient, 0)}", clear_on_submit=True):
-                col1, col2 = st.columns([5, 1])
-                
-                with col1:
-                    message = st.text_input("Type a message", key=f"input_{recipient}_{st.session_state.input_keys.get(recipient, 0)}")
-                
-                with col2:
-                    submit = st.form_submit_button("Send")
-                
-                if submit and message:
-                    success, error = send_message(recipient, message)
-                    if not success:
-                        st.error(error)
-                    else:
-                        # Update input key to clear the field
-                        if recipient not in st.session_state.input_keys:
-                            st.session_state.input_keys[recipient] = 0
-                        st.session_state.input_keys[recipient] += 1
-                        st.rerun()
+            st.fragment(render_chat_pane, run_every=refresh_every(CHAT_REFRESH))()
+            st.fragment(render_message_form)()
             st.markdown("</div>", unsafe_allow_html=True)
         # else:
         #     # No chat selected
@@ -481,6 +609,14 @@ def render_chat_interface():
         #         unsafe_allow_html=True
         #     )
 
+def render_settings():
+    """P2P status and troubleshooter, a fragment refreshed every SETTINGS_REFRESH"""
+    # P2P settings
+    display_p2p_status()
+    
+    # P2P troubleshooter
+    display_p2p_troubleshooter()
+
 def render_gui():
     """Main function to render the chat application GUI"""
     # Apply custom CSS
@@ -563,11 +699,7 @@ def render_gui():
             render_chat_interface()
         
         with tab2:
-            # P2P settings
-            display_p2p_status()
-            
-            # P2P troubleshooter
-            display_p2p_troubleshooter()
+            st.fragment(render_settings, run_every=refresh_every(SETTINGS_REFRESH))()
             
             # # Auto-refresh toggle
             # st.checkbox("Auto-refresh UI", value=st.session_state.auto_refresh, key="auto_refresh")
@@ -575,24 +707,3 @@ def render_gui():
             # # Force refresh button
             # if st.button("Force Refresh"):
             #     st.rerun()
-
-# Auto-refresh function that can be called in a thread
-def auto_refresh():
-    try:
-        if st.session_state.get("auto_refresh", False) and st.session_state.get("logged_in", False):
-            time.sleep(0.5)  # Short delay
-            st.rerun()
-    except Exception as e:
-        print(f"Auto-refresh error: {e}")
-        time.sleep(1)  # Wait a bit before trying again
-
-
-
-
-
-
-
-
-
-
-
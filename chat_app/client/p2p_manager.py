@@ -0,0 +1,274 @@
+"""
+P2P links of a chat client, independent of the GUI.
+
+P2PManager listens for peers, dials them, and hands every frame it receives
+to the owning client, which applies it like a frame from the server.
+"""
+import json
+import socket
+import threading
+import time
+from common.protocol import encode_frame, FrameReader
+from common import log, tls as tls_util
+from .core import route_usernames
+
+log_p2p = log.get_logger("p2p")
+
+# Number of P2P messages to a peer between two traffic reports to the server
+P2P_TRAFFIC_REPORT_EVERY = 25
+P2P_CONNECT_TIMEOUT = 5  # Seconds allowed for dialing a peer and its handshake
+
+class P2PManager:
+    """Listening socket and open P2P links of one user"""
+
+    def __init__(self, username, send_server, deliver, on_link, tls=None):
+        self.username = username
+        self.send_server = send_server  # Sends a frame to the server: send_server(*fields)
+        self.deliver = deliver  # Receives peer frames: deliver(peer, frame)
+        self.on_link = on_link  # Told about links coming up and going down: on_link(peer, up)
+        self.tls = tls  # (server context, ClientTLS) when links use TLS
+        self.connections = {}  # Dictionary to store P2P sockets by username
+        self.send_locks = {}
+        self.sent_counts = {}  # DMs sent over P2P not yet reported to the server
+        self.lock = threading.Lock()
+        self.port = 0  # Will be set when the listener is bound
+        self.running = False
+        self.server_socket = None
+
+    def notify_server(self, *fields):
+        """Send a control frame to the server, logging instead of raising"""
+        try:
+            self.send_server(*fields)
+        except Exception as e:
+            log_p2p.warning("Error sending %s to server: %s", fields[0], e)
+
+    def peers(self):
+        """Return the usernames we currently have a P2P link with"""
+        with self.lock:
+            return list(self.connections)
+
+    def is_connected(self, username):
+        return username in self.connections
+
+    def start(self):
+        """Bind the listener and register it with the server in the background"""
+        if self.running:
+            log_p2p.info("P2P server already running")
+            return True
+
+        # Binding and registration happen in the background so entering P2P mode never blocks
+        self.running = True
+        threading.Thread(target=self.listen, daemon=True).start()
+        log_p2p.info("P2P server starting in the background")
+        return True
+
+    def listen(self):
+        """Bind an ephemeral P2P port, register it with the server and serve peers"""
+        try:
+            # Let the OS pick a free port instead of probing candidates one by one
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.bind(('0.0.0.0', 0))
+            server_socket.listen(5)
+        except Exception as e:
+            log_p2p.warning("Error setting up P2P server: %s", e)
+            self.running = False
+            return
+
+        self.server_socket = server_socket
+        self.port = server_socket.getsockname()[1]
+        log_p2p.info("P2P server listening on port %s", self.port)
+
+        # Register our P2P port with the server, which already knows our public address
+        self.notify_server("P2P_PORT", self.port)
+
+        # A timeout on accept() lets the loop notice when we should stop
+        server_socket.settimeout(1.0)
+        while self.running:
+            try:
+                peer_socket, addr = server_socket.accept()
+            except socket.timeout:
+                continue
+            except Exception as e:
+                if self.running:
+                    log_p2p.warning("P2P server error: %s", e)
+                    time.sleep(1)  # Prevent tight loop in case of repeated errors
+                continue
+            threading.Thread(target=self.accept_peer, args=(peer_socket, addr), daemon=True).start()
+
+        log_p2p.info("P2P server handler stopped")
+
+    def accept_peer(self, peer_socket, addr):
+        """Run the handshake of an incoming P2P connection"""
+        log_p2p.info("Accepted P2P connection from %s", addr)
+        try:
+            if self.tls:
+                # The handshake runs on this peer's own thread, never on the listener
+                peer_socket = self.tls[0].wrap_socket(peer_socket, server_side=True, do_handshake_on_connect=False)
+                tls_util.accept_handshake(peer_socket)
+
+            # The dialing peer starts by sending its username
+            peer_socket.settimeout(P2P_CONNECT_TIMEOUT)
+            reader = FrameReader(peer_socket)
+            username = reader.read_frame()
+
+            with self.lock:
+                duplicate = username in self.connections
+            if not username or duplicate:
+                log_p2p.info("Already have a P2P connection with %s, closing duplicate", username)
+                peer_socket.sendall(encode_frame("P2P_DUPLICATE"))
+                peer_socket.close()
+                return
+
+            peer_socket.sendall(encode_frame("P2P_CONNECTED"))
+        except Exception as e:
+            log_p2p.warning("P2P handshake with %s failed: %s", addr, e)
+            peer_socket.close()
+            return
+
+        self.add_link(username, reader)
+
+    def connect(self, target_username, target_ip, target_port):
+        """Dial a peer at the address the server gave us, returning True on success"""
+        log_p2p.info("Establishing P2P connection with %s at %s:%s", target_username, target_ip, target_port)
+
+        if self.is_connected(target_username):
+            log_p2p.info("P2P connection with %s already exists", target_username)
+            return True
+
+        # Make sure peers can reach us too
+        self.start()
+
+        p2p_socket = None
+        try:
+            p2p_socket = socket.create_connection((target_ip, int(target_port)), timeout=P2P_CONNECT_TIMEOUT)
+            if self.tls:
+                # Redialing a peer resumes the session of the previous link
+                p2p_socket = self.tls[1].wrap(p2p_socket, (target_ip, int(target_port)))
+                p2p_socket.settimeout(P2P_CONNECT_TIMEOUT)
+            p2p_socket.sendall(encode_frame(self.username))
+
+            # Wait for confirmation
+            reader = FrameReader(p2p_socket)
+            response = reader.read_frame() or ""
+            if self.tls:
+                self.tls[1].remember((target_ip, int(target_port)), p2p_socket)
+            if not response.startswith("P2P_CONNECTED"):
+                log_p2p.warning("Unexpected P2P handshake response from %s: %s", target_username, response)
+                p2p_socket.close()
+                return False
+        except Exception as e:
+            log_p2p.warning("P2P connection to %s failed, staying on server relay: %s", target_username, e)
+            if p2p_socket:
+                p2p_socket.close()
+            return False
+
+        self.add_link(target_username, reader)
+        return True
+
+    def add_link(self, peer_username, reader):
+        """Store an established link, tell the server and start reading from it"""
+        reader.sock.settimeout(None)  # No timeout for message receiving
+        with self.lock:
+            self.connections[peer_username] = reader.sock
+            self.send_locks[peer_username] = threading.Lock()
+        log_p2p.info("P2P connection established with %s", peer_username)
+
+        self.notify_server("UPDATE_MODE", peer_username, "P2P Direct")
+        self.notify_server("P2P_ESTABLISHED", peer_username)
+        self.on_link(peer_username, True)
+
+        threading.Thread(target=self.receive, args=(reader, peer_username), daemon=True).start()
+
+    def receive(self, reader, peer_username):
+        """Hand every frame of a P2P link to the client until it closes"""
+        try:
+            while True:
+                frames = reader.read_frames()
+                if frames is None:
+                    log_p2p.info("Connection closed by %s", peer_username)
+                    break
+                for frame in frames:
+                    self.deliver(peer_username, frame)
+        except Exception as e:
+            log_p2p.warning("Error receiving from %s: %s", peer_username, e)
+        finally:
+            self.drop_link(peer_username, reader.sock)
+
+    def drop_link(self, peer_username, peer_socket):
+        """Forget a closed link and go back to server relay for that peer"""
+        try:
+            peer_socket.close()
+        except Exception:
+            pass
+
+        with self.lock:
+            if self.connections.get(peer_username) is not peer_socket:
+                return
+            del self.connections[peer_username]
+            self.send_locks.pop(peer_username, None)
+
+        # Flush the traffic we have not reported yet, then go back to server relay
+        self.report_traffic(peer_username)
+        self.notify_server("UPDATE_MODE", peer_username, "Server Relay")
+        self.on_link(peer_username, False)
+
+    def send(self, peer_username, *fields):
+        """Send a frame over the link with a peer, returning False if there is none or it failed"""
+        with self.lock:
+            peer_socket = self.connections.get(peer_username)
+            send_lock = self.send_locks.get(peer_username)
+        if peer_socket is None:
+            return False
+        try:
+            with send_lock:
+                peer_socket.sendall(encode_frame(*fields))
+            return True
+        except Exception as e:
+            log_p2p.warning("Error sending to %s over P2P: %s", peer_username, e)
+            return False
+
+    def send_message(self, peer_username, message):
+        """Send a DM over P2P and account for it, returning False to fall back to the relay"""
+        if not self.send(peer_username, "MSG", message):
+            return False
+
+        # Let the server account for DM traffic that bypassed the relay, in batches
+        counts = self.sent_counts
+        counts[peer_username] = counts.get(peer_username, 0) + 1
+        if counts[peer_username] >= P2P_TRAFFIC_REPORT_EVERY:
+            self.report_traffic(peer_username)
+        return True
+
+    def report_traffic(self, peer_username):
+        """Report DMs sent to a peer over P2P since the last report"""
+        count = self.sent_counts.pop(peer_username, 0)
+        if count:
+            self.notify_server("P2P_TRAFFIC", peer_username, count)
+
+    def forward_gossip(self, msg_id, sender, children, message):
+        """Forward an overlay broadcast to our subtrees, the server patches whatever we cannot reach"""
+        missed = []
+        for child in children:
+            if not self.send(child[0], "GOSSIP", msg_id, sender, json.dumps(child), message):
+                missed.extend(route_usernames(child))
+
+        if missed:
+            self.notify_server("GOSSIP_PATCH", msg_id, ",".join(missed))
+            log_p2p.debug("Asked server to patch broadcast for %s peers", len(missed))
+
+    def stop(self):
+        """Close the listener and every open link"""
+        self.running = False
+        if self.server_socket:
+            try:
+                self.server_socket.close()
+            except Exception:
+                pass
+        with self.lock:
+            sockets = list(self.connections.values())
+        for peer_socket in sockets:
+            try:
+                peer_socket.shutdown(socket.SHUT_RDWR)
+                peer_socket.close()
+            except Exception:
+                pass
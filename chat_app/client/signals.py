@@ -0,0 +1,61 @@
+"""
+Coalescing of ephemeral signals (typing indicators, read markers).
+
+Signals are never stored by the server and only the latest state matters,
+so a client sends at most one per conversation and kind per window, and a
+value repeated within the refresh interval is not sent at all.
+"""
+import threading
+import time
+
+SIGNAL_WINDOW = 0.5  # Seconds between two signals of one kind for one conversation
+SIGNAL_REFRESH = 3.0  # Seconds before an unchanged value is sent again, keeps typing indicators alive
+
+class SignalCoalescer:
+    """Rate limits signals per (conversation, kind), the latest value wins"""
+
+    def __init__(self, send, on_coalesced=None, window=SIGNAL_WINDOW, refresh=SIGNAL_REFRESH):
+        self.send = send  # Sends one signal: send(conversation, kind, value)
+        self.on_coalesced = on_coalesced  # Told about every signal that was merged or dropped
+        self.window = window
+        self.refresh = refresh
+        self.sent = {}  # Dictionary to store the last signal sent per key: {(conversation, kind): (value, time)}
+        self.pending = {}  # Dictionary to store values waiting for the end of their window: {key: value}
+        self.lock = threading.Lock()
+
+    def offer(self, conversation, kind, value):
+        """Send a signal now, later with the latest value, or not at all"""
+        key = (conversation, kind)
+        value = str(value)
+        now = time.monotonic()
+        with self.lock:
+            if key in self.pending:
+                # A flush is already scheduled, it carries the newest value
+                self.pending[key] = value
+                self.coalesced()
+                return
+            last_value, last_time = self.sent.get(key, (None, float("-inf")))
+            if value == last_value and now - last_time < self.refresh:
+                self.coalesced()
+                return
+            wait = last_time + self.window - now
+            if wait > 0:
+                self.pending[key] = value
+                timer = threading.Timer(wait, self.flush, (key,))
+                timer.daemon = True
+                timer.start()
+                return
+            self.sent[key] = (value, now)
+        self.send(conversation, kind, value)
+
+    def flush(self, key):
+        with self.lock:
+            value = self.pending.pop(key, None)
+            if value is None:
+                return
+            self.sent[key] = (value, time.monotonic())
+        self.send(key[0], key[1], value)
+
+    def coalesced(self):
+        if self.on_coalesced:
+            self.on_coalesced()
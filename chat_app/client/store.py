@@ -0,0 +1,274 @@
+"""
+Thread-safe state store of a chat client.
+
+Writers (the inbox consumer, P2P threads, the GUI) change state under one
+lock. Readers get immutable snapshots together with version numbers, so a
+UI can tell which conversations changed since it last drew them.
+
+History is kept in columns: interned sender names, message texts and epoch
+milliseconds in an array, so a message costs a few pointers besides its
+text. Once a conversation holds more than history_limit messages, its
+oldest messages are appended in pages to an unnamed temporary file and can
+be read back with older_messages().
+"""
+import json
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager
+
+HISTORY_LIMIT = 1000  # Messages kept in memory per conversation
+SPILL_PAGE = 250  # Messages moved to disk at a time once a conversation is over its limit
+
+Message = namedtuple("Message", ["sender", "text", "time"])  # time in epoch milliseconds
+
+class Conversation:
+    """Most recent messages of one conversation as columns, older pages spilled to a file"""
+    __slots__ = ("senders", "texts", "times", "version", "spill_file", "pages")
+
+    def __init__(self):
+        self.senders = []  # Interned, so a name is stored once however often it writes
+        self.texts = []
+        self.times = array("q")
+        self.version = 0
+        self.spill_file = None
+        self.pages = array("q")  # File offset of each spilled page, oldest first
+
+    def __len__(self):
+        return len(self.texts)
+
+    def messages(self):
+        return tuple(map(Message, self.senders, self.texts, self.times))
+
+    def spill(self, count, directory):
+        """Move the oldest count messages to the spill file as one page"""
+        if self.spill_file is None:
+            # Unnamed: the page file disappears with the process and nobody else can open it
+            self.spill_file = tempfile.TemporaryFile(mode="w+", dir=directory)
+        self.spill_file.seek(0, 2)
+        self.pages.append(self.spill_file.tell())
+        self.spill_file.write(json.dumps([self.senders[:count], self.texts[:count], self.times[:count].tolist()]) + "\n")
+        del self.senders[:count], self.texts[:count], self.times[:count]
+
+    def page(self, index):
+        self.spill_file.seek(self.pages[index])
+        senders, texts, times = json.loads(self.spill_file.readline())
+        return [Message(sys.intern(sender), text, at) for sender, text, at in zip(senders, texts, times)]
+
+class ClientStore:
+    """Conversation history, presence and P2P notifications behind a single lock"""
+
+    def __init__(self, history_limit=HISTORY_LIMIT, spill=True, spill_dir=None):
+        self.history_limit = history_limit
+        self.spill = spill  # False drops messages over the limit instead of writing them to disk
+        self.spill_dir = spill_dir  # None for the system's temporary directory
+        self.lock = threading.RLock()
+        self.conversations = {}  # Dictionary to store a Conversation by name
+        self.online_users = ()  # Empty once the server only sends the online count
+        self.online_count = 0
+        self.directory_page = None  # Last WHO page answered by the server
+        self.pending_p2p_requests = ()
+        self.p2p_rejections = ()
+        self.rooms = {}  # Dictionary to store the members of each joined room: {room: set(usernames)}
+        self.room_version = 0
+        self.version = 0  # Bumped on every change, readers compare it to skip work
+        self.presence_version = 0  # Bumped when users log in or out, not by our own WHO queries
+        self.signals = {}  # Dictionary to store ephemeral signals: {conversation: {(sender, kind): (value, received_at)}}
+        self.last_sent = {}  # Dictionary to store when we last wrote in each conversation: {conversation: monotonic time}
+        self.signal_version = 0
+        self.search_results = ("", ())  # Query and results of the last SEARCH answered by the server
+
+    @contextmanager
+    def batch(self):
+        """Group several updates into one commit, readers see all of them or none"""
+        with self.lock:
+            yield
+
+    def append(self, conversation, sender, message):
+        """Add a message to a conversation and return the conversation's new version"""
+        with self.lock:
+            entry = self.conversations.get(conversation)
+            if entry is None:
+                entry = self.conversations[conversation] = Conversation()
+            entry.senders.append(sys.intern(sender))
+            entry.texts.append(message)
+            entry.times.append(time.time_ns() // 1000000)
+            if len(entry.texts) > self.history_limit:
+                self.trim(entry)
+            signals = self.signals.get(conversation)
+            if signals:
+                # A message ends the typing of its sender
+                signals.pop((sender, "TYPING"), None)
+            entry.version += 1
+            self.version += 1
+            return entry.version
+
+    def trim(self, entry):
+        # A page is at most a quarter of the limit, so spilling never empties the conversation
+        count = max(1, min(SPILL_PAGE, self.history_limit // 4))
+        if self.spill:
+            try:
+                entry.spill(count, self.spill_dir)
+                return
+            except OSError:
+                # Keep the in-memory cap even when the disk is unavailable
+                pass
+        del entry.senders[:count], entry.texts[:count], entry.times[:count]
+
+    def snapshot(self, conversation):
+        """Return (version, messages) of a conversation, messages as a tuple of Message"""
+        with self.lock:
+            entry = self.conversations.get(conversation)
+            if entry is None:
+                return 0, ()
+            return entry.version, entry.messages()
+
+    def spilled_pages(self, conversation):
+        """Return the number of pages of a conversation on disk"""
+        with self.lock:
+            entry = self.conversations.get(conversation)
+            return len(entry.pages) if entry else 0
+
+    def older_messages(self, conversation, pages=1):
+        """Return the messages of the newest pages spilled to disk, oldest first, as a tuple of Message"""
+        with self.lock:
+            entry = self.conversations.get(conversation)
+            if entry is None or not entry.pages:
+                return ()
+            messages = []
+            for index in range(max(0, len(entry.pages) - pages), len(entry.pages)):
+                messages.extend(entry.page(index))
+            return tuple(messages)
+
+    def versions(self):
+        """Return the current version of every conversation"""
+        with self.lock:
+            return {name: entry.version for name, entry in self.conversations.items()}
+
+    def changed_since(self, versions):
+        """List conversations whose version differs from the given {conversation: version}"""
+        with self.lock:
+            return [name for name, entry in self.conversations.items() if versions.get(name) != entry.version]
+
+    def history(self):
+        """Return the messages in memory of every conversation as {conversation: [Message]}"""
+        with self.lock:
+            return {name: list(entry.messages()) for name, entry in self.conversations.items()}
+
+    def set_online_users(self, users):
+        with self.lock:
+            self.online_users = tuple(users)
+            self.online_count = len(self.online_users)
+            self.presence_version += 1
+            self.version += 1
+
+    def set_online_count(self, count):
+        """Record the number of online users when the server no longer lists them"""
+        with self.lock:
+            self.online_users = ()
+            self.online_count = count
+            self.presence_version += 1
+            self.version += 1
+
+    def set_directory_page(self, page):
+        with self.lock:
+            self.directory_page = page
+            self.version += 1
+
+    def recent_conversations(self, limit):
+        """Return the names of the conversations with the newest messages, newest first"""
+        with self.lock:
+            latest = [(entry.times[-1], name) for name, entry in self.conversations.items() if len(entry.times)]
+        return [name for _, name in sorted(latest, reverse=True)[:limit]]
+
+    def set_room_members(self, room, members):
+        with self.lock:
+            self.rooms[room] = set(members)
+            self.room_version += 1
+            self.version += 1
+
+    def add_room_member(self, room, member):
+        with self.lock:
+            if room in self.rooms:
+                self.rooms[room].add(member)
+                self.room_version += 1
+                self.version += 1
+
+    def remove_room_member(self, room, member, leaving_user):
+        """Drop a member from a room, or the whole room when leaving_user is that member"""
+        with self.lock:
+            if member == leaving_user:
+                self.rooms.pop(room, None)
+            elif room in self.rooms:
+                self.rooms[room].discard(member)
+            self.room_version += 1
+            self.version += 1
+
+    def room_list(self):
+        """Return the names of the joined rooms, sorted"""
+        with self.lock:
+            return tuple(sorted(self.rooms))
+
+    def room_members(self, room):
+        with self.lock:
+            return tuple(sorted(self.rooms.get(room, ())))
+
+    def add_pending_request(self, requester):
+        with self.lock:
+            if requester not in self.pending_p2p_requests:
+                self.pending_p2p_requests += (requester,)
+                self.version += 1
+
+    def remove_pending_request(self, requester):
+        with self.lock:
+            if requester in self.pending_p2p_requests:
+                self.pending_p2p_requests = tuple(r for r in self.pending_p2p_requests if r != requester)
+                self.version += 1
+
+    def add_rejection(self, rejecter):
+        with self.lock:
+            if rejecter not in self.p2p_rejections:
+                self.p2p_rejections += (rejecter,)
+                self.version += 1
+
+    def dismiss_rejection(self, rejecter):
+        with self.lock:
+            if rejecter in self.p2p_rejections:
+                self.p2p_rejections = tuple(r for r in self.p2p_rejections if r != rejecter)
+                self.version += 1
+
+    def set_signal(self, conversation, sender, kind, value, now):
+        """Replace the signal of one kind from a sender, signals are never part of the history"""
+        with self.lock:
+            self.signals.setdefault(conversation, {})[(sender, kind)] = (value, now)
+            self.signal_version += 1
+            self.version += 1
+
+    def note_sent(self, conversation, now):
+        with self.lock:
+            self.last_sent[conversation] = now
+
+    def typing_users(self, conversation, now, ttl):
+        """Return the senders currently typing in a conversation, sorted"""
+        with self.lock:
+            signals = self.signals.get(conversation, {})
+            return tuple(sorted(sender for (sender, kind), (value, at) in signals.items()
+                                if kind == "TYPING" and value == "1" and now - at < ttl))
+
+    def read_by(self, conversation):
+        """Return the senders who read the conversation after our last message in it, sorted"""
+        with self.lock:
+            sent = self.last_sent.get(conversation)
+            if sent is None:
+                return ()
+            signals = self.signals.get(conversation, {})
+            return tuple(sorted(sender for (sender, kind), (_, at) in signals.items()
+                                if kind == "READ" and at >= sent))
+
+    def set_search_results(self, query, results):
+        with self.lock:
+            self.search_results = (query, tuple(results))
+            self.version += 1
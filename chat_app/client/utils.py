@@ -2,8 +2,8 @@
 Utility functions for the chat application.
 """
 import hashlib
-import requests
 import socket
+from common import log
 
 # Server connection details
 SERVER_IP = 'localhost'
@@ -34,19 +34,10 @@ def validate_password(password):
         
     return True, "Password is strong"
 
-def get_public_ip():
-    """Get the public IP address of this machine"""
-    try:
-        response = requests.get('https://api.ipify.org', timeout=5)
-        return response.text
-    except Exception as e:
-        print(f"Error getting public IP: {e}")
-        return None
-
 def get_local_ip():
     """Get the local IP address of this machine"""
     try:
         return socket.gethostbyname(socket.gethostname())
     except Exception as e:
-        print(f"Error getting local IP: {e}")
+        log.get_logger("net").warning("Error getting local IP: %s", e)
         return "127.0.0.1"
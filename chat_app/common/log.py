@@ -0,0 +1,123 @@
+"""
+Asynchronous, level-gated logging shared by the server and the client.
+
+Loggers are named after a category (relay, p2p, auth, ...). Calls below the
+configured level stop at a cached level check, records that pass are handed
+to a bounded queue without being formatted, and a background thread formats
+and writes them. Message bodies are redacted unless explicitly enabled.
+"""
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+ROOT_LOGGER = "chat"
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+LOG_QUEUE_SIZE = 10000  # Records waiting for the writer thread, newer records are dropped beyond this
+
+# Defaults, overridable through configure() or the CHAT_LOG_* environment variables
+DEFAULT_LEVEL = os.environ.get("CHAT_LOG_LEVEL", "INFO")
+LOG_MESSAGE_BODIES = os.environ.get("CHAT_LOG_BODIES", "") == "1"
+
+_listener = None
+_queue_handler = None
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of the records of sampled categories"""
+
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        rate = self.sample_rates.get(record.name.rsplit('.', 1)[-1])
+        return rate is None or random.random() < rate
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that defers formatting to the writer and never blocks"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The writer thread lives in this process, so formatting can wait until it runs
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def get_logger(category):
+    """Return the logger of a category, e.g. get_logger("relay")"""
+    return logging.getLogger(f"{ROOT_LOGGER}.{category}")
+
+def body(text):
+    """Return a message body for logging, redacted unless bodies are enabled"""
+    return text if LOG_MESSAGE_BODIES else f"<{len(text)} chars>"
+
+def dropped_records():
+    """Return the number of records dropped because the writer fell behind"""
+    return _queue_handler.dropped if _queue_handler else 0
+
+def parse_category_spec(spec):
+    """Parse "relay=DEBUG,p2p=OFF" into {"relay": "DEBUG", "p2p": "OFF"}"""
+    values = {}
+    for item in filter(None, spec.split(',')):
+        category, _, value = item.partition('=')
+        values[category.strip()] = value.strip().upper()
+    return values
+
+def configure(level=None, category_levels=None, sample_rates=None, message_bodies=None, stream=None):
+    """
+    Set up the logging pipeline, safe to call more than once.
+    category_levels maps a category to a level name or "OFF" (CHAT_LOG_CATEGORIES),
+    sample_rates maps a category to the fraction of records to keep (CHAT_LOG_SAMPLE).
+    """
+    global _listener, _queue_handler, LOG_MESSAGE_BODIES
+
+    if message_bodies is not None:
+        LOG_MESSAGE_BODIES = message_bodies
+    if category_levels is None:
+        category_levels = parse_category_spec(os.environ.get("CHAT_LOG_CATEGORIES", ""))
+    if sample_rates is None:
+        sample_rates = {
+            category: float(rate)
+            for category, rate in parse_category_spec(os.environ.get("CHAT_LOG_SAMPLE", "")).items()
+        }
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel((level or DEFAULT_LEVEL).upper())
+    root.propagate = False
+
+    # Disabled categories fail the level check before any record is built
+    for category, category_level in category_levels.items():
+        logger = get_logger(category)
+        logger.setLevel(logging.CRITICAL + 1 if category_level == "OFF" else category_level)
+
+    if _listener is None:
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        _queue_handler = DroppingQueueHandler(log_queue)
+        writer = logging.StreamHandler(stream or sys.stdout)
+        writer.setFormatter(logging.Formatter(LOG_FORMAT))
+        _listener = logging.handlers.QueueListener(log_queue, writer)
+        _listener.start()
+        root.addHandler(_queue_handler)
+
+    for log_filter in list(_queue_handler.filters):
+        _queue_handler.removeFilter(log_filter)
+    if sample_rates:
+        _queue_handler.addFilter(SamplingFilter(sample_rates))
+
+def shutdown():
+    """Flush queued records and stop the writer thread"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        _listener.stop()
+        logging.getLogger(ROOT_LOGGER).removeHandler(_queue_handler)
+        _listener = None
+        _queue_handler = None
@@ -0,0 +1,206 @@
+"""
+Lightweight metrics shared by the server and the client.
+
+Counters and histograms keep one shard per thread, so recording is a plain
+dictionary update without any lock. Shards are only summed when a snapshot
+is taken, and shards of finished threads are folded into a retired total.
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from common import log
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class ShardedMetric:
+    """Base class for metrics recorded into per-thread shards"""
+    kind = "untyped"
+
+    def __init__(self, name, help_text, label_name="command"):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self._local = threading.local()
+        self._shards = []  # List of (thread, shard) pairs
+        self._retired = {}
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        """Return the shard of the calling thread, creating it on first use"""
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._retire_finished()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _retire_finished(self):
+        """Fold the shards of finished threads into the retired total"""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = live
+
+    def _merge(self, total, shard):
+        raise NotImplementedError
+
+    def collect(self):
+        """Return the merged value of every shard: {label: value}"""
+        with self._shards_lock:
+            self._retire_finished()
+            total = {}
+            self._merge(total, self._retired)
+            for _, shard in self._shards:
+                self._merge(total, dict(shard))
+        return total
+
+class Counter(ShardedMetric):
+    """Monotonic counter, optionally split by a label"""
+    kind = "counter"
+
+    def inc(self, label="", amount=1):
+        shard = self._shard()
+        shard[label] = shard.get(label, 0) + amount
+
+    def _merge(self, total, shard):
+        for label, value in shard.items():
+            total[label] = total.get(label, 0) + value
+
+    def value(self, label=""):
+        return self.collect().get(label, 0)
+
+class Histogram(ShardedMetric):
+    """Fixed bucket histogram, optionally split by a label"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS, label_name="command"):
+        super().__init__(name, help_text, label_name)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, label=""):
+        shard = self._shard()
+        entry = shard.get(label)
+        if entry is None:
+            # Bucket counts followed by the running sum and the observation count
+            entry = shard[label] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def _merge(self, total, shard):
+        for label, entry in shard.items():
+            if label not in total:
+                total[label] = list(entry)
+            else:
+                total[label] = [a + b for a, b in zip(total[label], entry)]
+
+    def quantile(self, q, label=""):
+        """Estimate a quantile from the bucket upper bounds"""
+        entry = self.collect().get(label)
+        if not entry or not entry[-1]:
+            return 0.0
+        target = q * entry[-1]
+        seen = 0
+        for index, count in enumerate(entry[:-2]):
+            seen += count
+            if seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+class Gauge:
+    """Value sampled from a callback when metrics are collected"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, callback, label_name="command"):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.callback = callback
+
+    def collect(self):
+        value = self.callback()
+        return value if isinstance(value, dict) else {"": value}
+
+class MetricsRegistry:
+    """Named collection of metrics that can be snapshotted or rendered"""
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.metrics = {}
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, label_name="command"):
+        return self._register(Counter(name, help_text, label_name))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS, label_name="command"):
+        return self._register(Histogram(name, help_text, buckets, label_name))
+
+    def gauge(self, name, help_text, callback, label_name="command"):
+        return self._register(Gauge(name, help_text, callback, label_name))
+
+    def snapshot(self):
+        """Return every metric as plain JSON-serializable data"""
+        result = {}
+        for name, metric in self.metrics.items():
+            values = metric.collect()
+            if metric.kind == "histogram":
+                values = {
+                    label: {"count": entry[-1], "sum": entry[-2],
+                            "p50": metric.quantile(0.5, label), "p99": metric.quantile(0.99, label)}
+                    for label, entry in values.items()
+                }
+            result[name] = values
+        return result
+
+    def render_prometheus(self):
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+        for name, metric in self.metrics.items():
+            full_name = self.prefix + name
+            lines.append(f"# HELP {full_name} {metric.help_text}")
+            lines.append(f"# TYPE {full_name} {metric.kind}")
+            for label, value in sorted(metric.collect().items()):
+                label_text = f'{metric.label_name}="{label}"' if label else ""
+                if metric.kind != "histogram":
+                    lines.append(f"{full_name}{{{label_text}}} {value}" if label_text else f"{full_name} {value}")
+                    continue
+                cumulative = 0
+                separator = "," if label_text else ""
+                for bound, count in zip(metric.buckets + ("+Inf",), value[:-2]):
+                    cumulative += count
+                    lines.append(f'{full_name}_bucket{{{label_text}{separator}le="{bound}"}} {cumulative}')
+                suffix = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{full_name}_sum{suffix} {value[-2]}")
+                lines.append(f"{full_name}_count{suffix} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+def start_metrics_http_server(registry, port, host="127.0.0.1"):
+    """Serve the registry as Prometheus text on http://host:port/metrics"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Keep scrapes out of the server output
+
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    log.get_logger("admin").info("Serving metrics on http://%s:%s/metrics", host, port)
+    return http_server
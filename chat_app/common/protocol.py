@@ -0,0 +1,57 @@
+"""
+Wire framing shared by the server and the client.
+
+Every frame is a '|' separated list of fields terminated by a newline, so
+several frames can share one TCP segment and a frame can span several reads.
+"""
+import hashlib
+import hmac
+
+FRAME_DELIMITER = b"\n"
+RECV_SIZE = 4096
+
+def encode_frame(*fields):
+    """Encode fields into a single newline terminated frame, refusing fields that would split it"""
+    frame = "|".join(str(field) for field in fields)
+    if "\n" in frame or "\r" in frame:
+        # A line break in user text would end the frame and turn the rest into a command of its own
+        raise ValueError("Frame fields cannot contain line breaks")
+    return frame.encode() + FRAME_DELIMITER
+
+def gossip_tag(key, msg_id, sender, parent, digest):
+    """
+    Tag the server puts on each user of an overlay broadcast route, with the key it
+    gave that user at login, over the broadcast and the peer it must come from
+    (empty for the server). digest is the SHA-256 of the message.
+    """
+    return hmac.new(key, f"{msg_id}|{sender}|{parent}|".encode() + digest, hashlib.sha256).hexdigest()[:32]
+
+class FrameReader:
+    """Split the byte stream of a socket into complete frames"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b""
+
+    def read_frames(self):
+        """Block until at least one frame arrives, return None once the peer closes"""
+        while True:
+            if FRAME_DELIMITER in self.buffer:
+                *frames, self.buffer = self.buffer.split(FRAME_DELIMITER)
+                return [frame.decode() for frame in frames]
+
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            self.buffer += data
+
+    def read_frame(self):
+        """Read exactly one frame, keeping any following frames buffered"""
+        while FRAME_DELIMITER not in self.buffer:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            self.buffer += data
+
+        frame, self.buffer = self.buffer.split(FRAME_DELIMITER, 1)
+        return frame.decode()
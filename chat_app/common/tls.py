@@ -0,0 +1,103 @@
+"""
+Optional TLS for the server port and P2P links.
+
+TLS is off unless certificates are configured. Clients keep the session of
+their last connection to each address and offer it on the next one, so a
+reconnect or a repeated P2P dial resumes the session with an abbreviated
+handshake instead of a full one.
+
+Environment:
+    CHAT_TLS_CERT, CHAT_TLS_KEY          server certificate, enables TLS on the server port
+    CHAT_TLS_CA                          CA bundle clients verify the server with, enables client TLS
+    CHAT_P2P_TLS_CERT, CHAT_P2P_TLS_KEY  certificate of P2P listeners, enables TLS on P2P links
+"""
+import os
+import socket
+import ssl
+import threading
+import time
+
+TLS_HANDSHAKE_TIMEOUT = 10  # Seconds a peer gets to complete its handshake
+TLS_SESSION_LIMIT = 256  # Sessions remembered per cache
+
+def server_context(certfile, keyfile):
+    """Context for accepting TLS connections"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+def client_context(cafile=None, check_hostname=True):
+    """Context for dialing TLS servers, cafile trusts self-signed certificates"""
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.check_hostname = check_hostname
+    return context
+
+class ClientTLS:
+    """Client context plus the last session per address, for resumption"""
+
+    def __init__(self, context):
+        self.context = context
+        self.sessions = {}  # Dictionary to store the last session per address: {(host, port): SSLSession}
+        self.lock = threading.Lock()
+        self.handshakes = {"full": 0, "resumed": 0}
+
+    def wrap(self, sock, address, server_hostname=None):
+        """Run the handshake on a connected socket, offering the cached session of address"""
+        disable_nagle(sock)
+        with self.lock:
+            session = self.sessions.get(address)
+        tls_socket = self.context.wrap_socket(sock, server_hostname=server_hostname or address[0],
+                                              session=session, do_handshake_on_connect=False)
+        tls_socket.settimeout(TLS_HANDSHAKE_TIMEOUT)
+        tls_socket.do_handshake()
+        tls_socket.settimeout(None)
+        self.handshakes["resumed" if tls_socket.session_reused else "full"] += 1
+        return tls_socket
+
+    def remember(self, address, tls_socket):
+        """Keep the session of a connection, call it once data has been read (TLS 1.3 tickets come late)"""
+        session = tls_socket.session
+        if session is None:
+            return
+        with self.lock:
+            self.sessions.pop(address, None)
+            self.sessions[address] = session
+            while len(self.sessions) > TLS_SESSION_LIMIT:
+                del self.sessions[next(iter(self.sessions))]
+
+def disable_nagle(sock):
+    """Handshake flights and tickets are small writes, Nagle would hold them for a delayed ACK"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def accept_handshake(tls_socket):
+    """Complete the server side of a handshake, return (seconds, resumed)"""
+    started = time.perf_counter()
+    disable_nagle(tls_socket)
+    tls_socket.settimeout(TLS_HANDSHAKE_TIMEOUT)
+    tls_socket.do_handshake()
+    tls_socket.settimeout(None)
+    return time.perf_counter() - started, tls_socket.session_reused
+
+def server_context_from_env(prefix="CHAT_TLS"):
+    """Server context from <prefix>_CERT and <prefix>_KEY, None when TLS is not configured"""
+    certfile = os.environ.get(f"{prefix}_CERT")
+    if not certfile:
+        return None
+    return server_context(certfile, os.environ.get(f"{prefix}_KEY") or certfile)
+
+def client_tls_from_env(check_hostname=True):
+    """ClientTLS trusting CHAT_TLS_CA, None when TLS is not configured"""
+    cafile = os.environ.get("CHAT_TLS_CA")
+    if not cafile:
+        return None
+    return ClientTLS(client_context(cafile, check_hostname))
+
+def p2p_tls_from_env():
+    """(server context, ClientTLS) for P2P links, None when P2P TLS is not configured"""
+    context = server_context_from_env("CHAT_P2P_TLS")
+    if context is None:
+        return None
+    # Peers are dialed by IP, the certificate is checked against the CA but not a hostname
+    return context, ClientTLS(client_context(os.environ.get("CHAT_TLS_CA"), check_hostname=False))
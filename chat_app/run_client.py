@@ -20,6 +20,10 @@ if is_cloud:
     auth.SERVER_HOST = os.environ.get('SERVER_HOST', 'your-server-ip')
     auth.SERVER_PORT = int(os.environ.get('SERVER_PORT', 5000))
 
+# Start the background log writer, calling this on every rerun is cheap
+from common import log
+log.configure()
+
 # Initialize the session state
 initialize_session_state()
 
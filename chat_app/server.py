@@ -3,19 +3,219 @@ Server for the chat application.
 """
 import socket
 import threading
+import signal
+import errno
+import struct
+import base64
+import selectors
+import ssl
+import logging
 import json
 import os
 import hashlib
+import uuid
+import secrets
+import random
+import time
+import itertools
+from collections import OrderedDict, deque
+from common.protocol import encode_frame, FrameReader, gossip_tag
+from common.metrics import MetricsRegistry, start_metrics_http_server
+from common import log, tls
+from backend.ratelimit import RateLimiter
+from backend.cluster import Cluster
+from backend.timerwheel import TimerWheel
+from backend.search import SearchIndex, dm_key
+from backend import handoff
+from backend.capture import Recorder
+from backend.profiling import Profiler
+from backend.directory import UserDirectory, WHO_PAGE
+from backend.backlog import FrameRing
+from backend.lanes import OutboundLanes, CONTROL, BULK
 
 # Server configuration
-HOST = "0.0.0.0"  # Listen on all interfaces
-PORT = 5000
+HOST = os.environ.get("CHAT_SERVER_HOST", "0.0.0.0")  # Listen on all interfaces
+PORT = int(os.environ.get("CHAT_SERVER_PORT", 5000))
+
+# Federation configuration, a node without a cluster port runs standalone
+CLUSTER_HOST = os.environ.get("CHAT_CLUSTER_HOST", "127.0.0.1")  # Interface peer nodes connect to, loopback only by default
+CLUSTER_PORT = int(os.environ.get("CHAT_CLUSTER_PORT", 0)) or None  # Port peer nodes connect to
+CLUSTER_SECRET = os.environ.get("CHAT_CLUSTER_SECRET", "")  # Shared by every node, required to run a cluster
+CLUSTER_PEERS = [p for p in os.environ.get("CHAT_CLUSTER_PEERS", "").split(',') if p]  # "host:port" of peer nodes
+NODE_ID = os.environ.get("CHAT_NODE_ID", "")  # Defaults to host:port of the client listener
+
+# Hot restart configuration, a new process started with the same path takes over the old one's sockets
+HANDOFF_PATH = os.environ.get("CHAT_HANDOFF_PATH")  # Unix socket path, None disables hot restart
+HANDOFF_TIMEOUT = 2.0  # Longest wait for connection threads to stop reading before the handoff
+HANDOFF_BIND_TIMEOUT = 5.0  # Longest the new process retries binding ports the old one has yet to release
+
+# TLS configuration, the client port speaks TLS when a certificate is configured
+TLS_CERT = os.environ.get("CHAT_TLS_CERT")  # PEM certificate chain, None for plain TCP
+TLS_KEY = os.environ.get("CHAT_TLS_KEY")  # PEM private key, defaults to TLS_CERT
+
+# Capture configuration, every inbound frame is recorded for tools/replay.py when a path is set
+CAPTURE_PATH = os.environ.get("CHAT_CAPTURE_PATH")  # Capture file, gzip-compressed if it ends in .gz
+# A {pid} in the path keeps the process taking over in a hot restart from overwriting the old capture
+
+# Overlay broadcast configuration
+OVERLAY_BROADCAST = True  # Spread broadcasts over client P2P links when possible
+GOSSIP_MAX_FANOUT = 4  # Maximum number of peers a client forwards a broadcast to
+GOSSIP_MAX_DEPTH = 3  # Maximum hops from the seed, keeps delivery latency bounded
+GOSSIP_RECENT_LIMIT = 256  # Number of recent broadcasts kept for patching uncovered peers
+GOSSIP_ACK_TIMEOUT = 2.0  # Seconds a tree member gets to acknowledge a broadcast before the server patches it
+GOSSIP_ACK_TICK = 0.5  # Resolution of the acknowledgement timeouts in seconds
+
+# Automatic relay-to-P2P upgrade configuration
+AUTO_P2P_UPGRADE = True  # Start P2P negotiation for busy DM pairs without a manual request
+AUTO_P2P_THRESHOLD = 20  # Relayed DMs per window that make a pair "hot"
+AUTO_P2P_WINDOW = 60  # Length of the rate window in seconds
+AUTO_P2P_COOLDOWN = 300  # Seconds before retrying a pair after an attempt or a rejection
+MAX_P2P_TRAFFIC_REPORT = 100  # DMs a single P2P_TRAFFIC report may account for, clients report every 25
+
+# Rate limiting configuration, per user and command class: (frames per second, bytes per second)
+RATE_LIMITS = {
+    "direct": (50, 256 * 1024),
+    "broadcast": (5, 32 * 1024),  # Every broadcast costs one send per online user
+    "room": (20, 128 * 1024),  # Room messages only cost one send per member
+    "control": (50, 64 * 1024),
+    "signal": (20, 8 * 1024),  # Typing and read signals, clients coalesce them to a few per second
+    "search": (5, 16 * 1024),  # Every SEARCH walks the index on the connection's thread
+    "who": (10, 16 * 1024),  # WHO pages, clients send one per keystroke of a lookup at most
+    "ack": (100, 16 * 1024),  # Overlay broadcast acknowledgements, one per read at most
+}
+# Command classes shed over the limit instead of pausing the connection, a shed ack costs a patch
+DROPPED_CLASSES = {"signal", "ack"}
+RATE_LIMIT_BURST = 2.0  # Seconds of unused allowance a user can save up
+MAX_THROTTLE_DELAY = 5.0  # Longest single pause in reading from a throttled connection
+IDLE_RATE_LIMITERS = 10000  # Buckets of users who left kept so a reconnect does not refill them, oldest dropped first
+
+# Heartbeat configuration, silent connections are pinged and then reaped
+HEARTBEAT_INTERVAL = 15  # Seconds without inbound frames before the server sends a PING
+IDLE_TIMEOUT = 45  # Seconds without inbound frames before a connection is considered dead
+HEARTBEAT_TICK = 1.0  # Resolution of the reaper in seconds
+SEND_TIMEOUT = 5.0  # Seconds a write to a client may block before the connection is reaped as dead
+
+# Admission control configuration
+LISTEN_BACKLOG = int(os.environ.get("CHAT_LISTEN_BACKLOG", 1024))  # Pending TCP connections, capped by somaxconn
+MAX_CONNECTIONS = int(os.environ.get("CHAT_MAX_CONNECTIONS", 10000))  # Open client connections, authenticated or not
+MAX_PENDING_AUTH = int(os.environ.get("CHAT_MAX_PENDING_AUTH", 256))  # Connections that have not logged in yet
+AUTH_DEADLINE = 10  # Seconds a new connection gets for its TLS handshake and LOGIN or REGISTER
+BUSY_RETRY_MS = 500  # Retry hint sent to clients turned away under overload
+
+# Admin and metrics configuration
+SEARCH_LIMIT = 20  # Results per SEARCH unless the client asks for fewer
+BROADCAST_BACKLOG = int(os.environ.get("CHAT_BROADCAST_BACKLOG", 100))  # Recent broadcasts replayed at login, 0 for none
+USERS_LIST_LIMIT = 500  # Above this many online users clients get ONLINE|count instead of USERS and look people up with WHO
+# Users allowed to run admin commands such as STATS and PROFILE, none unless the operator names them.
+# Their accounts cannot be created with REGISTER, add them to user_credentials.json instead
+ADMIN_USERS = {u for u in os.environ.get("CHAT_ADMIN_USERS", "").split(',') if u}
+ADMIN_SOCKET = os.environ.get("CHAT_ADMIN_SOCKET")  # Unix socket taking admin commands from local processes
+PROFILE_DIR = os.environ.get("CHAT_PROFILE_DIR", "profiles")  # Where PROFILE writes its files
+PROFILE_SECONDS = 10  # Length of a profile when the request gives none
+METRICS_HTTP_PORT = int(os.environ.get("CHAT_METRICS_PORT", 0)) or None  # Port serving Prometheus metrics, None disables it
+METRICS_HTTP_HOST = "127.0.0.1"  # Metrics are only served on loopback
 
 # Global variables
 clients = {}  # Dictionary to store connected clients: {username: socket}
 client_addresses = {}  # Dictionary to store client addresses: {username: (ip, port)}
 client_p2p_ports = {}  # Dictionary to store client P2P ports: {username: port}
 user_credentials = {}  # Dictionary to store user credentials: {username: password_hash}
+p2p_links = {}  # Dictionary to store established P2P links: {username: set(peer usernames)}
+p2p_link_claims = {}  # Dictionary to store links reported by one side only: {username: set(peer usernames)}
+send_locks = {}  # Dictionary to serialize writes per socket: {socket: LaneLock}
+recent_gossip = OrderedDict()  # Recently seeded overlay broadcasts: {msg_id: (sender, message, {username: parent}, pending)}
+gossip_lock = threading.Lock()  # Guards recent_gossip and its sets of users that neither acknowledged nor were patched
+gossip_deadlines = TimerWheel(GOSSIP_ACK_TICK, GOSSIP_ACK_TIMEOUT)  # Acknowledgement deadline of each overlay broadcast
+gossip_keys = {}  # Dictionary to store the key overlay broadcasts to each user are tagged with: {username: bytes}
+dm_pair_rates = {}  # Relayed DM rate per conversation: {(user_a, user_b): [window_start, count]}
+p2p_upgrade_attempts = {}  # Last P2P negotiation or rejection per pair: {(user_a, user_b): timestamp}
+dm_traffic = {"relayed": 0, "offloaded": 0, "auto_upgrades": 0}  # DM traffic accounting
+rate_limiters = {}  # Dictionary to store token buckets of connected users: {username: RateLimiter}
+idle_rate_limiters = OrderedDict()  # Token buckets of users who left, least recently left first: {username: RateLimiter}
+rooms = {}  # Dictionary to store room members: {room: set(usernames)}
+user_rooms = {}  # Dictionary to store the rooms of each user and the search watermark of their join: {username: {room: doc id}}
+cluster = None  # Cluster linking this node to its peers, None when running standalone
+tls_context = None  # Server TLS context, None when the client port is plain TCP
+recorder = None  # Capture of inbound frames, None unless CAPTURE_PATH is set
+metrics_http_server = None  # Prometheus endpoint, None unless METRICS_HTTP_PORT is set
+admin_listener = None  # Admin socket, None unless ADMIN_SOCKET is set
+connection_ids = itertools.count(1)  # IDs that tell connections apart in a capture
+handoff_requested = threading.Event()  # Set once a new process asked to take over
+connection_threads = {}  # Dictionary to store the handler thread of each connection: {socket: thread ident}
+parked_connections = {}  # Dictionary to store connections stopped for a handoff: {socket: session metadata}
+last_seen = {}  # Dictionary to store when each authenticated connection last sent a frame: {socket: monotonic time}
+pending_auth = {}  # Dictionary to store connections that have not logged in yet: {socket: monotonic accept time}
+failed_sockets = set()  # Connections a send failed on, reaped on the next tick
+heartbeats = TimerWheel(HEARTBEAT_TICK, IDLE_TIMEOUT)  # Next heartbeat check of each connection
+
+# Commands reported under their own label, anything else is counted as OTHER
+KNOWN_COMMANDS = {
+    "LOGIN", "REGISTER", "DIRECT", "BROADCAST", "P2P_REQUEST", "P2P_ACCEPT", "P2P_REJECT",
+    "P2P_PORT", "P2P_ESTABLISHED", "P2P_TRAFFIC", "UPDATE_MODE", "GOSSIP_PATCH", "GOSSIP_ACK", "STATS",
+    "JOIN", "LEAVE", "ROOM_MSG", "PING", "PONG", "SIGNAL", "SEARCH", "PROFILE",
+    "WHO",
+}
+
+# Rate limit class of each command, anything else is a control frame
+COMMAND_CLASSES = {"DIRECT": "direct", "BROADCAST": "broadcast", "ROOM_MSG": "room", "SIGNAL": "signal", "SEARCH": "search",
+                   "WHO": "who", "GOSSIP_ACK": "ack"}
+# Frames sent in the bulk lane, behind waiting control and presence frames such as P2P_INFO, ERROR and USERS
+BULK_FRAMES = {"DIRECT", "BROADCAST", "GOSSIP", "ROOM_MSG", "SEARCH_RESULTS", "WHO_RESULTS"}
+SIGNAL_KINDS = {"TYPING", "READ"}  # Ephemeral signals relayed best effort and never stored
+
+# Loggers per category, relay and broadcast log per message at DEBUG only
+log_conn = log.get_logger("conn")
+log_auth = log.get_logger("auth")
+log_relay = log.get_logger("relay")
+log_broadcast = log.get_logger("broadcast")
+log_p2p = log.get_logger("p2p")
+log_admin = log.get_logger("admin")
+
+# Server metrics, recorded per thread so they are cheap enough to leave on
+metrics = MetricsRegistry(prefix="chat_")
+frames_in = metrics.counter("frames_in_total", "Frames received from clients")
+bytes_in = metrics.counter("bytes_in_total", "Bytes received from clients")
+frames_out = metrics.counter("frames_out_total", "Frames sent to clients")
+bytes_out = metrics.counter("bytes_out_total", "Bytes sent to clients")
+send_failures = metrics.counter("send_failures_total", "Frames that could not be sent")
+command_latency = metrics.histogram("command_seconds", "Time spent handling a client frame")
+broadcast_fanout = metrics.histogram("broadcast_fanout_seconds", "Time spent fanning out a broadcast", label_name="kind")
+throttle_events = metrics.counter("throttled_frames_total", "Frames that exceeded a rate limit", label_name="class")
+throttle_delay = metrics.counter("throttle_seconds_total", "Time spent not reading throttled connections", label_name="class")
+reaped_connections = metrics.counter("reaped_connections_total", "Dead connections closed by the reaper", label_name="reason")
+reap_detect_time = metrics.histogram("reap_detect_seconds", "Time from the last inbound frame to reaping a connection")
+heartbeat_rtt = metrics.histogram("heartbeat_rtt_seconds", "Round trip time of server PINGs")
+tls_handshakes = metrics.histogram("tls_handshake_seconds", "TLS handshakes with clients", label_name="kind")
+tls_failures = metrics.counter("tls_failures_total", "TLS handshakes that failed")
+admission_rejections = metrics.counter("admission_rejections_total", "Connections turned away with BUSY", label_name="reason")
+signal_frames = metrics.counter("signal_frames_total", "Typing and read signals by outcome", label_name="outcome")
+gossip_patches = metrics.counter("gossip_patches_total", "Overlay broadcast deliveries made by the server", label_name="reason")
+send_lanes = OutboundLanes(metrics)
+metrics.gauge("connected_users", "Authenticated users", lambda: len(clients))
+metrics.gauge("open_sockets", "Client sockets that have been written to", lambda: len(send_locks))
+metrics.gauge("threads", "Live server threads", threading.active_count)
+metrics.gauge("rooms", "Rooms with at least one member", lambda: len(rooms))
+metrics.gauge("rate_limiters", "Token buckets held, of connected users and of users who left",
+              lambda: len(rate_limiters) + len(idle_rate_limiters))
+metrics.gauge("heartbeat_timers", "Connections tracked by the reaper", lambda: len(heartbeats))
+metrics.gauge("open_connections", "Client connections with a handler thread", lambda: len(connection_threads))
+metrics.gauge("pending_auth_connections", "Connections that have not logged in yet", lambda: len(pending_auth))
+metrics.gauge("gossip_backlog", "Overlay broadcasts kept for patching", lambda: len(recent_gossip))
+metrics.gauge("dm_offload_share", "Share of DM traffic carried over P2P", lambda: dm_offload_share())
+metrics.gauge("signal_share", "Share of outbound frames that are typing and read signals", lambda: signal_share())
+metrics.gauge("log_dropped", "Log records dropped because the writer fell behind", log.dropped_records)
+
+# Full-text index of relayed messages, filled by its own thread off the relay path
+search_index = SearchIndex(metrics)
+
+# Recent broadcasts, encoded once and replayed to every user logging in
+broadcast_backlog = FrameRing(BROADCAST_BACKLOG, metrics)
+
+# Sorted online usernames, local and on peer nodes, answering WHO
+user_directory = UserDirectory(metrics)
+
+# Profiles taken on admin request, idle until one is asked for
+profiler = Profiler(PROFILE_DIR, metrics)
 
 def save_user_credentials():
     """Save user credentials to a file"""
@@ -29,205 +229,1089 @@ def load_user_credentials():
             return json.load(f)
     return {}
 
+def send_frame(client_socket, *fields):
+    """Send a single frame to a client, serializing concurrent writers"""
+    send_encoded(client_socket, fields[0], encode_frame(*fields))
+
+def send_lock(client_socket):
+    """Return the lock serializing writes to a socket"""
+    lock = send_locks.get(client_socket)
+    if lock is None:
+        lock = send_locks.setdefault(client_socket, send_lanes.lock())
+    return lock
+
+def frame_lane(label):
+    """Return the lane a frame waits in for its socket"""
+    return BULK if label in BULK_FRAMES else CONTROL
+
+def send_encoded(client_socket, label, data):
+    """Send frames encoded once for many recipients, label is the command counted in the metrics"""
+    try:
+        with send_lock(client_socket).turn(frame_lane(label)):
+            # Writers queued behind a write that timed out do not wait out the timeout again
+            if client_socket in failed_sockets:
+                raise ConnectionError("an earlier write to the connection failed")
+            client_socket.sendall(data)
+    except Exception:
+        send_failures.inc(label)
+        # Let the reaper close the connection instead of failing on it for every broadcast
+        if client_socket in last_seen:
+            failed_sockets.add(client_socket)
+            heartbeats.schedule(client_socket, 0)
+        raise
+    frames_out.inc(label)
+    bytes_out.inc(label, len(data))
+
+def command_label(data):
+    """Return the metrics label of an inbound frame"""
+    command = data.split('|', 1)[0]
+    return command if command in KNOWN_COMMANDS else "OTHER"
+
+def throttle(username, data):
+    """
+    Charge a frame to its sender's rate limit, pausing this connection while over the limit.
+    Return False if the frame should be dropped instead.
+    """
+    command_class = COMMAND_CLASSES.get(data.split('|', 1)[0], "control")
+    wait = rate_limiter(username).charge(command_class, len(data) + 1)
+    if not wait:
+        return True
+    if command_class in DROPPED_CLASSES:
+        # A stale typing indicator is worth less than the messages queued behind it
+        throttle_events.inc(command_class)
+        if command_class == "signal":
+            signal_frames.inc("throttled")
+        return False
+    
+    # Not reading the socket lets TCP push back on the sender instead of queueing its frames
+    wait = min(wait, MAX_THROTTLE_DELAY)
+    throttle_events.inc(command_class)
+    throttle_delay.inc(command_class, wait)
+    log_relay.debug("Throttling %s for %.3fs on %s traffic", username, wait, command_class)
+    # A handoff cuts the pause short, the new process charges the user from a fresh bucket
+    handoff_requested.wait(wait)
+    return True
+
+def rate_limiter(username):
+    """Return the rate limiter of a connected user, bringing back the one it had when it last left"""
+    limiter = rate_limiters.get(username)
+    if limiter is None:
+        limiter = idle_rate_limiters.pop(username, None) or RateLimiter(RATE_LIMITS, RATE_LIMIT_BURST)
+        rate_limiters[username] = limiter
+    return limiter
+
+def retire_rate_limiter(username):
+    """Move the buckets of a user that left to the bounded idle set"""
+    limiter = rate_limiters.pop(username, None)
+    if limiter is None:
+        return
+    idle_rate_limiters[username] = limiter
+    idle_rate_limiters.move_to_end(username)
+    while len(idle_rate_limiters) > IDLE_RATE_LIMITERS:
+        idle_rate_limiters.popitem(last=False)
+
+def touch_connection(client_socket):
+    """Record inbound traffic, pushing back the connection's next heartbeat"""
+    now = time.monotonic()
+    last_seen[client_socket] = now
+    heartbeats.schedule(client_socket, now + HEARTBEAT_INTERVAL)
+
+def try_send_frame(client_socket, *fields):
+    """Send a small frame without ever blocking, returning False if the socket is busy or full"""
+    lock = send_lock(client_socket)
+    if not lock.acquire(frame_lane(fields[0]), blocking=False):
+        return False
+    try:
+        # A writable socket takes a small frame at once, TLS sockets cannot send with MSG_DONTWAIT
+        with selectors.DefaultSelector() as selector:
+            selector.register(client_socket, selectors.EVENT_WRITE)
+            if not selector.select(0):
+                return False
+        data = encode_frame(*fields)
+        client_socket.sendall(data)
+        frames_out.inc(fields[0])
+        bytes_out.inc(fields[0], len(data))
+        return True
+    except OSError:
+        send_failures.inc(fields[0])
+        failed_sockets.add(client_socket)
+        return False
+    finally:
+        lock.release()
+
+def set_send_timeout(client_socket):
+    """
+    Make writes to a client that stopped reading fail after SEND_TIMEOUT instead of
+    blocking every thread sending to it until the reaper notices the idle connection
+    """
+    whole = int(SEND_TIMEOUT)
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                             struct.pack("ll", whole, int((SEND_TIMEOUT - whole) * 1e6)))
+
+def reap_connection(client_socket, idle, reason):
+    """Close a dead connection, its handler thread then cleans up as for any disconnect"""
+    last_seen.pop(client_socket, None)
+    pending_auth.pop(client_socket, None)
+    failed_sockets.discard(client_socket)
+    reaped_connections.inc(reason)
+    reap_detect_time.observe(idle)
+    log_conn.info("Reaping connection idle for %.1fs (%s)", idle, reason)
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def reap_dead_connections():
+    """Ping quiet connections and reap silent ones, only visiting timers that expired"""
+    while True:
+        time.sleep(HEARTBEAT_TICK)
+        now = time.monotonic()
+        for client_socket in heartbeats.advance(now):
+            accepted = pending_auth.get(client_socket)
+            if accepted is not None:
+                # Slow or silent logins lose their thread once the deadline passes
+                if now - accepted >= AUTH_DEADLINE:
+                    reap_connection(client_socket, now - accepted, "auth_deadline")
+                else:
+                    heartbeats.schedule(client_socket, accepted + AUTH_DEADLINE)
+                continue
+            seen = last_seen.get(client_socket)
+            if seen is None:
+                continue
+            idle = now - seen
+            if client_socket in failed_sockets:
+                reap_connection(client_socket, idle, "send_failed")
+            elif idle >= IDLE_TIMEOUT:
+                reap_connection(client_socket, idle, "idle")
+            elif idle >= HEARTBEAT_INTERVAL:
+                try_send_frame(client_socket, "PING", time.time_ns())
+                heartbeats.schedule(client_socket, seen + IDLE_TIMEOUT)
+            else:
+                heartbeats.schedule(client_socket, seen + HEARTBEAT_INTERVAL)
+
+def track_pending_auth(client_socket):
+    """Give a connection AUTH_DEADLINE seconds to log in"""
+    now = time.monotonic()
+    pending_auth[client_socket] = now
+    heartbeats.schedule(client_socket, now + AUTH_DEADLINE)
+
+def admit_connection(client_socket):
+    """Track a new connection until it logs in, return False and turn it away if the server is full"""
+    if len(connection_threads) >= MAX_CONNECTIONS:
+        reason = "connections"
+    elif len(pending_auth) >= MAX_PENDING_AUTH:
+        reason = "pending_auth"
+    else:
+        track_pending_auth(client_socket)
+        return True
+    
+    admission_rejections.inc(reason)
+    retry_ms = int(BUSY_RETRY_MS * random.uniform(1, 2))
+    try:
+        # A fresh socket has an empty send buffer, the reply never blocks the accept loop
+        client_socket.setblocking(False)
+        if not isinstance(client_socket, ssl.SSLSocket):
+            client_socket.send(encode_frame("BUSY", retry_ms))
+    except OSError:
+        pass
+    # TLS clients cannot read a plaintext reply, they see the connection close and back off
+    client_socket.close()
+    return False
+
+def is_online(username):
+    """Return True if a user is connected to this node or to a peer node"""
+    return username in clients or (cluster is not None and cluster.locate(username) is not None)
+
+def send_to_user(username, *fields):
+    """Send a frame to a user on any node, returning False if nobody by that name is online"""
+    client_socket = clients.get(username)
+    if client_socket is not None:
+        send_frame(client_socket, *fields)
+        return True
+    return cluster is not None and cluster.forward(username, *fields)
+
+def user_p2p_address(username):
+    """Return the (ip, p2p_port) a user can be reached on for P2P"""
+    if username in clients:
+        return client_addresses[username][0], client_p2p_ports.get(username, "0")
+    entry = cluster.locate(username) if cluster is not None else None
+    if entry is None:
+        raise KeyError(username)
+    return entry[1], entry[3]
+
+def publish_user(username):
+    """Tell peer nodes where a local user is"""
+    if cluster is not None:
+        ip, port = client_addresses[username]
+        cluster.publish_user(username, ip, port, client_p2p_ports.get(username, "0"))
+
+def local_directory():
+    """Return (username, ip, port, p2p_port) of every local user, for new peer nodes"""
+    return [(username, address[0], address[1], client_p2p_ports.get(username, "0"))
+            for username, address in list(client_addresses.items())]
+
+def deliver_local(username, data):
+    """Write an already encoded frame forwarded by a peer node to a local user"""
+    client_socket = clients.get(username)
+    if client_socket is None:
+        return
+    if data.startswith(b"DIRECT|"):
+        # DMs across nodes are searchable on the recipient's node as well
+        _, sender, msg = data[:-1].decode().split('|', 2)
+        search_index.add(dm_key(sender, username), sender, msg, (sender, username))
+    try:
+        with send_lock(client_socket).turn(frame_lane(data.split(b'|', 1)[0].decode())):
+            client_socket.sendall(data)
+    except Exception as e:
+        send_failures.inc("FWD")
+        log_relay.warning("Error delivering forwarded frame to %s: %s", username, e)
+
+def deliver_cluster_broadcast(frame, exclude):
+    """Deliver a broadcast or a room frame from a peer node to the users of this node"""
+    kind, _, rest = frame.partition('|')
+    if kind == "ROOM_MSG":
+        # Rooms have members on several nodes, each node indexes the room for its own members
+        room, sender, message = rest.split('|', 2)
+        search_index.add("#" + room, sender, message)
+        send_to_room(room, kind, room, sender, message)
+        return
+    if kind in ("ROOM_JOINED", "ROOM_LEFT"):
+        room, username = rest.split('|', 1)
+        send_to_room(room, kind, room, username)
+        return
+    
+    sender, message = rest.split('|', 1)
+    if sender != "SERVER":
+        search_index.add("broadcast", sender, message)
+    broadcast_message(sender, message, exclude, forward=False)
+
+def store_replicated_credentials(username, password_hash):
+    """Keep a registration made on a peer node, existing accounts are never replaced"""
+    if username in user_credentials or username in ADMIN_USERS:
+        log_auth.warning("Ignored a replicated registration of existing or reserved user %s", username)
+        return
+    user_credentials[username] = password_hash
+    save_user_credentials()
+
 def broadcast_online_users():
-    """Broadcast the list of online users to all clients"""
-    online_users = list(clients.keys())
-    users_str = ",".join(online_users)
+    """Broadcast the list of online users to all clients, or only their number once there are too many"""
+    started = time.perf_counter()
+    if len(user_directory) > USERS_LIST_LIMIT:
+        # Past a few hundred names the list costs more to send and draw than it helps, clients use WHO instead
+        frame = ("ONLINE", len(user_directory))
+    else:
+        online_users = list(clients.keys())
+        if cluster is not None:
+            online_users += cluster.remote_users()
+        frame = ("USERS", ",".join(online_users))
     
-    for username, client_socket in clients.items():
+    for username, client_socket in list(clients.items()):
         try:
-            client_socket.sendall(f"USERS|{users_str}".encode())
+            send_frame(client_socket, *frame)
         except:
             pass  # Handle failed sends silently
+    
+    broadcast_fanout.observe(time.perf_counter() - started, frame[0])
+
+def remote_directory_changed(added, removed):
+    """Apply users joining or leaving peer nodes to the directory and tell the clients"""
+    for username in added:
+        user_directory.add(username)
+    for username in removed:
+        user_directory.remove(username)
+    broadcast_online_users()
+
+def claim_p2p_link(username, peer):
+    """
+    Record that username reports a P2P link with peer, return True once both have.
+    Broadcast trees only use links both ends vouch for.
+    """
+    if username in p2p_link_claims.get(peer, ()):
+        p2p_link_claims[peer].discard(username)
+        p2p_links.setdefault(username, set()).add(peer)
+        p2p_links.setdefault(peer, set()).add(username)
+        return True
+    p2p_link_claims.setdefault(username, set()).add(peer)
+    return False
+
+def remove_p2p_link(username, peer):
+    """Forget the P2P link between two users, or the claim of one of them"""
+    p2p_links.get(username, set()).discard(peer)
+    p2p_links.get(peer, set()).discard(username)
+    p2p_link_claims.get(username, set()).discard(peer)
+    p2p_link_claims.get(peer, set()).discard(username)
+
+def remove_p2p_links(username):
+    """Forget every P2P link and claim of a user"""
+    for peer in p2p_links.pop(username, set()):
+        p2p_links.get(peer, set()).discard(username)
+    p2p_link_claims.pop(username, None)
+    for claims in list(p2p_link_claims.values()):
+        claims.discard(username)
 
-def broadcast_message(sender, message, exclude=None):
-    """Broadcast a message to all connected clients except the sender"""
-    for username, client_socket in clients.items():
-        if username != exclude:
+def valid_room_name(room):
+    """Room names travel inside frames and member lists, so they cannot contain separators"""
+    return bool(room) and len(room) <= 64 and not any(c in room for c in "|,\n")
+
+def send_to_room(room, *fields, exclude=None):
+    """Send a frame to every member of a room"""
+    started = time.perf_counter()
+    # Copy the members so joins and leaves from other threads cannot break the loop
+    for member in list(rooms.get(room, ())):
+        if member == exclude or member not in clients:
+            continue
+        try:
+            send_frame(clients[member], *fields)
+        except Exception as e:
+            log_broadcast.warning("Error sending %s to %s in room %s: %s", fields[0], member, room, e)
+    broadcast_fanout.observe(time.perf_counter() - started, "ROOM")
+
+def relay_to_room(room, *fields, exclude=None):
+    """Send a room frame to the members here and to those on every peer node"""
+    send_to_room(room, *fields, exclude=exclude)
+    # Peer nodes only hand it to their own members of the room, the excluded user is always local
+    if cluster is not None:
+        cluster.broadcast(None, *fields)
+
+def join_room(username, room):
+    """Add a user to a room, returning False if they were already a member"""
+    members = rooms.setdefault(room, set())
+    if username in members:
+        return False
+    # Taken before the user can receive anything, so search covers every room message they were sent
+    user_rooms.setdefault(username, {})[room] = search_index.watermark()
+    members.add(username)
+    return True
+
+def leave_room(username, room):
+    """Remove a user from a room, returning False if they were not a member"""
+    members = rooms.get(room)
+    if not members or username not in members:
+        return False
+    members.discard(username)
+    if not members:
+        rooms.pop(room, None)
+    user_rooms.get(username, {}).pop(room, None)
+    # Remaining members only hear about the one user who left
+    relay_to_room(room, "ROOM_LEFT", room, username)
+    return True
+
+def leave_all_rooms(username):
+    """Remove a disconnecting user from each of their rooms"""
+    for room in user_rooms.pop(username, {}):
+        members = rooms.get(room)
+        if members is None:
+            continue
+        members.discard(username)
+        if not members:
+            rooms.pop(room, None)
+        relay_to_room(room, "ROOM_LEFT", room, username)
+
+def build_broadcast_forest(recipients):
+    """
+    Cover the recipients with spanning trees over the P2P overlay.
+    Returns (trees, direct) where each tree is a nested [username, [subtrees]]
+    route and direct lists the recipients the server must reach itself.
+    """
+    recipient_set = set(recipients)
+    neighbours = {
+        username: [peer for peer in p2p_links.get(username, ()) if peer in recipient_set]
+        for username in recipients
+    }
+    
+    visited = set()
+    trees = []
+    direct = []
+    
+    # Seed from the best connected peers first so each tree covers as many users as possible
+    for root in sorted(recipients, key=lambda username: len(neighbours[username]), reverse=True):
+        if root in visited:
+            continue
+        visited.add(root)
+        
+        tree = [root, []]
+        frontier = deque([(tree, 0)])
+        while frontier:
+            node, depth = frontier.popleft()
+            if depth >= GOSSIP_MAX_DEPTH:
+                continue
+            for peer in neighbours[node[0]]:
+                if len(node[1]) >= GOSSIP_MAX_FANOUT:
+                    break
+                if peer in visited:
+                    continue
+                visited.add(peer)
+                child = [peer, []]
+                node[1].append(child)
+                frontier.append((child, depth + 1))
+        
+        if tree[1]:
+            trees.append(tree)
+        else:
+            direct.append(root)
+    
+    return trees, direct
+
+def route_parents(route, parents):
+    """Record the parent of every user below the root of a broadcast route"""
+    for child in route[1]:
+        parents[child[0]] = route[0]
+        route_parents(child, parents)
+    return parents
+
+def remember_gossip(msg_id, sender, message, trees):
+    """Keep a seeded broadcast and its routes around until every member acknowledged or was patched"""
+    parents = {}
+    pending = set()
+    for tree in trees:
+        route_parents(tree, parents)
+        pending.update(flatten_route(tree))
+    with gossip_lock:
+        recent_gossip[msg_id] = (sender, message, parents, pending)
+        evicted = []
+        while len(recent_gossip) > GOSSIP_RECENT_LIMIT:
+            evicted.append(recent_gossip.popitem(last=False))
+    gossip_deadlines.schedule(msg_id, time.monotonic() + GOSSIP_ACK_TIMEOUT)
+    # Broadcasts pushed out before their deadline are patched now rather than never
+    for old_id, (old_sender, old_message, _, old_pending) in evicted:
+        gossip_deadlines.cancel(old_id)
+        with gossip_lock:
+            missed = list(old_pending)
+            old_pending.clear()
+        deliver_gossip_patch(old_id, old_sender, old_message, missed, "evicted")
+
+def broadcast_message(sender, message, exclude=None, forward=True):
+    """Broadcast a message to all connected clients except the excluded one"""
+    started = time.perf_counter()
+    
+    # Peer nodes deliver to their own users, they never forward again
+    if forward and cluster is not None:
+        cluster.broadcast(exclude, "BROADCAST", sender, message)
+    
+    frame = encode_frame("BROADCAST", sender, message)
+    listed = lambda: [username for username in list(clients) if username != exclude]
+    # Join and leave notices are stale by the time anyone logs in, they are not replayed.
+    # Replays are BACKLOG frames, which clients keep even for their own messages
+    recipients = (broadcast_backlog.append(encode_frame("BACKLOG", sender, message), listed)
+                  if sender != "SERVER" else listed())
+    
+    if OVERLAY_BROADCAST and p2p_links:
+        # Users whose route cannot be tagged are reached directly
+        trees, direct = build_broadcast_forest([username for username in recipients if username in gossip_keys])
+        direct.extend(username for username in recipients if username not in gossip_keys)
+    else:
+        trees, direct = [], recipients
+    
+    # Seed one member of each P2P tree, the tree forwards the message itself
+    if trees:
+        msg_id = uuid.uuid4().hex
+        remember_gossip(msg_id, sender, message, trees)
+        digest = hashlib.sha256(message.encode()).digest()
+        for tree in trees:
             try:
-                client_socket.sendall(f"BROADCAST|{sender}|{message}".encode())
-            except:
-                pass  # Handle failed sends silently
+                route = tag_route(tree, msg_id, sender, digest)
+                send_frame(clients[tree[0]], "GOSSIP", msg_id, sender, json.dumps(route), message)
+            except Exception:
+                direct.extend(flatten_route(tree))
+                acknowledge_gossip(flatten_route(tree), [msg_id])
+    
+    for username in direct:
+        client_socket = clients.get(username)
+        if client_socket is None:
+            continue
+        try:
+            send_encoded(client_socket, "BROADCAST", frame)
+        except:
+            pass  # Handle failed sends silently
+    
+    broadcast_fanout.observe(time.perf_counter() - started, "BROADCAST")
+
+def tag_route(route, msg_id, sender, digest, parent=""):
+    """
+    Copy a broadcast route as [username, [subtrees], tag], the tag proving to each
+    user that the server routed the broadcast to it through parent
+    """
+    username = route[0]
+    tag = gossip_tag(gossip_keys.get(username, b""), msg_id, sender, parent, digest)
+    return [username, [tag_route(child, msg_id, sender, digest, username) for child in route[1]], tag]
+
+def flatten_route(route):
+    """List every username contained in a broadcast route"""
+    usernames = [route[0]]
+    for child in route[1]:
+        usernames.extend(flatten_route(child))
+    return usernames
+
+def patch_gossip(msg_id, reporter, usernames):
+    """
+    Deliver an overlay broadcast directly to peers the overlay could not reach.
+    Only users below the reporter in the broadcast's route are patched, each at most once.
+    """
+    entry = recent_gossip.get(msg_id)
+    if entry is None:
+        log_broadcast.warning("Cannot patch unknown broadcast %s", msg_id)
+        return
+    
+    sender, message, parents, pending = entry
+    with gossip_lock:
+        accepted = [username for username in usernames if username in pending and is_below(parents, username, reporter)]
+        pending.difference_update(accepted)
+    if len(accepted) < len(usernames):
+        log_broadcast.warning("Ignored %d patch targets of broadcast %s outside the subtree of %s or already served",
+                              len(usernames) - len(accepted), msg_id, reporter)
+    deliver_gossip_patch(msg_id, sender, message, accepted, "reported")
+
+def acknowledge_gossip(usernames, msg_ids):
+    """Record that users received overlay broadcasts, they will not be patched"""
+    with gossip_lock:
+        for msg_id in msg_ids:
+            entry = recent_gossip.get(msg_id)
+            if entry is not None:
+                entry[3].difference_update(usernames)
+
+def patch_unacknowledged_gossip():
+    """Patch the members of overlay broadcasts that did not acknowledge them in time"""
+    while True:
+        time.sleep(GOSSIP_ACK_TICK)
+        for msg_id in gossip_deadlines.advance(time.monotonic()):
+            with gossip_lock:
+                entry = recent_gossip.get(msg_id)
+                if entry is None:
+                    continue
+                sender, message, _, pending = entry
+                missed = list(pending)
+                pending.clear()
+            if missed:
+                # A parent that died or stayed silent loses nobody its subtree
+                log_broadcast.info("Patching broadcast %s for %d peers that did not acknowledge it", msg_id, len(missed))
+                deliver_gossip_patch(msg_id, sender, message, missed, "timeout")
+
+def deliver_gossip_patch(msg_id, sender, message, usernames, reason):
+    """Send an overlay broadcast to users as a route of their own, so those who got it already drop it"""
+    if not usernames:
+        return
+    digest = hashlib.sha256(message.encode()).digest()
+    for username in usernames:
+        client_socket = clients.get(username)
+        if client_socket is None:
+            continue
+        route = tag_route([username, []], msg_id, sender, digest)
+        try:
+            send_frame(client_socket, "GOSSIP", msg_id, sender, json.dumps(route), message)
+        except:
+            pass  # Handle failed sends silently
+    gossip_patches.inc(reason, len(usernames))
+
+def is_below(parents, username, ancestor):
+    """Tell whether ancestor is on the route from the root of a broadcast tree to username"""
+    parent = parents.get(username)
+    while parent is not None:
+        if parent == ancestor:
+            return True
+        parent = parents.get(parent)
+    return False
+
+def send_p2p_info(requester_username, accepter_username, *flags):
+    """Send each side of a P2P negotiation the address of the other side"""
+    # Send P2P info to both clients, either of them may be on a peer node
+    try:
+        accepter_ip, accepter_port = user_p2p_address(accepter_username)
+        requester_ip, requester_port = user_p2p_address(requester_username)
+        log_p2p.debug("Accepter info: %s:%s, requester info: %s:%s", accepter_ip, accepter_port, requester_ip, requester_port)
+        
+        # Send accepter's info to requester
+        send_to_user(requester_username, "P2P_INFO", accepter_username, accepter_ip, accepter_port, *flags)
+        
+        # Send requester's info to accepter
+        send_to_user(accepter_username, "P2P_INFO", requester_username, requester_ip, requester_port, *flags)
+        
+        log_p2p.info("Sent P2P connection info to %s and %s", requester_username, accepter_username)
+        return True
+    except Exception as e:
+        log_p2p.warning("Error sending P2P connection info: %s", e)
+        return False
+
+def conversation_pair(user_a, user_b):
+    """Return the order-independent key of a DM conversation"""
+    return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+def can_auto_upgrade(pair, now):
+    """Check whether policy allows the server to start P2P for a pair on its own"""
+    user_a, user_b = pair
+    if user_a not in client_p2p_ports or user_b not in client_p2p_ports:
+        return False  # Both sides must have a P2P listener running
+    if user_b in p2p_links.get(user_a, ()):
+        return False  # Already linked
+    return now - p2p_upgrade_attempts.get(pair, float("-inf")) >= AUTO_P2P_COOLDOWN
+
+def track_dm_rate(sender, recipient):
+    """Count a relayed DM and upgrade the pair to P2P once it gets hot"""
+    dm_traffic["relayed"] += 1
+    if not AUTO_P2P_UPGRADE:
+        return
+    
+    now = time.time()
+    pair = conversation_pair(sender, recipient)
+    rate = dm_pair_rates.get(pair)
+    if rate is None or now - rate[0] >= AUTO_P2P_WINDOW:
+        rate = dm_pair_rates[pair] = [now, 0]
+    rate[1] += 1
+    
+    if rate[1] >= AUTO_P2P_THRESHOLD and can_auto_upgrade(pair, now):
+        log_p2p.info("Auto P2P: %s and %s exchanged %d DMs in %.0fs, starting negotiation", pair[0], pair[1], rate[1], now - rate[0])
+        p2p_upgrade_attempts[pair] = now
+        # Connection threads of both users can get here for the same pair at once
+        dm_pair_rates.pop(pair, None)
+        if send_p2p_info(pair[0], pair[1], "AUTO"):
+            dm_traffic["auto_upgrades"] += 1
+
+def dm_offload_share():
+    """Return the share of DM traffic carried over P2P instead of the relay"""
+    total = dm_traffic["relayed"] + dm_traffic["offloaded"]
+    return dm_traffic["offloaded"] / total if total else 0.0
+
+def signal_share():
+    """Return the share of frames sent to clients that are signals"""
+    sent = frames_out.collect()
+    total = sum(sent.values())
+    return sent.get("SIGNAL", 0) / total if total else 0.0
+
+def relay_signal(sender, target, kind, value):
+    """
+    Pass a typing or read signal to a user or the members of a room. Signals
+    are never queued behind a busy socket: a recipient that cannot take the
+    frame right away misses it, the next signal supersedes it anyway.
+    """
+    if target.startswith("#"):
+        room = target[1:]
+        if sender not in rooms.get(room, ()):
+            return
+        recipients = [member for member in list(rooms.get(room, ())) if member != sender]
+    else:
+        recipients = [target]
+    # A DM signal arrives in the conversation with the sender, a room signal in the room
+    conversation = target if target.startswith("#") else sender
+    for recipient in recipients:
+        client_socket = clients.get(recipient)
+        if client_socket is None:
+            # Users on other nodes, rooms only list the members on this node so room signals stay here
+            if cluster is not None and cluster.forward(recipient, "SIGNAL", sender, conversation, kind, value):
+                signal_frames.inc("forwarded")
+            continue
+        if try_send_frame(client_socket, "SIGNAL", sender, conversation, kind, value):
+            signal_frames.inc("relayed")
+        else:
+            signal_frames.inc("dropped")
+
+def handle_command(client_socket, username_for_loop, data):
+    """Handle a single frame from an authenticated client"""
+    # Parse the message format
+    parts = data.split('|', 2)
+    if parts[0] == "DIRECT":
+        # Direct message: DIRECT|recipient|message
+        recipient, msg = parts[1], parts[2]
+        if log_relay.isEnabledFor(logging.DEBUG):
+            log_relay.debug("Direct message from %s to %s: %s", username_for_loop, recipient, log.body(msg))
+        
+        if is_online(recipient):
+            try:
+                # Send message to the recipient, through its node when it is connected elsewhere
+                send_to_user(recipient, "DIRECT", username_for_loop, msg)
+                track_dm_rate(username_for_loop, recipient)
+                search_index.add(dm_key(username_for_loop, recipient), username_for_loop, msg, (username_for_loop, recipient))
+            except Exception as e:
+                log_relay.warning("Error delivering message to %s: %s", recipient, e)
+                send_frame(client_socket, "ERROR", f"Could not deliver message to {recipient}")
+        else:
+            send_frame(client_socket, "ERROR", f"User {recipient} not connected")
+    
+    elif parts[0] == "PING":
+        # Client checking the connection: PING|token
+        send_frame(client_socket, "PONG", *parts[1:])
+    
+    elif parts[0] == "PONG":
+        # Answer to a server heartbeat: PONG|sent_ns
+        try:
+            heartbeat_rtt.observe((time.time_ns() - int(parts[1])) / 1e9)
+        except (IndexError, ValueError):
+            pass
+    
+    elif parts[0] == "BROADCAST":
+        # Broadcast message: BROADCAST|message
+        msg = parts[1]
+        if log_broadcast.isEnabledFor(logging.DEBUG):
+            log_broadcast.debug("Broadcast from %s: %s", username_for_loop, log.body(msg))
+        
+        # Send to all clients
+        broadcast_message(username_for_loop, msg)
+        search_index.add("broadcast", username_for_loop, msg)
+    
+    elif parts[0] == "P2P_REQUEST":
+        # P2P connection request: P2P_REQUEST|target_username
+        target_username = parts[1]
+        log_p2p.info("P2P request from %s to %s", username_for_loop, target_username)
+        
+        if is_online(target_username):
+            # Send request notification to target user
+            try:
+                send_to_user(target_username, "P2P_REQUEST_NOTIFICATION", username_for_loop)
+            except Exception as e:
+                log_p2p.warning("Error sending P2P request notification: %s", e)
+                send_frame(client_socket, "ERROR", f"Failed to send P2P request to {target_username}")
+        else:
+            send_frame(client_socket, "ERROR", f"User {target_username} not available for P2P")
+
+    elif parts[0] == "P2P_ACCEPT":
+        # P2P accept: P2P_ACCEPT|requester_username
+        requester_username = parts[1]
+        log_p2p.info("P2P request accepted: %s accepted request from %s", username_for_loop, requester_username)
+        
+        send_p2p_info(requester_username, username_for_loop)
+
+    elif parts[0] == "P2P_REJECT":
+        # P2P reject: P2P_REJECT|requester_username
+        requester_username = parts[1]
+        log_p2p.info("P2P request rejected: %s rejected request from %s", username_for_loop, requester_username)
+        p2p_upgrade_attempts[conversation_pair(username_for_loop, requester_username)] = time.time()
+        
+        # Notify requester of rejection
+        try:
+            send_to_user(requester_username, "P2P_REJECTED", username_for_loop)
+            
+            # After a short delay, allow the requester to send another request
+            # This is handled client-side
+        except Exception as e:
+            log_p2p.warning("Error sending P2P rejection notification: %s", e)
+
+    elif parts[0] == "P2P_PORT":
+        # Store the client's P2P port
+        p2p_port = parts[1]
+        client_p2p_ports[username_for_loop] = p2p_port
+        publish_user(username_for_loop)
+        log_p2p.info("User %s registered P2P port: %s", username_for_loop, p2p_port)
+    
+    elif parts[0] == "P2P_ESTABLISHED":
+        # Client notifying that P2P connection was established
+        target_username = parts[1]
+        if claim_p2p_link(username_for_loop, target_username):
+            log_p2p.info("P2P connection established between %s and %s", username_for_loop, target_username)
+        else:
+            log_p2p.info("%s reports a P2P connection with %s, waiting for the other side", username_for_loop, target_username)
+    
+    elif parts[0] == "UPDATE_MODE":
+        # Client updating their connection mode
+        target_username, mode = parts[1], parts[2]
+        log_p2p.info("User %s updated connection mode for %s to %s", username_for_loop, target_username, mode)
+        if mode == "Server Relay":
+            remove_p2p_link(username_for_loop, target_username)
+    
+    elif parts[0] == "P2P_TRAFFIC":
+        # Client reporting DMs it sent over a P2P link: P2P_TRAFFIC|peer|count
+        try:
+            target_username, count = parts[1], int(parts[2])
+        except (IndexError, ValueError):
+            send_frame(client_socket, "ERROR", "P2P_TRAFFIC needs a peer and a DM count")
+            return
+        if count < 1:
+            send_frame(client_socket, "ERROR", "P2P_TRAFFIC counts must be positive")
+            return
+        count = min(count, MAX_P2P_TRAFFIC_REPORT)
+        dm_traffic["offloaded"] += count
+        log_p2p.info("Auto P2P: %s sent %d DMs to %s over P2P, %.1f%% of DM traffic now bypasses the relay",
+                     username_for_loop, count, target_username, dm_offload_share() * 100)
+    
+    elif parts[0] in ("STATS", "PROFILE"):
+        # Admin request: STATS for a metrics snapshot, PROFILE|kind|seconds to profile the server
+        if username_for_loop in ADMIN_USERS:
+            log_admin.info("%s requested by %s", parts[0], username_for_loop)
+            send_frame(client_socket, *admin_command(parts))
+        else:
+            send_frame(client_socket, "ERROR", f"{parts[0]} is restricted to admin users")
+    
+    elif parts[0] == "JOIN":
+        # Join or create a room: JOIN|room
+        room = parts[1] if len(parts) > 1 else ""
+        if not valid_room_name(room):
+            send_frame(client_socket, "ERROR", "Room names must be 1-64 characters without '|' or ','")
+        elif join_room(username_for_loop, room):
+            log_relay.info("%s joined room %s", username_for_loop, room)
+            # The joiner gets the member list once, everyone else only the new member. The list
+            # only holds members on this node, those on peer nodes show up as they join
+            send_frame(client_socket, "ROOM_MEMBERS", room, ",".join(rooms[room]))
+            relay_to_room(room, "ROOM_JOINED", room, username_for_loop, exclude=username_for_loop)
+    
+    elif parts[0] == "LEAVE":
+        # Leave a room: LEAVE|room
+        room = parts[1] if len(parts) > 1 else ""
+        if leave_room(username_for_loop, room):
+            log_relay.info("%s left room %s", username_for_loop, room)
+            send_frame(client_socket, "ROOM_LEFT", room, username_for_loop)
+    
+    elif parts[0] == "ROOM_MSG":
+        # Message to the members of a room: ROOM_MSG|room|message
+        room, msg = parts[1], parts[2]
+        if username_for_loop not in rooms.get(room, ()):
+            send_frame(client_socket, "ERROR", f"You are not a member of room {room}")
+        else:
+            if log_relay.isEnabledFor(logging.DEBUG):
+                log_relay.debug("Room message from %s to %s: %s", username_for_loop, room, log.body(msg))
+            relay_to_room(room, "ROOM_MSG", room, username_for_loop, msg, exclude=username_for_loop)
+            search_index.add("#" + room, username_for_loop, msg)
+    
+    elif parts[0] == "SIGNAL":
+        # Typing indicator or read receipt: SIGNAL|user or #room|kind|value
+        kind, _, value = parts[2].partition('|')
+        if kind in SIGNAL_KINDS:
+            relay_signal(username_for_loop, parts[1], kind, value)
+    
+    elif parts[0] == "SEARCH":
+        # Full-text search of the conversations the user can see: SEARCH|query[|limit]
+        query = parts[1] if len(parts) > 1 else ""
+        try:
+            limit = min(int(parts[2]), SEARCH_LIMIT) if len(parts) > 2 else SEARCH_LIMIT
+        except ValueError:
+            limit = SEARCH_LIMIT
+        results = search_index.search(query, username_for_loop, dict(user_rooms.get(username_for_loop, {})), max(limit, 1))
+        send_frame(client_socket, "SEARCH_RESULTS", json.dumps({"query": query, "results": results}))
+    
+    elif parts[0] == "WHO":
+        # Page of online users by prefix: WHO|prefix|cursor|limit, the cursor is the last name of the previous page
+        fields = data.split('|')[1:] + ["", "", ""]
+        prefix, cursor = fields[0], fields[1]
+        try:
+            limit = int(fields[2]) if fields[2] else WHO_PAGE
+        except ValueError:
+            limit = WHO_PAGE
+        users, next_cursor = user_directory.query(prefix, cursor, limit)
+        send_frame(client_socket, "WHO_RESULTS", json.dumps({"prefix": prefix, "cursor": cursor, "users": users,
+                                                              "next": next_cursor, "online": len(user_directory)}))
+    
+    elif parts[0] == "GOSSIP_PATCH":
+        # Overlay broadcast could not reach part of a tree: GOSSIP_PATCH|msg_id|user1,user2
+        msg_id, missed = parts[1], parts[2].split(',')
+        log_broadcast.info("Patching broadcast %s for %d peers reported by %s", msg_id, len(missed), username_for_loop)
+        patch_gossip(msg_id, username_for_loop, missed)
+    
+    elif parts[0] == "GOSSIP_ACK":
+        # Overlay broadcasts received by the client: GOSSIP_ACK|msg_id1,msg_id2
+        acknowledge_gossip([username_for_loop], parts[1].split(',') if len(parts) > 1 else [])
 
-def handle_client(client_socket, client_address):
-    """Handle client connection"""
-    print(f"[NEW CONNECTION] {client_address} connected.")
+def admin_command(parts):
+    """Run an admin command from an admin user or the admin socket, return the reply fields"""
+    if parts[0] == "STATS":
+        return "STATS", json.dumps(metrics.snapshot())
+    if parts[0] == "PROFILE":
+        # PROFILE|cpu, memory or stacks|seconds, the reply names the file the profile is written to
+        kind = parts[1] if len(parts) > 1 else ""
+        try:
+            path = profiler.start(kind, parts[2] if len(parts) > 2 else PROFILE_SECONDS)
+        except ValueError as e:
+            return "ERROR", str(e)
+        return "PROFILE", kind, os.path.abspath(path)
+    return "ERROR", f"Unknown admin command {parts[0]}"
+
+def open_admin_socket(path):
+    """Bind the admin socket, the socket file is only accessible to our user"""
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    os.chmod(path, 0o600)
+    listener.listen(8)
+    return listener
+
+def serve_admin_socket(listener):
+    """Answer admin commands from local processes until the listener is closed"""
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=answer_admin_connection, args=(conn,), daemon=True).start()
+
+def answer_admin_connection(conn):
+    try:
+        reader = FrameReader(conn)
+        while True:
+            frame = reader.read_frame()
+            if not frame:
+                break
+            log_admin.info("%s requested on the admin socket", frame.split('|', 1)[0])
+            conn.sendall(encode_frame(*admin_command(frame.split('|'))))
+    except OSError as e:
+        log_admin.warning("Error on the admin socket: %s", e)
+    finally:
+        conn.close()
+
+def send_login_reply(client_socket, username, client_address):
+    """Register the client and send AUTH_SUCCESS followed by the broadcast backlog in a single write"""
+    try:
+        # Broadcasts to the client wait for its send lock, so none overtakes AUTH_SUCCESS or the backlog
+        with send_lock(client_socket).turn(CONTROL):
+            # Overlay broadcasts to the user are tagged with this key, peers cannot forge them
+            gossip_key = secrets.token_bytes(16)
+            gossip_keys[username] = gossip_key
+            backlog = broadcast_backlog.snapshot(lambda: clients.__setitem__(username, client_socket))
+            reply = encode_frame("AUTH_SUCCESS", *client_address, gossip_key.hex())
+            client_socket.sendall(reply + backlog)
+    except Exception:
+        send_failures.inc("AUTH_SUCCESS")
+        if clients.get(username) is client_socket:
+            del clients[username]
+            gossip_keys.pop(username, None)
+            user_directory.remove(username)
+        raise
+    frames_out.inc("AUTH_SUCCESS")
+    bytes_out.inc("AUTH_SUCCESS", len(reply))
+    bytes_out.inc("BACKLOG", len(backlog))
+
+def handle_client(client_socket, client_address, reader=None, resumed_username=None):
+    """Handle client connection, resumed_username is set for sessions taken over from an old process"""
+    connection_threads[client_socket] = threading.get_ident()
+    connection_id = next(connection_ids)
+    if resumed_username is None:
+        log_conn.info("New connection from %s", client_address)
     
     # Wait for login or registration
     try:
-        data = client_socket.recv(1024).decode()
-        parts = data.split('|')
+        if isinstance(client_socket, ssl.SSLSocket):
+            # Runs on this connection's thread, the accept loop never waits for a handshake
+            try:
+                seconds, resumed = tls.accept_handshake(client_socket)
+            except (OSError, ValueError) as e:
+                tls_failures.inc()
+                log_conn.info("TLS handshake with %s failed: %s", client_address, e)
+                return
+            tls_handshakes.observe(seconds, "resumed" if resumed else "full")
         
-        if parts[0] == "LOGIN":
-            # Login request: LOGIN|username|password_hash
-            username, password_hash = parts[1], parts[2]
+        reader = reader or FrameReader(client_socket)
+        username = resumed_username
+        if username is None:
+            try:
+                data = reader.read_frame()
+            except OSError:
+                if handoff_requested.is_set():
+                    return park_connection(client_socket, client_address, None, reader)
+                raise
+            if data is None:
+                return
+            if handoff_requested.is_set():
+                return park_connection(client_socket, client_address, None, reader, [data])
+            if recorder is not None:
+                recorder.frame(connection_id, data)
+            frames_in.inc(command_label(data))
+            bytes_in.inc(command_label(data), len(data) + 1)
+            parts = data.split('|')
             
-            # Check credentials
-            if username in user_credentials and user_credentials[username] == password_hash:
-                # Authentication successful
-                client_socket.sendall("AUTH_SUCCESS".encode())
-                
-                # Register the client
-                clients[username] = client_socket
-                client_addresses[username] = client_address
-                print(f"[+] {username} authenticated and connected from {client_address}")
+            if parts[0] == "LOGIN":
+                # Login request: LOGIN|username|password_hash
+                username, password_hash = parts[1], parts[2]
+            
+                # Check credentials
+                if username in user_credentials and user_credentials[username] == password_hash:
+                    # Authentication successful
+                    # Register the client and reply with the address we observe, so it never has to ask an
+                    # external service, and the recent broadcasts, all in one write
+                    if username not in clients:
+                        user_directory.add(username)
+                    send_login_reply(client_socket, username, client_address)
+                    client_addresses[username] = client_address
+                    publish_user(username)
+                    log_auth.info("%s authenticated and connected from %s", username, client_address)
                 
-                # Broadcast updated user list to all clients
-                broadcast_online_users()
+                    # Broadcast updated user list to all clients
+                    broadcast_online_users()
                 
-                # Notify all clients about the new user
-                broadcast_message("SERVER", f"{username} has joined the chat", username)
-            else:
-                # Authentication failed
-                client_socket.sendall("AUTH_FAILED".encode())
+                    # Notify all clients about the new user
+                    broadcast_message("SERVER", f"{username} has joined the chat", username)
+                else:
+                    # Authentication failed
+                    send_frame(client_socket, "AUTH_FAILED")
+                    client_socket.close()
+                    return
+        
+            elif parts[0] == "REGISTER":
+                # New user registration: REGISTER|username|password_hash
+                new_username, new_password_hash = parts[1], parts[2]
+                if new_username in ADMIN_USERS:
+                    log_auth.warning("Refused to register admin user %s from %s", new_username, client_address)
+                    send_frame(client_socket, "ERROR", f"Username {new_username} is reserved")
+                elif new_username not in user_credentials:
+                    user_credentials[new_username] = new_password_hash
+                    save_user_credentials()
+                    if cluster is not None:
+                        cluster.publish_credentials(new_username, new_password_hash)
+                    send_frame(client_socket, "SUCCESS", f"User {new_username} registered successfully")
+                else:
+                    send_frame(client_socket, "ERROR", f"Username {new_username} already exists")
                 client_socket.close()
                 return
         
-        elif parts[0] == "REGISTER":
-            # New user registration: REGISTER|username|password_hash
-            new_username, new_password_hash = parts[1], parts[2]
-            if new_username not in user_credentials:
-                user_credentials[new_username] = new_password_hash
-                save_user_credentials()
-                client_socket.sendall(f"SUCCESS|User {new_username} registered successfully".encode())
             else:
-                client_socket.sendall(f"ERROR|Username {new_username} already exists".encode())
-            client_socket.close()
-            return
-        
-        else:
-            # Unknown request
-            client_socket.close()
-            return
+                # Unknown request
+                client_socket.close()
+                return
         
         # Main message handling loop
         username_for_loop = username  # Store username for use in the loop
+        rate_limiter(username_for_loop)
+        pending_auth.pop(client_socket, None)
+        touch_connection(client_socket)
+        if recorder is not None:
+            recorder.user(connection_id, username_for_loop)
         
         while True:
             try:
-                data = client_socket.recv(1024).decode()
-                if not data:
+                frames = reader.read_frames()
+                if frames is None:
                     break
+                touch_connection(client_socket)
                 
-                # Parse the message format
-                parts = data.split('|', 2)
-                
-                if parts[0] == "DIRECT":
-                    # Direct message: DIRECT|recipient|message
-                    recipient, msg = parts[1], parts[2]
-                    print(f"Direct message from {username_for_loop} to {recipient}: {msg[:30]}...")
+                for i, data in enumerate(frames):
+                    # Stop before the next frame, the new process handles the rest
+                    if handoff_requested.is_set():
+                        return park_connection(client_socket, client_address, username_for_loop, reader, frames[i:])
+                    if recorder is not None:
+                        recorder.frame(connection_id, data)
+                    # The rate limit is what keeps a busy connection from crowding out the others, each has
+                    # its own thread and the interpreter switches threads every sys.getswitchinterval() anyway
+                    if not throttle(username_for_loop, data):
+                        continue
                     
-                    if recipient in clients:
-                        try:
-                            # Send message to the recipient
-                            clients[recipient].sendall(f"DIRECT|{username_for_loop}|{msg}".encode())
-                            print(f"Delivered message to {recipient}")
-                        except Exception as e:
-                            print(f"Error delivering message to {recipient}: {e}")
-                            client_socket.sendall(f"ERROR|Could not deliver message to {recipient}".encode())
-                    else:
-                        client_socket.sendall(f"ERROR|User {recipient} not connected".encode())
-                
-                elif parts[0] == "BROADCAST":
-                    # Broadcast message: BROADCAST|message
-                    msg = parts[1]
-                    print(f"Broadcast from {username_for_loop}: {msg[:30]}...")
-                    
-                    # Send to all clients
-                    broadcast_message(username_for_loop, msg)
-                
-                elif parts[0] == "P2P_REQUEST":
-                    # P2P connection request: P2P_REQUEST|target_username
-                    target_username = parts[1]
-                    print(f"P2P request from {username_for_loop} to {target_username}")
-                    
-                    if target_username in clients:
-                        # Send request notification to target user
-                        try:
-                            clients[target_username].sendall(f"P2P_REQUEST_NOTIFICATION|{username_for_loop}".encode())
-                            print(f"Sent P2P request notification to {target_username}")
-                        except Exception as e:
-                            print(f"Error sending P2P request notification: {e}")
-                            client_socket.sendall(f"ERROR|Failed to send P2P request to {target_username}".encode())
-                    else:
-                        client_socket.sendall(f"ERROR|User {target_username} not available for P2P".encode())
-
-                elif parts[0] == "P2P_ACCEPT":
-                    # P2P accept: P2P_ACCEPT|requester_username
-                    requester_username = parts[1]
-                    print(f"P2P request accepted: {username_for_loop} accepted request from {requester_username}")
-                    
-                    # Get the P2P port of the accepting client
-                    accepter_port = client_p2p_ports.get(username_for_loop, "0")
-                    accepter_ip = client_addresses[username_for_loop][0]
-                    
-                    # Get the P2P port of the requesting client
-                    requester_port = client_p2p_ports.get(requester_username, "0")
-                    requester_ip = client_addresses[requester_username][0]
-                    
-                    print(f"Accepter info: {accepter_ip}:{accepter_port}")
-                    print(f"Requester info: {requester_ip}:{requester_port}")
-                    
-                    # Send P2P info to both clients
-                    try:
-                        # Send accepter's info to requester
-                        clients[requester_username].sendall(f"P2P_INFO|{username_for_loop}|{accepter_ip}|{accepter_port}".encode())
-                        print(f"Sent accepter info to requester: {accepter_ip}:{accepter_port}")
-                        
-                        # Send requester's info to accepter
-                        clients[username_for_loop].sendall(f"P2P_INFO|{requester_username}|{requester_ip}|{requester_port}".encode())
-                        print(f"Sent requester info to accepter: {requester_ip}:{requester_port}")
-                        
-                        print(f"Sent P2P connection info to both users")
-                    except Exception as e:
-                        print(f"Error sending P2P connection info: {e}")
-
-                elif parts[0] == "P2P_REJECT":
-                    # P2P reject: P2P_REJECT|requester_username
-                    requester_username = parts[1]
-                    print(f"P2P request rejected: {username_for_loop} rejected request from {requester_username}")
-                    
-                    # Notify requester of rejection
-                    try:
-                        clients[requester_username].sendall(f"P2P_REJECTED|{username_for_loop}".encode())
-                        print(f"Sent P2P rejection notification to {requester_username}")
-                        
-                        # After a short delay, allow the requester to send another request
-                        # This is handled client-side, but we log it here for clarity
-                        print(f"User {requester_username} can send another P2P request to {username_for_loop}")
-                    except Exception as e:
-                        print(f"Error sending P2P rejection notification: {e}")
-
-                elif parts[0] == "P2P_PORT":
-                    # Store the client's P2P port
-                    p2p_port = parts[1]
-                    client_p2p_ports[username_for_loop] = p2p_port
-                    print(f"User {username_for_loop} registered P2P port: {p2p_port}")
-                
-                elif parts[0] == "P2P_ESTABLISHED":
-                    # Client notifying that P2P connection was established
-                    target_username = parts[1]
-                    print(f"P2P connection established between {username_for_loop} and {target_username}")
-                
-                elif parts[0] == "UPDATE_MODE":
-                    # Client updating their connection mode
-                    target_username, mode = parts[1], parts[2]
-                    print(f"User {username_for_loop} updated connection mode for {target_username} to {mode}")
+                    command = command_label(data)
+                    frames_in.inc(command)
+                    bytes_in.inc(command, len(data) + 1)
+                    if "\r" in data:
+                        # Nothing the server sends may carry a line break, see encode_frame
+                        send_frame(client_socket, "ERROR", f"{command} frame contains a carriage return")
+                        continue
+                    started = time.perf_counter()
+                    handle_command(client_socket, username_for_loop, data)
+                    command_latency.observe(time.perf_counter() - started, command)
                 
             except Exception as e:
-                print(f"Error handling client {username_for_loop}: {e}")
+                if handoff_requested.is_set():
+                    return park_connection(client_socket, client_address, username_for_loop, reader)
+                log_conn.warning("Error handling client %s: %s", username_for_loop, e)
                 break
         
         # Client disconnected
-        print(f"[-] {username_for_loop} disconnected")
+        log_conn.info("%s disconnected", username_for_loop)
         
         # Remove client from dictionaries
         if username_for_loop in clients:
             del clients[username_for_loop]
+            gossip_keys.pop(username_for_loop, None)
+            user_directory.remove(username_for_loop)
+        retire_rate_limiter(username_for_loop)
         if username_for_loop in client_addresses:
             del client_addresses[username_for_loop]
         if username_for_loop in client_p2p_ports:
             del client_p2p_ports[username_for_loop]
+        remove_p2p_links(username_for_loop)
+        leave_all_rooms(username_for_loop)
+        if cluster is not None:
+            cluster.unpublish_user(username_for_loop)
         
         # Notify others that user has left
         broadcast_message("SERVER", f"{username_for_loop} has left the chat")
@@ -236,34 +1320,256 @@ def handle_client(client_socket, client_address):
         broadcast_online_users()
         
     except Exception as e:
-        print(f"Error in client handler: {e}")
+        log_conn.error("Error in client handler: %s", e)
     
     finally:
-        # Close the socket
+        connection_threads.pop(client_socket, None)
+        pending_auth.pop(client_socket, None)
+        if recorder is not None and not handoff_requested.is_set():
+            recorder.close(connection_id)
+        last_seen.pop(client_socket, None)
+        failed_sockets.discard(client_socket)
+        heartbeats.cancel(client_socket)
+        # Parked sockets stay open until they are handed off
+        if client_socket not in parked_connections:
+            # Close the socket
+            try:
+                client_socket.close()
+            except:
+                pass
+            send_locks.pop(client_socket, None)
+            log_conn.info("Connection closed: %s", client_address)
+
+def park_connection(client_socket, client_address, username, reader, frames=()):
+    """Stop handling a connection for a handoff, keeping its unread input"""
+    pending = b"".join(frame.encode() + b"\n" for frame in frames) + reader.buffer
+    parked_connections[client_socket] = {
+        "username": username,
+        "address": list(client_address),
+        "pending": base64.b64encode(pending).decode(),
+    }
+
+def session_metadata(client_socket, parked):
+    """Complete the metadata of a parked connection with the state of its user"""
+    username = parked["username"]
+    if username is None:
+        return parked
+    gossip_key = gossip_keys.get(username)
+    return dict(parked, p2p_port=client_p2p_ports.get(username), rooms=sorted(user_rooms.get(username, ())),
+                p2p_links=sorted(p2p_links.get(username, ())), gossip_key=gossip_key.hex() if gossip_key else None)
+
+def wake_connections():
+    """Make blocked recv calls return so connection threads notice the handoff"""
+    # A receive timeout affects the next call, the signal interrupts the call in progress
+    for client_socket, ident in list(connection_threads.items()):
         try:
-            client_socket.close()
-        except:
+            handoff.set_receive_timeout(client_socket, 0.001)
+            if ident is not None:
+                signal.pthread_kill(ident, signal.SIGUSR1)
+        except (OSError, ProcessLookupError):
+            pass
+
+def hand_off(server, conn):
+    """Pass the listening socket and every connection to the process on conn, then exit"""
+    started = time.perf_counter()
+    wake_connections()
+    deadline = time.monotonic() + HANDOFF_TIMEOUT
+    while connection_threads and time.monotonic() < deadline:
+        time.sleep(0.001)
+    if connection_threads:
+        log_conn.warning("%d connections did not stop in time and will be dropped", len(connection_threads))
+    
+    # Hold every send lock so nothing else writes to a socket once the new process owns it
+    # TLS state cannot move between processes, those clients reconnect and resume their session
+    parked = [(client_socket, meta) for client_socket, meta in parked_connections.items()
+              if not isinstance(client_socket, ssl.SSLSocket)]
+    for client_socket, _ in parked:
+        send_lock(client_socket).acquire(CONTROL)
+    
+    release_listeners()
+    handoff.send_message(conn, {"kind": "listener", "dm_traffic": dm_traffic}, [server.fileno()])
+    handoff.send_sessions(conn, [(client_socket, session_metadata(client_socket, meta)) for client_socket, meta in parked])
+    handoff.send_message(conn, {"kind": "done"})
+    log_conn.info("Handed off %d connections in %.1f ms", len(parked), (time.perf_counter() - started) * 1000)
+    if recorder is not None:
+        recorder.stop()
+    log.shutdown()
+    os._exit(0)
+
+def release_listeners():
+    """Free the cluster, metrics and admin ports for the process taking over"""
+    if cluster is not None:
+        cluster.stop_listening()
+    if admin_listener is not None:
+        try:
+            admin_listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
             pass
-        print(f"[-] Connection closed: {client_address}")
+        admin_listener.close()
+    if metrics_http_server is not None:
+        # shutdown() waits for the serving loop to notice, which can take its poll interval
+        def stop_metrics():
+            metrics_http_server.shutdown()
+            metrics_http_server.server_close()
+        threading.Thread(target=stop_metrics, daemon=True).start()
+
+def bind_retrying(bind, what, took_over):
+    """
+    Return bind(), retrying while the address is in use if we took over from a
+    process that may still be releasing it. Failing is fatal and logged as such.
+    """
+    deadline = time.monotonic() + HANDOFF_BIND_TIMEOUT
+    delay = 0.01
+    while True:
+        try:
+            return bind()
+        except OSError as e:
+            if not took_over or e.errno != errno.EADDRINUSE or time.monotonic() >= deadline:
+                log_conn.critical("Cannot bind the %s: %s", what, e)
+                raise
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+def resume_session(client_socket, meta):
+    """Restore a session received from an old process, return the thread that will handle it"""
+    handoff.set_receive_timeout(client_socket, 0)
+    client_address = tuple(meta["address"])
+    reader = FrameReader(client_socket)
+    reader.buffer = base64.b64decode(meta["pending"])
+    username = meta["username"]
+    if username is not None:
+        if username not in clients:
+            user_directory.add(username)
+        clients[username] = client_socket
+        client_addresses[username] = client_address
+        if meta.get("gossip_key"):
+            gossip_keys[username] = bytes.fromhex(meta["gossip_key"])
+        if meta.get("p2p_port") is not None:
+            client_p2p_ports[username] = meta["p2p_port"]
+        for room in meta.get("rooms", ()):
+            # The index starts empty in this process, everything it will hold comes after the join
+            rooms.setdefault(room, set()).add(username)
+            user_rooms.setdefault(username, {})[room] = 0
+        for peer in meta.get("p2p_links", ()):
+            p2p_links.setdefault(username, set()).add(peer)
+    if username is None:
+        track_pending_auth(client_socket)
+    connection_threads[client_socket] = None
+    return threading.Thread(target=handle_client, args=(client_socket, client_address, reader, username), daemon=True)
+
+def take_over(path):
+    """Take over the sockets of a running server, returning its listening socket or None"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        return None
+    
+    started = time.perf_counter()
+    server = None
+    handlers = []
+    with conn:
+        while True:
+            payload, fds = handoff.receive_message(conn)
+            if payload["kind"] == "listener":
+                server = socket.socket(fileno=fds[0])
+                handoff.set_receive_timeout(server, 0)
+                dm_traffic.update(payload["dm_traffic"])
+            elif payload["kind"] == "sessions":
+                for meta, fd in zip(payload["sessions"], fds):
+                    handlers.append(resume_session(socket.socket(fileno=fd), meta))
+            else:
+                break
+    
+    # Every session is restored before any of them runs, so no frame finds its recipient missing
+    for handler in handlers:
+        handler.start()
+    log_conn.info("Took over %d connections in %.1f ms", len(handlers), (time.perf_counter() - started) * 1000)
+    return server
+
+def serve_handoff_requests(path, server, handoff_connection):
+    """Wait for a new process on the handoff socket and tell the accept loop about it"""
+    if os.path.exists(path):
+        os.unlink(path)
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    control.bind(path)
+    control.listen(1)
+    conn, _ = control.accept()
+    log_conn.info("A new server process is taking over")
+    handoff_connection.append(conn)
+    handoff_requested.set()
+    # The main thread runs the accept loop, interrupt it
+    handoff.set_receive_timeout(server, 0.001)
+    signal.pthread_kill(threading.main_thread().ident, signal.SIGUSR1)
 
 def start_server():
     """Start the chat server"""
     # Load user credentials
-    global user_credentials
+    global user_credentials, cluster, tls_context, recorder, metrics_http_server, admin_listener
+    log.configure()
     user_credentials = load_user_credentials()
+    if TLS_CERT:
+        tls_context = tls.server_context(TLS_CERT, TLS_KEY or TLS_CERT)
+    if CLUSTER_PORT and not CLUSTER_SECRET:
+        raise RuntimeError("CHAT_CLUSTER_SECRET must be set to run a cluster node")
     
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((HOST, PORT))
-    server.listen(5)
-    print(f"[SERVER] Listening on {HOST}:{PORT}...")
+    # Take over from a running server first, it releases its other ports before handing off
+    server = take_over(HANDOFF_PATH) if HANDOFF_PATH else None
+    took_over = server is not None
+    
+    if CLUSTER_PORT:
+        cluster = Cluster(
+            NODE_ID or f"{socket.gethostname()}:{PORT}", (CLUSTER_HOST, CLUSTER_PORT), CLUSTER_PEERS, CLUSTER_SECRET, metrics,
+            deliver=deliver_local,
+            deliver_broadcast=deliver_cluster_broadcast,
+            on_directory_change=remote_directory_changed,
+            on_credentials=store_replicated_credentials,
+            local_directory=local_directory,
+        )
+        bind_retrying(cluster.start, "cluster port", took_over)
+    
+    if METRICS_HTTP_PORT:
+        metrics_http_server = bind_retrying(
+            lambda: start_metrics_http_server(metrics, METRICS_HTTP_PORT, METRICS_HTTP_HOST), "metrics port", took_over)
+    if ADMIN_SOCKET:
+        admin_listener = bind_retrying(lambda: open_admin_socket(ADMIN_SOCKET), "admin socket", took_over)
+        threading.Thread(target=serve_admin_socket, args=(admin_listener,), daemon=True).start()
+    
+    threading.Thread(target=reap_dead_connections, daemon=True).start()
+    threading.Thread(target=patch_unacknowledged_gossip, daemon=True).start()
+    search_index.start()
+    if CAPTURE_PATH:
+        recorder = Recorder(CAPTURE_PATH.replace("{pid}", str(os.getpid())), metrics).start()
+    
+    if server is None:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((HOST, PORT))
+        server.listen(LISTEN_BACKLOG)
+    log_conn.info("Listening on %s:%s%s", HOST, PORT, " with TLS" if tls_context else "")
+    
+    handoff_connection = []
+    if HANDOFF_PATH:
+        # Python only interrupts blocking calls for signals that have a handler
+        signal.signal(signal.SIGUSR1, lambda signum, frame: None)
+        threading.Thread(target=serve_handoff_requests, args=(HANDOFF_PATH, server, handoff_connection), daemon=True).start()
 
-    while True:
+    while not handoff_requested.is_set():
         try:
             client_socket, client_address = server.accept()
+            set_send_timeout(client_socket)
+            if tls_context is not None:
+                client_socket = tls_context.wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
+            if not admit_connection(client_socket):
+                continue
+            connection_threads[client_socket] = None
             threading.Thread(target=handle_client, args=(client_socket, client_address), daemon=True).start()
         except Exception as e:
-            print(f"Error accepting connection: {e}")
+            if not handoff_requested.is_set():
+                log_conn.error("Error accepting connection: %s", e)
+    
+    hand_off(server, handoff_connection[0])
 
 if __name__ == "__main__":
     start_server()
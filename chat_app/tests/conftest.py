@@ -0,0 +1,8 @@
+"""
+The chat_app modules import each other as top-level packages (common, client,
+backend), as when run from the chat_app directory.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,38 @@
+"""
+Broadcast backlog replayed at login, including the user's own broadcasts.
+"""
+import socket
+import server
+from common.protocol import FrameReader
+from client.core import ChatSession, BROADCAST_CONVERSATION
+
+def test_login_replays_own_broadcasts():
+    server.broadcast_message("alice", "sent before logging out")
+    server.broadcast_message("bob", "sent while alice was away")
+
+    server_end, client_end = socket.socketpair()
+    try:
+        server.send_login_reply(server_end, "alice", ("127.0.0.1", 5000))
+        server_end.shutdown(socket.SHUT_WR)
+        session = ChatSession("alice")
+        reader = FrameReader(client_end)
+        while (frames := reader.read_frames()):
+            for frame in frames:
+                if frame.startswith("AUTH_SUCCESS|"):
+                    session.handle_auth_success(frame)
+                else:
+                    session.handle_frame(frame)
+    finally:
+        server.clients.pop("alice", None)
+        server.gossip_keys.pop("alice", None)
+        server_end.close()
+        client_end.close()
+
+    _, messages = session.store.snapshot(BROADCAST_CONVERSATION)
+    assert [(message.sender, message.text) for message in messages][-2:] == [
+        ("alice", "sent before logging out"), ("bob", "sent while alice was away")]
+
+def test_live_echo_of_own_broadcast_is_dropped():
+    session = ChatSession("alice")
+    assert session.handle_frame("BROADCAST|alice|hello") == []
+    assert [event.sender for event in session.handle_frame("BACKLOG|alice|hello")] == ["alice"]
@@ -0,0 +1,49 @@
+"""
+Lane locks order the threads waiting for a socket, they do not preempt the one writing.
+"""
+import threading
+import time
+from common.metrics import MetricsRegistry
+from backend.lanes import OutboundLanes, CONTROL, BULK, CONTROL_BURST
+
+def queue_waiter(lock, lane, order, name):
+    """Start a thread taking a turn in lane, return once it waits in the lane"""
+    waiting = len(lock.waiting[lane])
+
+    def take_turn():
+        with lock.turn(lane):
+            order.append(name)
+
+    thread = threading.Thread(target=take_turn, daemon=True)
+    thread.start()
+    while len(lock.waiting[lane]) == waiting:
+        time.sleep(0.001)
+    return thread
+
+def test_control_overtakes_queued_bulk_but_not_the_writer():
+    lock = OutboundLanes(MetricsRegistry("test_")).lock()
+    order = []
+    lock.acquire(BULK)  # A write to a slow reader in progress
+    threads = [queue_waiter(lock, BULK, order, "bulk"), queue_waiter(lock, CONTROL, order, "control")]
+
+    # Nothing takes the socket from the writer, control frames included
+    assert not lock.acquire(CONTROL, blocking=False)
+    time.sleep(0.05)
+    assert order == []
+
+    lock.release()
+    for thread in threads:
+        thread.join(1)
+    assert order == ["control", "bulk"]
+
+def test_bulk_gets_a_turn_after_a_control_burst():
+    lock = OutboundLanes(MetricsRegistry("test_")).lock()
+    order = []
+    lock.acquire(CONTROL)
+    threads = [queue_waiter(lock, BULK, order, "bulk")]
+    threads += [queue_waiter(lock, CONTROL, order, "control") for _ in range(CONTROL_BURST + 2)]
+
+    lock.release()
+    for thread in threads:
+        thread.join(1)
+    assert order.index("bulk") == CONTROL_BURST
@@ -0,0 +1,30 @@
+"""
+Frame encoding, user text must never be able to end a frame early.
+"""
+import pytest
+from common.protocol import encode_frame
+from client.chat_client import ChatClient
+from client.core import ChatSession
+
+def test_encode_frame():
+    assert encode_frame("DIRECT", "bob", "hi | there") == b"DIRECT|bob|hi | there\n"
+
+@pytest.mark.parametrize("text", ["hi\nLOGIN|mallory|x", "hi\rthere", "\n"])
+def test_encode_frame_refuses_line_breaks(text):
+    with pytest.raises(ValueError):
+        encode_frame("BROADCAST", text)
+
+def test_client_never_sends_injected_frames():
+    written = []
+    client = ChatClient()
+    client.write = written.append
+    client.session = ChatSession("alice")
+
+    for send in (lambda text: client.send_direct("bob", text), client.send_broadcast,
+                 lambda text: client.send_room("lobby", text)):
+        ok, status = send("hello\nBROADCAST|spoofed")
+        assert not ok and "line breaks" in status
+
+    assert written == []
+    assert client.send_broadcast("hello")[0]
+    assert written == [b"BROADCAST|hello\n"]
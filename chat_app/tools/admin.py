@@ -0,0 +1,36 @@
+"""
+Send one admin command to a server's local admin socket and print the reply.
+
+The server listens on the socket named by CHAT_ADMIN_SOCKET. Only processes
+running as the server's user can connect to it.
+
+Run from the chat_app directory:
+    python -m tools.admin /run/chat-admin.sock PROFILE cpu 10
+    python -m tools.admin /run/chat-admin.sock PROFILE stacks
+    python -m tools.admin /run/chat-admin.sock STATS
+"""
+import argparse
+import socket
+
+from common.protocol import FrameReader, encode_frame
+
+def admin_request(path, fields, timeout=10.0):
+    """Send one command and return the reply frame"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(encode_frame(*fields))
+        return FrameReader(sock).read_frame()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Send an admin command to a running chat server")
+    parser.add_argument("socket", help="Path of the server's CHAT_ADMIN_SOCKET")
+    parser.add_argument("command", nargs="+", help="Command and its fields, e.g. PROFILE cpu 10")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    print(admin_request(args.socket, args.command))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Benchmark of the Streamlit GUI's render cost per event.
+
+Runs the GUI headless with streamlit.testing's AppTest, for a logged-in
+user whose client store is seeded with online users, rooms and a long
+open conversation. For each event it times what Streamlit reruns: the
+whole page, or only the fragment the event belongs to. Prints a JSON
+report with the per-run latency of each.
+
+Run from the chat_app directory:
+    python -m tools.guibench --users 200 --messages 1000
+"""
+import argparse
+import json
+import time
+
+from streamlit.testing.v1 import AppTest
+
+from client.chat_client import ChatClient
+from client.core import ChatSession
+from tools.loadgen import percentiles, git_revision
+
+USERNAME = "bench"
+CONTACTS = 30  # Users we have a conversation with
+PEER = "user1"
+
+# Script AppTest runs: the whole page, or one fragment on its own as Streamlit reruns it
+SCRIPT = """
+import streamlit as st
+from client import gui
+from client.session_state import initialize_session_state
+initialize_session_state()
+{body}
+"""
+TARGETS = {
+    "page": "gui.render_gui()",
+    "chat_pane": "gui.render_chat_pane()",
+    "message_form": "gui.render_message_form()",
+    "user_list": "gui.render_user_list()",
+    "settings": "gui.render_settings()",
+}
+
+# Events and what reruns for them, before and after fragments
+EVENTS = {
+    "message_arrives": "chat_pane",
+    "message_sent": "message_form",
+    "presence_refresh": "user_list",
+    "settings_refresh": "settings",
+}
+
+def seeded_client(users, rooms, messages):
+    """A ChatClient that is not connected, with a store filled as the inbox would fill it"""
+    client = ChatClient()
+    client.session = ChatSession(USERNAME)
+    store = client.session.store
+    store.set_online_users([USERNAME] + [f"user{n}" for n in range(users)])
+    # The sidebar draws the first WHO page and the recent contacts rather than every online user
+    names = sorted(store.online_users)
+    store.set_directory_page({"prefix": "", "cursor": "", "users": names[:10], "next": names[9], "online": len(names)})
+    for n in range(min(users, CONTACTS)):
+        store.append(f"user{n}", f"user{n}", "hello")
+    for n in range(rooms):
+        store.set_room_members(f"room{n}", [USERNAME, PEER])
+    for n in range(messages):
+        store.append(PEER, PEER if n % 2 else USERNAME, f"message {n} " + "lorem ipsum " * 4)
+    return client
+
+def app(target, client):
+    at = AppTest.from_string(SCRIPT.format(body=TARGETS[target]), default_timeout=60)
+    at.session_state["chat_client"] = client
+    at.session_state["logged_in"] = True
+    at.session_state["mode_selected"] = True
+    at.session_state["username"] = USERNAME
+    at.session_state["chat_with"] = PEER
+    return at
+
+def time_runs(target, client, runs):
+    """Time reruns of a target, a message arrives before each so cached HTML is rebuilt as it would be"""
+    at = app(target, client)
+    at.run()
+    samples = []
+    for n in range(runs):
+        client.session.store.append(PEER, PEER, f"new message {n}")
+        started = time.perf_counter_ns()
+        at.run()
+        samples.append(time.perf_counter_ns() - started)
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    return percentiles(samples)
+
+def run(args):
+    client = seeded_client(args.users, args.rooms, args.messages)
+    timings = {target: time_runs(target, client, args.runs) for target in TARGETS}
+    return {
+        "benchmark": "gui",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "config": {"users": args.users, "rooms": args.rooms, "messages": args.messages, "runs": args.runs},
+        "render_ms": timings,
+        "per_event_p50_ms": {event: {"page": timings["page"]["p50"], "fragment": timings[target]["p50"]}
+                             for event, target in EVENTS.items()},
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Streamlit GUI render cost benchmark")
+    parser.add_argument("--users", type=int, default=200, help="Online users in the user list")
+    parser.add_argument("--rooms", type=int, default=10, help="Joined rooms")
+    parser.add_argument("--messages", type=int, default=1000, help="Messages in the open conversation")
+    parser.add_argument("--runs", type=int, default=30, help="Reruns timed per target")
+    parser.add_argument("--output", help="Write the JSON report to this file as well")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    text = json.dumps(run(args), indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark of the memory used by a chat client's message history.
+
+Feeds synthetic messages through a ClientStore in this process, the way the
+inbox applies them, and measures the memory they hold with tracemalloc:
+once with every message kept in memory, once with the default per
+conversation cap, and for the overlay broadcast IDs remembered for
+deduplication. Prints a JSON report with bytes per 100k messages.
+
+Run from the chat_app directory:
+    python -m tools.historybench --messages 100000
+"""
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+import uuid
+
+from client import core, store as client_store
+from tools.loadgen import git_revision
+
+USERS = 200
+CONVERSATIONS = 50
+TEXT_SIZE = (10, 80)
+
+def generate(messages, seed):
+    """Return conversation|sender|text frames of synthetic messages"""
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz     "
+    generated = []
+    for _ in range(messages):
+        generated.append("|".join((f"user{rng.randrange(CONVERSATIONS)}", f"user{rng.randrange(USERS)}",
+                                   "".join(rng.choices(letters, k=rng.randint(*TEXT_SIZE))))))
+    return generated
+
+def measure(build):
+    """Return (bytes still allocated by build(), what it returned)"""
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return allocated, kept
+
+def fill(store, frames):
+    # Split as the inbox does, so the store keeps new strings for every field
+    for frame in frames:
+        conversation, sender, text = frame.split('|', 2)
+        store.append(conversation, sender, text)
+    return store
+
+def remember_ids(count):
+    session = core.ChatSession("bench")
+    for _ in range(count):
+        session.mark_seen(uuid.uuid4().hex)
+    return session
+
+def run(args):
+    messages = generate(args.messages, args.seed)
+    text_bytes = sum(len(frame.split('|', 2)[2]) + 49 for frame in messages)  # Size of the str objects of the bodies
+    per_100k = 100000 / args.messages
+    started = time.perf_counter()
+    fill(client_store.ClientStore(), messages)
+    append_s = time.perf_counter() - started
+    uncapped, _ = measure(lambda: fill(client_store.ClientStore(history_limit=args.messages), messages))
+    capped, kept = measure(lambda: fill(client_store.ClientStore(), messages))
+    ids, _ = measure(lambda: remember_ids(core.MAX_SEEN_IDS))
+    return {
+        "benchmark": "history",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "config": {"messages": args.messages, "users": USERS, "conversations": CONVERSATIONS,
+                   "history_limit": client_store.HISTORY_LIMIT},
+        "uncapped_bytes_per_100k": round(uncapped * per_100k),
+        "uncapped_overhead_bytes_per_message": round((uncapped - text_bytes) / args.messages, 1),
+        "append_us_per_message": round(append_s / args.messages * 1e6, 2),
+        "capped_bytes_per_100k": round(capped * per_100k),
+        "capped_messages_in_memory": sum(len(messages) for _, messages in
+                                         (kept.snapshot(name) for name in kept.versions())),
+        "seen_ids": core.MAX_SEEN_IDS,
+        "seen_ids_bytes": ids,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Client history memory benchmark")
+    parser.add_argument("--messages", type=int, default=100000, help="Messages appended to the history")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report to this file as well")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    text = json.dumps(run(args), indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+"""
+Headless load generator and end-to-end benchmark for the chat server.
+
+Starts server.py locally (unless --port points at a running server), connects
+N simulated clients that speak the real LOGIN/DIRECT/BROADCAST/P2P_* protocol
+and prints a JSON report with throughput, delivery latency and server usage.
+
+Run from the chat_app directory:
+    python -m tools.loadgen --scenario dm --clients 1000 --duration 30
+    python -m tools.loadgen --scenario broadcast --clients 200 --output bench.json
+    python -m tools.loadgen --scenario dm --clients 300 --nodes 3
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from common.protocol import encode_frame
+
+SCENARIOS = ("dm", "broadcast", "login_storm", "churn", "p2p")
+PASSWORD = "bench-password"
+BENCH_PREFIX = "bench:"  # Marks message bodies that carry a send timestamp
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+STREAM_LIMIT = 16 * 1024 * 1024  # USERS frames grow with the number of online users
+CLUSTER_SETTLE = 1.0  # Seconds for freshly started nodes to link up
+
+def percentiles(samples_ns):
+    """Summarize latency samples in milliseconds"""
+    if not samples_ns:
+        return {"count": 0}
+    ordered = sorted(samples_ns)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] / 1e6, 3)
+
+    return {"count": len(ordered), "p50": pick(0.5), "p99": pick(0.99), "p999": pick(0.999),
+            "max": round(ordered[-1] / 1e6, 3)}
+
+def password_hash():
+    return hashlib.sha256(PASSWORD.encode()).hexdigest()
+
+def usernames(count):
+    return [f"bench{i}" for i in range(count)]
+
+class BenchStats:
+    """Counters and latency samples shared by every simulated client"""
+
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.delivery_ns = []
+        self.same_node_ns = []  # Delivery samples by whether sender and recipient share a node
+        self.cross_node_ns = []
+        self.login_ns = []
+        self.p2p_ns = []
+        self.errors = {}
+        self.traffic_started = None  # Traffic phase, excludes the initial logins
+        self.traffic_ended = None
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+class SimClient:
+    """One simulated chat client on an asyncio connection"""
+
+    def __init__(self, name, host, port, stats, node=0):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.node = node  # Index of the server node this client logs in to
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.connected = False
+        self.p2p_requests = {}  # Pending P2P requests: {peer: send time}
+        self.logged_in_ns = 0  # Start of the last login, older broadcasts are replayed from the backlog
+
+    async def connect(self, retries=5):
+        """Log in, retrying with jittered backoff when the server refuses"""
+        for attempt in range(retries):
+            started = time.monotonic_ns()
+            try:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=STREAM_LIMIT)
+                self.writer.write(encode_frame("LOGIN", self.name, password_hash()))
+                await self.writer.drain()
+                response = (await self.reader.readuntil(b"\n")).decode().rstrip("\n")
+            except (OSError, asyncio.IncompleteReadError) as e:
+                self.stats.error(type(e).__name__)
+                await asyncio.sleep(random.uniform(0.05, 0.2) * (2 ** attempt))
+                continue
+
+            if response.startswith("AUTH_SUCCESS"):
+                self.stats.login_ns.append(time.monotonic_ns() - started)
+                self.logged_in_ns = started
+                self.connected = True
+                self.reader_task = asyncio.create_task(self.read_loop())
+                return True
+
+            self.stats.error(response.split('|', 1)[0] or "EMPTY_RESPONSE")
+            self.writer.close()
+            # Honour the server's retry hint when it turned us away
+            base = int(response.split('|')[1]) / 1000 if response.startswith("BUSY|") else 0.1
+            await asyncio.sleep(base * random.uniform(0.5, 1.5) * (2 ** attempt))
+        return False
+
+    async def read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readuntil(b"\n")
+                self.handle_frame(line.decode().rstrip("\n"))
+        except (OSError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connected = False
+
+    def handle_frame(self, frame):
+        parts = frame.split('|')
+        frame_type = parts[0]
+
+        if frame_type in ("DIRECT", "BROADCAST", "GOSSIP", "ROOM_MSG"):
+            body = parts[-1]
+            if body.startswith(BENCH_PREFIX):
+                sent_ns, sender_node, _ = body[len(BENCH_PREFIX):].split(':', 2)
+                if int(sent_ns) < self.logged_in_ns:
+                    return  # Replayed at login, not a delivery
+                latency = time.monotonic_ns() - int(sent_ns)
+                self.stats.delivered += 1
+                self.stats.delivery_ns.append(latency)
+                if int(sender_node) == self.node:
+                    self.stats.same_node_ns.append(latency)
+                else:
+                    self.stats.cross_node_ns.append(latency)
+        elif frame_type == "PING":
+            self.send("PONG", *parts[1:])
+        elif frame_type == "P2P_REQUEST_NOTIFICATION":
+            self.send("P2P_ACCEPT", parts[1])
+        elif frame_type == "P2P_INFO":
+            started = self.p2p_requests.pop(parts[1], None)
+            if started is not None:
+                self.stats.p2p_ns.append(time.monotonic_ns() - started)
+        elif frame_type == "ERROR":
+            self.stats.error("ERROR")
+
+    def send(self, *fields):
+        if not self.connected:
+            return False
+        try:
+            self.writer.write(encode_frame(*fields))
+            return True
+        except (OSError, RuntimeError):
+            self.stats.error("send")
+            return False
+
+    def bench_body(self, size):
+        body = f"{BENCH_PREFIX}{time.monotonic_ns()}:{self.node}:"
+        return body + "x" * max(0, size - len(body))
+
+    async def close(self):
+        self.connected = False
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+class ServerProcess:
+    """chat_app/server.py running in a scratch directory with seeded accounts"""
+
+    def __init__(self, user_count, cluster_peers=None, extra_env=None, names=None):
+        # names replaces the generated bench usernames, replays seed the users of their capture
+        self.workdir = tempfile.mkdtemp(prefix="chat-bench-")
+        with open(os.path.join(self.workdir, "user_credentials.json"), "w") as f:
+            json.dump({name: password_hash() for name in (names or usernames(user_count))}, f)
+        self.port = free_port()
+        # Cluster nodes also listen for peer nodes and dial the ones started before them
+        self.cluster_port = free_port() if cluster_peers is not None else None
+        self.cluster_peers = cluster_peers or []
+        self.extra_env = extra_env or {}
+        self.process = None
+        self.log_file = None
+
+    def start(self):
+        env = dict(os.environ, CHAT_SERVER_HOST="127.0.0.1", CHAT_SERVER_PORT=str(self.port),
+                   CHAT_LOG_LEVEL=os.environ.get("CHAT_LOG_LEVEL", "WARNING"))
+        if self.cluster_port:
+            env.update(CHAT_CLUSTER_PORT=str(self.cluster_port), CHAT_NODE_ID=f"bench-{self.port}",
+                       CHAT_CLUSTER_SECRET=os.environ.get("CHAT_CLUSTER_SECRET", "bench"),
+                       CHAT_CLUSTER_PEERS=",".join(f"127.0.0.1:{port}" for port in self.cluster_peers))
+        env.update(self.extra_env)
+        # Keep server output out of the JSON report on stdout
+        self.log_file = open(os.path.join(self.workdir, "server.log"), "w")
+        self.process = subprocess.Popen([sys.executable, SERVER_SCRIPT], cwd=self.workdir, env=env,
+                                        stdout=self.log_file, stderr=subprocess.STDOUT)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.2).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("Server did not start listening")
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+            self.log_file.close()
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def read_process_status(pid):
+    """Return (rss_kb, threads) of a local process, or (None, None) off Linux"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields["VmRSS"].split()[0]), int(fields["Threads"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+async def sample_server(pid, samples, stop):
+    while not stop.is_set():
+        rss_kb, threads = read_process_status(pid)
+        if rss_kb is not None:
+            samples.append((rss_kb, threads))
+        await asyncio.sleep(0.5)
+
+async def connect_all(clients, concurrency):
+    gate = asyncio.Semaphore(concurrency)
+
+    async def connect(client):
+        async with gate:
+            await client.connect()
+
+    await asyncio.gather(*(connect(client) for client in clients))
+
+async def paced(rate, duration, action):
+    """Call action() rate times per second until duration elapses"""
+    interval = 1.0 / rate
+    deadline = time.monotonic() + duration
+    next_send = time.monotonic() + random.uniform(0, interval)
+    while time.monotonic() < deadline:
+        await asyncio.sleep(max(0, next_send - time.monotonic()))
+        action()
+        next_send += interval
+
+def dm_action(client, clients, stats, size):
+    def action():
+        peer = random.choice(clients)
+        if peer is not client and client.send("DIRECT", peer.name, client.bench_body(size)):
+            stats.sent += 1
+    return action
+
+async def run_scenario(args, clients, stats):
+    names = [client.name for client in clients]
+
+    if args.scenario == "login_storm":
+        deadline = time.monotonic() + args.duration
+        while True:
+            await asyncio.gather(*(client.connect() for client in clients))
+            await asyncio.gather(*(client.close() for client in clients))
+            if time.monotonic() >= deadline:
+                return
+            await asyncio.sleep(0.1)
+
+    await connect_all(clients, args.connect_concurrency)
+    stats.traffic_started = time.monotonic()
+
+    if args.scenario == "dm":
+        await asyncio.gather(*(paced(args.rate, args.duration, dm_action(client, clients, stats, args.message_size))
+                               for client in clients))
+
+    elif args.scenario == "broadcast":
+        senders = clients[:args.senders]
+
+        def broadcast_action(client):
+            def action():
+                if client.send("BROADCAST", client.bench_body(args.message_size)):
+                    # The server delivers broadcasts to every online client, the sender included
+                    stats.sent += len(clients)
+            return action
+
+        await asyncio.gather(*(paced(args.rate, args.duration, broadcast_action(client)) for client in senders))
+
+    elif args.scenario == "churn":
+        async def churn():
+            deadline = time.monotonic() + args.duration
+            while time.monotonic() < deadline:
+                await asyncio.sleep(args.churn_interval)
+                leaving = random.sample(clients, max(1, int(len(clients) * args.churn_fraction)))
+                await asyncio.gather(*(client.close() for client in leaving))
+                await asyncio.gather(*(client.connect() for client in leaving))
+
+        await asyncio.gather(churn(), *(paced(args.rate, args.duration, dm_action(client, clients, stats, args.message_size))
+                                        for client in clients))
+
+    elif args.scenario == "p2p":
+        for port, client in enumerate(clients, start=20000):
+            client.send("P2P_PORT", port)
+
+        def p2p_action(client):
+            def action():
+                peer = random.choice(names)
+                if peer != client.name and client.send("P2P_REQUEST", peer):
+                    client.p2p_requests[peer] = time.monotonic_ns()
+                    stats.sent += 1
+            return action
+
+        await asyncio.gather(*(paced(args.rate, args.duration, p2p_action(client)) for client in clients))
+
+    # Give in-flight frames a moment to arrive before reporting
+    await asyncio.sleep(args.drain)
+    stats.traffic_ended = time.monotonic()
+
+async def run(args):
+    raise_fd_limit()
+    stats = BenchStats()
+    servers = []
+    addresses = [(args.host, args.port)]
+    if not args.port:
+        for _ in range(args.nodes):
+            cluster_peers = [node.cluster_port for node in servers] if args.nodes > 1 else None
+            servers.append(ServerProcess(args.clients, cluster_peers))
+            servers[-1].start()
+        if args.nodes > 1:
+            await asyncio.sleep(CLUSTER_SETTLE)
+        addresses = [("127.0.0.1", node.port) for node in servers]
+
+    # Clients are spread over the nodes round robin
+    clients = [SimClient(name, *addresses[i % len(addresses)], stats, node=i % len(addresses))
+               for i, name in enumerate(usernames(args.clients))]
+    samples = []
+    stop_sampling = asyncio.Event()
+    # Server usage is sampled on the first node only
+    sampler = asyncio.create_task(sample_server(servers[0].process.pid, samples, stop_sampling)) if servers else None
+
+    started = time.monotonic()
+    try:
+        await run_scenario(args, clients, stats)
+    finally:
+        elapsed = time.monotonic() - started
+        stop_sampling.set()
+        if sampler:
+            await sampler
+        await asyncio.gather(*(client.close() for client in clients))
+        for node in servers:
+            node.stop()
+
+    traffic_elapsed = (stats.traffic_ended - stats.traffic_started) if stats.traffic_ended else elapsed
+    delivered_per_s = stats.delivered / traffic_elapsed if traffic_elapsed else 0.0
+    return {
+        "scenario": args.scenario,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "elapsed_s": round(elapsed, 3),
+        "traffic_elapsed_s": round(traffic_elapsed, 3),
+        "messages_sent": stats.sent,
+        "messages_delivered": stats.delivered,
+        "messages_per_s": round(delivered_per_s, 1),
+        "logins_per_s": round(len(stats.login_ns) / elapsed, 1) if elapsed else 0.0,
+        "delivery_latency_ms": percentiles(stats.delivery_ns),
+        "same_node_latency_ms": percentiles(stats.same_node_ns),
+        "cross_node_latency_ms": percentiles(stats.cross_node_ns),
+        "login_latency_ms": percentiles(stats.login_ns),
+        "p2p_negotiation_ms": percentiles(stats.p2p_ns),
+        "errors": stats.errors,
+        "server": {
+            "rss_kb_max": max((rss for rss, _ in samples), default=None),
+            "rss_kb_final": samples[-1][0] if samples else None,
+            "threads_max": max((threads for _, threads in samples), default=None),
+        },
+    }
+
+def raise_fd_limit():
+    """Allow one socket per simulated client"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(SERVER_SCRIPT)).stdout.strip() or None
+    except OSError:
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the chat server")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="dm")
+    parser.add_argument("--clients", type=int, default=100, help="Number of simulated clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of traffic per run")
+    parser.add_argument("--rate", type=float, default=1.0, help="Messages per second per sending client")
+    parser.add_argument("--senders", type=int, default=5, help="Broadcasting clients in the broadcast scenario")
+    parser.add_argument("--message-size", type=int, default=64, help="Message body size in bytes")
+    parser.add_argument("--churn-interval", type=float, default=1.0, help="Seconds between churn rounds")
+    parser.add_argument("--churn-fraction", type=float, default=0.05, help="Share of clients reconnecting per round")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="Logins in flight at once")
+    parser.add_argument("--drain", type=float, default=1.0, help="Seconds to wait for in-flight frames")
+    parser.add_argument("--host", default="127.0.0.1", help="Server host when --port is given")
+    parser.add_argument("--port", type=int, default=0, help="Benchmark a running server instead of starting one")
+    parser.add_argument("--nodes", type=int, default=1, help="Federated server nodes to start and spread clients over")
+    parser.add_argument("--output", help="Write the JSON report to this file as well")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
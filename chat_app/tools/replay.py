@@ -0,0 +1,177 @@
+"""
+Replay a capture of client traffic against a local chat server.
+
+Reads a capture written by a server started with CHAT_CAPTURE_PATH, starts
+server.py with the captured users (unless --port points at a running
+server), and drives one simulated client per captured connection. Every
+client logs in, sends its frames and disconnects at the captured times,
+divided by --speed, or as fast as possible with --speed max. Message
+bodies are prefixed with a send timestamp, so the JSON report has delivery
+latency next to the achieved throughput and can be compared across builds.
+
+Run from the chat_app directory:
+    python -m tools.replay busy-hour.cap --speed 1
+    python -m tools.replay busy-hour.cap.gz --speed max --output replay.json
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from backend import capture
+from common.protocol import encode_frame
+from tools.loadgen import (BENCH_PREFIX, BenchStats, ServerProcess, SimClient, git_revision, password_hash,
+                           percentiles, raise_fd_limit, sample_server)
+
+# Message commands and the number of fields before their body
+MESSAGE_FIELDS = {"DIRECT": 2, "BROADCAST": 1, "ROOM_MSG": 2}
+
+# Frames the simulated clients produce themselves
+SKIPPED_COMMANDS = {"LOGIN", "REGISTER", "PONG"}
+
+class ReplayClient(SimClient):
+    """Simulated client that only sends what the capture says it sent"""
+
+    def handle_frame(self, frame):
+        # The captured client's own P2P_ACCEPT frames are replayed instead
+        if not frame.startswith("P2P_REQUEST_NOTIFICATION|"):
+            super().handle_frame(frame)
+
+def load_connections(path):
+    """Group the records of a capture by connection, keeping only connections that logged in"""
+    records = {}
+    users = {}
+    for record in capture.read_capture(path):
+        records.setdefault(record.connection, []).append(record)
+        if record.kind == capture.USER:
+            users[record.connection] = record.data
+    return {connection: (users[connection], connection_records)
+            for connection, connection_records in records.items() if connection in users}
+
+def timestamp_frame(frame):
+    """Prefix the body of a message frame with the send time, return None for frames not to replay"""
+    command = frame.split('|', 1)[0]
+    if command in SKIPPED_COMMANDS:
+        return None
+    fields = MESSAGE_FIELDS.get(command)
+    if fields is None:
+        return frame
+    parts = frame.split('|', fields)
+    if len(parts) <= fields:
+        return frame
+    parts[-1] = f"{BENCH_PREFIX}{time.monotonic_ns()}:0:{parts[-1]}"
+    return "|".join(parts)
+
+async def replay_connection(client, records, started, origin_ns, speed, counts):
+    for record in records:
+        # speed 0 replays as fast as possible, sleep(0) still lets the other connections run
+        delay = started + (record.time_ns - origin_ns) / 1e9 / speed - time.monotonic() if speed else 0
+        await asyncio.sleep(max(0, delay))
+        if record.kind == capture.USER:
+            if not await client.connect():
+                return
+        elif record.kind == capture.CLOSE:
+            await client.close()
+        elif client.connected:
+            frame = timestamp_frame(record.data)
+            if frame is not None and client.send(frame):
+                counts["frames"] += 1
+                if frame.startswith(tuple(MESSAGE_FIELDS)):
+                    counts["messages"] += 1
+
+async def register_users(host, port, names):
+    """Create the captured accounts on a running server, existing ones are left alone"""
+    for name in names:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(encode_frame("REGISTER", name, password_hash()))
+        await reader.readuntil(b"\n")
+        writer.close()
+
+async def run(args):
+    raise_fd_limit()
+    connections = load_connections(args.capture)
+    names = sorted({username for username, _ in connections.values()})
+    end_ns = max((records[-1].time_ns for _, records in connections.values()), default=0)
+    start_ns = min((records[0].time_ns for _, records in connections.values()), default=0)
+    captured_frames = sum(1 for _, records in connections.values() for record in records
+                          if record.kind == capture.FRAME and record.data.split('|', 1)[0] not in SKIPPED_COMMANDS)
+
+    server = None
+    host, port = args.host, args.port
+    if not port:
+        server = ServerProcess(0, names=names)
+        server.start()
+        host, port = "127.0.0.1", server.port
+    else:
+        await register_users(host, port, names)
+
+    stats = BenchStats()
+    counts = {"frames": 0, "messages": 0}
+    clients = {connection: ReplayClient(username, host, port, stats) for connection, (username, _) in connections.items()}
+    samples = []
+    stop_sampling = asyncio.Event()
+    sampler = asyncio.create_task(sample_server(server.process.pid, samples, stop_sampling)) if server else None
+
+    speed = 0 if args.speed == "max" else float(args.speed)
+    started = time.monotonic()
+    try:
+        # The replay starts at the first record, not at the time the server started recording
+        await asyncio.gather(*(replay_connection(clients[connection], records, started, start_ns, speed, counts)
+                               for connection, (_, records) in connections.items()))
+        replayed = time.monotonic() - started
+        await asyncio.sleep(args.drain)
+    finally:
+        stop_sampling.set()
+        if sampler:
+            await sampler
+        await asyncio.gather(*(client.close() for client in clients.values()))
+        if server:
+            server.stop()
+
+    captured_s = (end_ns - start_ns) / 1e9
+    return {
+        "benchmark": "replay",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "config": {"capture": args.capture, "speed": args.speed},
+        "capture": {"connections": len(connections), "users": len(names), "frames": captured_frames,
+                    "duration_s": round(captured_s, 3)},
+        "replay_s": round(replayed, 3),
+        "frames_sent": counts["frames"],
+        "frames_per_s": round(counts["frames"] / replayed, 1) if replayed else 0.0,
+        "captured_frames_per_s": round(captured_frames / captured_s, 1) if captured_s else 0.0,
+        "messages_sent": counts["messages"],
+        "messages_delivered": stats.delivered,
+        "messages_per_s": round(stats.delivered / replayed, 1) if replayed else 0.0,
+        "delivery_latency_ms": percentiles(stats.delivery_ns),
+        "login_latency_ms": percentiles(stats.login_ns),
+        "errors": stats.errors,
+        "server": {
+            "rss_kb_max": max((rss for rss, _ in samples), default=None),
+            "threads_max": max((threads for _, threads in samples), default=None),
+        },
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a capture against the chat server")
+    parser.add_argument("capture", help="Capture file written by a server with CHAT_CAPTURE_PATH")
+    parser.add_argument("--speed", default="1", help="Time compression factor, or max for no pauses")
+    parser.add_argument("--drain", type=float, default=1.0, help="Seconds to wait for in-flight frames")
+    parser.add_argument("--host", default="127.0.0.1", help="Server host when --port is given")
+    parser.add_argument("--port", type=int, default=0, help="Replay against a running server instead of starting one")
+    parser.add_argument("--output", help="Write the JSON report to this file as well")
+    args = parser.parse_args(argv)
+    if args.speed != "max" and float(args.speed) <= 0:
+        parser.error("--speed must be positive or max")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    text = json.dumps(asyncio.run(run(args)), indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
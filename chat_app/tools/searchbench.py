@@ -0,0 +1,109 @@
+"""
+Benchmark of the server's full-text search index.
+
+Feeds synthetic chat messages (a Zipf-like vocabulary spread over DMs,
+rooms and broadcasts) through a SearchIndex in this process, then times
+queries of rare, common and multi-word terms for one user. Prints a JSON
+report with indexing throughput, query latency, segment count and size.
+
+Run from the chat_app directory:
+    python -m tools.searchbench --messages 1000000
+"""
+import argparse
+import itertools
+import json
+import random
+import time
+
+from backend import search
+from common.metrics import MetricsRegistry
+from tools.loadgen import percentiles, git_revision
+
+VOCABULARY = 20000
+WORDS_PER_MESSAGE = (3, 15)
+USERS = 1000
+ROOMS = 50
+
+def generate(messages, seed):
+    """Return (conversation, sender, text, participants) tuples of synthetic messages"""
+    rng = random.Random(seed)
+    # Word n is drawn with weight 1/(n+1), like natural language
+    words = [f"w{n}" for n in range(VOCABULARY)]
+    cumulative = list(itertools.accumulate(1 / (n + 1) for n in range(VOCABULARY)))
+    generated = []
+    for i in range(messages):
+        text = " ".join(rng.choices(words, cum_weights=cumulative, k=rng.randint(*WORDS_PER_MESSAGE)))
+        sender = f"user{rng.randrange(USERS)}"
+        kind = i % 10
+        if kind < 6:
+            recipient = f"user{rng.randrange(USERS)}"
+            generated.append((search.dm_key(sender, recipient), sender, text, (sender, recipient)))
+        elif kind < 9:
+            generated.append((f"#room{rng.randrange(ROOMS)}", sender, text, ()))
+        else:
+            generated.append((search.BROADCAST_KEY, sender, text, ()))
+    return generated
+
+def build(index, messages):
+    """Queue messages as the relay would and wait until they are indexed and merged"""
+    started = time.perf_counter()
+    for message in messages:
+        index.add(*message)
+    queued = time.perf_counter() - started
+    while index.incoming.qsize():
+        time.sleep(0.01)
+    indexed = time.perf_counter() - started
+    while search.merge_candidates(list(index.segments)):
+        time.sleep(0.01)
+    return queued, indexed
+
+def time_queries(index, queries, rounds):
+    rooms = {f"room{n}": 0 for n in range(0, ROOMS, 5)}
+    samples = []
+    hits = 0
+    for _ in range(rounds):
+        for query in queries:
+            started = time.perf_counter_ns()
+            hits += len(index.search(query, "user1", rooms))
+            samples.append(time.perf_counter_ns() - started)
+    return {"latency_ms": percentiles(samples), "avg_hits": round(hits / (rounds * len(queries)), 1)}
+
+def run(args):
+    index = search.SearchIndex(MetricsRegistry("bench_"))
+    index.start()
+    queued, indexed = build(index, generate(args.messages, args.seed))
+    query_sets = {
+        "rare": [f"w{n}" for n in range(VOCABULARY - 50, VOCABULARY)],
+        "common": [f"w{n}" for n in range(10)],
+        "two_words": [f"w{n} w{n * 7 + 100}" for n in range(1, 51)],
+    }
+    return {
+        "benchmark": "search",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "config": {"messages": args.messages, "vocabulary": VOCABULARY, "users": USERS, "rooms": ROOMS},
+        "enqueue_us_per_message": round(queued / args.messages * 1e6, 2),
+        "index_messages_per_second": round(args.messages / indexed),
+        "segments": [segment.level for segment in index.segments],
+        "index_bytes": sum(segment.size() for segment in index.segments),
+        **{name: time_queries(index, queries, args.rounds) for name, queries in query_sets.items()},
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Search index benchmark")
+    parser.add_argument("--messages", type=int, default=1000000, help="Messages indexed before querying")
+    parser.add_argument("--rounds", type=int, default=5, help="Times each query is repeated")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report to this file as well")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    text = json.dumps(run(args), indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
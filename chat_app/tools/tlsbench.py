@@ -0,0 +1,111 @@
+"""
+Reconnect latency benchmark for the TLS transport.
+
+Creates a self-signed certificate with the openssl command line tool, starts
+server.py with TLS, and times connect + handshake + LOGIN until AUTH_SUCCESS
+for repeated reconnects over plain TCP, TLS with a full handshake every
+time, and TLS resuming the previous session. Prints a JSON report.
+
+Run from the chat_app directory:
+    python -m tools.tlsbench --reconnects 200
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import time
+
+from common import tls
+from common.protocol import encode_frame, FrameReader
+from tools.loadgen import ServerProcess, password_hash, percentiles, usernames, git_revision
+
+MODES = ("plain", "tls_full", "tls_resumed")
+
+KEY_TYPES = {"ec": ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1"], "rsa": ["-newkey", "rsa:2048"]}
+
+def make_self_signed(directory, key_type="rsa"):
+    """Write cert.pem and key.pem for localhost and 127.0.0.1, return their paths"""
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", *KEY_TYPES[key_type], "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+                    "-keyout", keyfile, "-out", certfile], check=True, capture_output=True)
+    return certfile, keyfile
+
+def login_once(port, client_tls, username):
+    """Connect, log in and return (elapsed nanoseconds, TLS version or None)"""
+    started = time.perf_counter_ns()
+    sock = socket.create_connection(("127.0.0.1", port))
+    if client_tls:
+        sock = client_tls.wrap(sock, ("127.0.0.1", port))
+    sock.sendall(encode_frame("LOGIN", username, password_hash()))
+    response = FrameReader(sock).read_frame() or ""
+    elapsed = time.perf_counter_ns() - started
+    version = None
+    if client_tls:
+        client_tls.remember(("127.0.0.1", port), sock)
+        version = sock.version()
+    sock.close()
+    if not response.startswith("AUTH_SUCCESS"):
+        raise RuntimeError(f"Login failed: {response}")
+    return elapsed, version
+
+def run_mode(mode, port, certfile, reconnects):
+    client_tls = None
+    if mode != "plain":
+        client_tls = tls.ClientTLS(tls.client_context(certfile))
+    username = usernames(1)[0]
+    samples = []
+    version = None
+    for _ in range(reconnects):
+        if mode == "tls_full":
+            client_tls.sessions.clear()  # Never offer a session, every reconnect is a full handshake
+        elapsed, version = login_once(port, client_tls, username)
+        samples.append(elapsed)
+    result = {"reconnect_ms": percentiles(samples)}
+    if client_tls:
+        result["tls_version"] = version
+        result["handshakes"] = dict(client_tls.handshakes)
+    return result
+
+def run(args):
+    plain = ServerProcess(1)
+    certfile, keyfile = make_self_signed(plain.workdir, args.key_type)
+    secure = ServerProcess(1, extra_env={"CHAT_TLS_CERT": certfile, "CHAT_TLS_KEY": keyfile})
+    try:
+        plain.start()
+        secure.start()
+        report = {}
+        for mode in MODES:
+            port = plain.port if mode == "plain" else secure.port
+            report[mode] = run_mode(mode, port, certfile, args.reconnects)
+    finally:
+        plain.stop()
+        secure.stop()
+
+    return {
+        "benchmark": "tls_reconnect",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "config": {"reconnects": args.reconnects, "key_type": args.key_type},
+        **report,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="TLS reconnect latency benchmark")
+    parser.add_argument("--reconnects", type=int, default=200, help="Logins timed per mode")
+    parser.add_argument("--key-type", choices=sorted(KEY_TYPES), default="rsa", help="Certificate key algorithm")
+    parser.add_argument("--output", help="Write the JSON report to this file as well")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    text = json.dumps(run(args), indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()